@@ -0,0 +1,43 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cache
+
+DEFAULT_ACCOUNT = 'default'
+
+_current_account: ContextVar[str] = ContextVar('wb_account', default=DEFAULT_ACCOUNT)
+
+
+@cache
+def get_accounts() -> dict[str, str]:
+    """Возвращает аккаунты продавца и их API ключи.
+    Аккаунты задаются переменной WB_ACCOUNTS вида 'имя=ключ,...',
+    без неё используется один аккаунт default с ключом WB_API_KEY.
+    Переменные окружения читаются при первом обращении, а не при импорте
+    @return: словарь {имя аккаунта: API ключ} в порядке объявления
+    """
+    accounts = {}
+    for account in filter(None, os.getenv('WB_ACCOUNTS', '').replace(' ', '').split(',')):
+        name, _, api_key = account.partition('=')
+        accounts[name] = api_key
+    return accounts or {DEFAULT_ACCOUNT: os.getenv('WB_API_KEY', '')}
+
+
+def get_current_account() -> str:
+    """Возвращает аккаунт, от имени которого выполняются запросы к API и БД"""
+    return _current_account.get()
+
+
+@contextmanager
+def use_account(account: str):
+    """Контекстный менеджер выполняет блок от имени аккаунта.
+    Значение хранится в contextvar, поэтому потоки бота не мешают друг другу
+    @param account: Имя аккаунта из get_accounts
+    """
+    if account not in get_accounts():
+        raise KeyError(f'Неизвестный аккаунт {account}')
+    token = _current_account.set(account)
+    try:
+        yield account
+    finally:
+        _current_account.reset(token)
@@ -0,0 +1,127 @@
+import base64
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.client import responses
+from urllib.parse import urlencode
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from .errors import WBAPIError
+
+logger = logging.getLogger(__name__)
+
+# Заголовки ответа, которые нужны клиенту и сохраняются в кассете
+_SAVED_HEADERS = ('Content-Type', 'Retry-After', 'X-Ratelimit-Remaining', 'X-Ratelimit-Retry')
+_REDACTED = '<WB_API_KEY>'
+
+
+class Cassette:
+    """Запись и воспроизведение запросов к API Wildberries.
+    Кассета - файл JSON Lines, сжатый gzip, по строке на запрос. Каждая строка пишется
+    отдельным полным членом gzip, поэтому кассета читается и после аварийной остановки процесса. Заголовки запроса
+    не сохраняются, а API ключ вырезается из всех сохраняемых строк.
+    При воспроизведении ответы на одинаковые запросы отдаются в порядке записи,
+    после последнего повторяется последний ответ
+    """
+
+    def __init__(self, path: str, mode: str, time_scale: float = 1, api_key: str = ''):
+        """
+        @param path: Путь к файлу кассеты
+        @param mode: 'record' - дописывать запросы в кассету, 'replay' - отвечать из кассеты
+        @param time_scale: Множитель к записанному времени ответа при воспроизведении.
+        1 - исходное время, 0 - без задержек
+        @param api_key: API ключ, который вырезается из записи
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Неизвестный режим кассеты: {mode}')
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self._api_key = api_key
+        self._lock = threading.Lock()
+        self._file = None
+        self._responses: dict[str, deque[dict]] = defaultdict(deque)
+        if mode == 'replay':
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            try:
+                for line in file:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self._responses[interaction['key']].append(interaction)
+            except EOFError:
+                # Последняя запись оборвалась при остановке процесса во время записи
+                logger.warning('Кассета %s обрезана, последняя запись пропущена', self.path)
+        logger.info('Загружена кассета %s: %s разных запросов', self.path, len(self._responses))
+
+    @staticmethod
+    def make_key(method: str, path: str, params: dict = None, json_: dict | list = None) -> str:
+        """Собирает ключ запроса из метода, пути, параметров и тела запроса"""
+        query = urlencode(sorted((key, str(value)) for key, value in (params or {}).items()))
+        body = json.dumps(json_, sort_keys=True, ensure_ascii=False) if json_ is not None else ''
+        return f'{method} {path}?{query} {body}'
+
+    def _redact(self, text: str) -> str:
+        return text.replace(self._api_key, _REDACTED) if self._api_key else text
+
+    def record(self, method: str, path: str, response: Response, params: dict = None, json_: dict | list = None):
+        """Дописывает запрос и ответ в кассету"""
+        interaction = {
+            'key': self._redact(self.make_key(method, path, params, json_)),
+            'status': response.status_code,
+            'headers': {name: response.headers[name] for name in _SAVED_HEADERS if name in response.headers},
+            'elapsed': round(response.elapsed.total_seconds(), 4),
+        }
+        try:
+            interaction['content'] = self._redact(response.content.decode('utf-8'))
+        except UnicodeDecodeError:
+            interaction['content_b64'] = base64.b64encode(response.content).decode()
+        member = gzip.compress((json.dumps(interaction, ensure_ascii=False) + '\n').encode('utf-8'))
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, 'ab')
+            self._file.write(member)
+            self._file.flush()
+
+    def replay(self, method: str, path: str, params: dict = None, json_: dict | list = None) -> Response:
+        """Отвечает на запрос из кассеты, выдерживая записанное время ответа
+        @return: Response, собранный из записи
+        @raise: WBAPIError, если запроса нет в кассете
+        """
+        key = self.make_key(method, path, params, json_)
+        with self._lock:
+            interactions = self._responses.get(self._redact(key))
+            if not interactions:
+                raise WBAPIError(f'Запрос отсутствует в кассете {self.path}: {key}')
+            interaction = interactions.popleft() if len(interactions) > 1 else interactions[0]
+
+        if delay := interaction['elapsed'] * self.time_scale:
+            time.sleep(delay)
+        response = Response()
+        response.status_code = interaction['status']
+        response.reason = responses.get(response.status_code)
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        if 'content_b64' in interaction:
+            response._content = base64.b64decode(interaction['content_b64'])
+        else:
+            response._content = interaction['content'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = path
+        response.elapsed = datetime.timedelta(seconds=interaction['elapsed'])
+        return response
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
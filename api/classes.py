@@ -3,8 +3,46 @@ from dataclasses import dataclass
 
 from pydantic import BaseModel, Field
 
+from config import WB_VALIDATE_RESPONSES
+from .parsing import parse_datetime
 
-class Supply(BaseModel):
+_FAST_CONVERTERS = {
+    datetime.datetime: parse_datetime,
+    str: str,
+    int: int,
+    bool: bool,
+}
+
+
+class FastParseModel(BaseModel):
+    """Базовый класс для моделей, которые парсятся из ответов API большими списками"""
+
+    @classmethod
+    def parse_list(cls, items: list[dict], validate: bool = WB_VALIDATE_RESPONSES) -> list:
+        """Парсит список объектов из ответа API
+        @param items: список словарей из json ответа
+        @param validate: Если True, то каждый объект проходит полную валидацию pydantic.
+        В противном случае поля только приводятся к нужным типам, что в разы быстрее
+        @return: список объектов модели
+        """
+        if validate:
+            return [cls.parse_obj(item) for item in items]
+
+        fields = [
+            (name, field.alias, _FAST_CONVERTERS.get(field.type_, lambda value: value), field.default)
+            for name, field in cls.__fields__.items()]
+        fields_set = set(cls.__fields__)
+        parsed_items = []
+        for item in items:
+            values = {}
+            for name, alias, convert, default in fields:
+                value = item.get(alias)
+                values[name] = default if value is None else convert(value)
+            parsed_items.append(cls.construct(_fields_set=fields_set, **values))
+        return parsed_items
+
+
+class Supply(FastParseModel):
     """Класс для парсинга информации о поставке полученной от API"""
     supply_id: str = Field(alias='id')
     name: str
@@ -16,14 +54,14 @@ class Supply(BaseModel):
         return self.supply_id, self.name, self.closed_at, self.created_at, self.is_done
 
 
-class Order(BaseModel):
+class Order(FastParseModel):
     """Класс для парсинга информации о заказе полученной от API"""
     order_id: int = Field(alias='id')
     article: str
     created_at: datetime.datetime = Field(alias='createdAt')
 
 
-class Sticker(BaseModel):
+class Sticker(FastParseModel):
     """Класс для парсинга информации о стикере полученной от API"""
     order_id: int = Field(alias='orderId')
     file: str
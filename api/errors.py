@@ -1,7 +1,17 @@
+import datetime
+import random
+import threading
 import time
+from email.utils import parsedate_to_datetime
+from functools import partial, wraps
 
-from requests import Response
-from requests.exceptions import ChunkedEncodingError
+from requests import Response, HTTPError
+from requests.exceptions import ChunkedEncodingError, ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+
+from config import WB_RETRY_ATTEMPTS, WB_RETRY_BASE_DELAY, WB_RETRY_MAX_DELAY
+from metrics import registry, CallbackMetric
+from .parsing import decode_response
 
 
 class WBAPIError(Exception):
@@ -16,34 +26,113 @@ class WBAPIError(Exception):
         return f'{self.code}: {self.message}' if self.code else self.message
 
 
-def check_response(response: Response):
-    """Функция для проверки запроса к API
+def check_response(response: Response) -> dict:
+    """Функция для проверки запроса к API. Тело ответа декодируется один раз
     @param response: Response от API
+    @return: тело ответа в виде словаря
     @raise: HTTPError, WBAPIError
     """
     response.raise_for_status()
-    response_json = response.json()
-    if response_json.keys() == ('code', 'message'):
+    response_json = decode_response(response)
+    if response_json.keys() == {'code', 'message'}:
         raise WBAPIError(
             code=response_json['code'],
             message=response_json['message'])
     if response_json.get('error'):
         raise WBAPIError(
             message=f'{response_json["errorText"]}: {response_json["additionalErrors"]}')
+    return response_json
+
+
+def get_retry_after(response: Response) -> float | None:
+    """Достаёт из ответа API время, через которое можно повторить запрос
+    @param response: Response от API
+    @return: Время в секундах или None, если заголовка Retry-After нет
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+
+_retry_stats = {'retries': 0, 'backoff_time': 0.0, 'exhausted': 0}
+_retry_stats_lock = threading.Lock()
+
+
+def _count_retry(delay: float = None, exhausted: bool = False):
+    with _retry_stats_lock:
+        if exhausted:
+            _retry_stats['exhausted'] += 1
+        else:
+            _retry_stats['retries'] += 1
+            _retry_stats['backoff_time'] += delay
 
 
-def retry_on_network_error(func):
-    """Декоратор повторяет запрос к серверу, если произошла ошибка соединения."""
+def get_retry_stats() -> dict:
+    """Возвращает статистику повторов запросов к API"""
+    with _retry_stats_lock:
+        return dict(_retry_stats)
+
+
+registry.register(CallbackMetric(
+    'wb_retries_total', 'Повторы запросов к API Wildberries',
+    lambda: get_retry_stats()['retries'], type='counter'))
+registry.register(CallbackMetric(
+    'wb_retries_exhausted_total', 'Запросы к API Wildberries, исчерпавшие попытки',
+    lambda: get_retry_stats()['exhausted'], type='counter'))
+
+
+def is_request_not_sent(ex: Exception) -> bool:
+    """Проверяет, что запрос не дошёл до сервера: соединение не удалось установить"""
+    if isinstance(ex, ConnectTimeout):
+        return True
+    reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_on_network_error(func=None, *, idempotent: bool = True):
+    """Декоратор повторяет запрос к серверу, если произошла ошибка соединения
+    или сервер ответил 429 Too Many Requests.
+    Паузы между попытками растут экспоненциально со случайным разбросом,
+    заголовок Retry-After имеет приоритет. Число попыток ограничено WB_RETRY_ATTEMPTS.
+    Используется как @retry_on_network_error или @retry_on_network_error(idempotent=False)
+    @param idempotent: False для запросов, которые меняют данные: после таймаута чтения
+    сервер мог уже выполнить запрос, поэтому повторяется только запрос, который не был отправлен
+    @raise: HTTPError, WBAPIError
+    """
+    if func is None:
+        return partial(retry_on_network_error, idempotent=idempotent)
 
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        delay = 0
-        while True:
-            delay = min(delay, 30)
+        for attempt in range(WB_RETRY_ATTEMPTS):
             try:
                 return func(*args, **kwargs)
-            except (ChunkedEncodingError, ConnectionError):
-                time.sleep(delay)
-                delay += 5
-                continue
+            except HTTPError as ex:
+                if ex.response is None or ex.response.status_code != 429:
+                    raise
+                if attempt == WB_RETRY_ATTEMPTS - 1:
+                    _count_retry(exhausted=True)
+                    raise
+                retry_after = get_retry_after(ex.response)
+            except (ChunkedEncodingError, ConnectionError, Timeout) as ex:
+                if not idempotent and not is_request_not_sent(ex):
+                    raise WBAPIError(message=f'Нет ответа сервера, запрос мог быть выполнен: {ex}') from ex
+                if attempt == WB_RETRY_ATTEMPTS - 1:
+                    _count_retry(exhausted=True)
+                    raise WBAPIError(message=f'Сервер недоступен: {ex}') from ex
+                retry_after = None
+            backoff = random.uniform(0, min(WB_RETRY_MAX_DELAY, WB_RETRY_BASE_DELAY * 2 ** attempt))
+            delay = max(backoff, retry_after or 0)
+            _count_retry(delay)
+            time.sleep(delay)
 
     return wrapper
@@ -0,0 +1,167 @@
+import threading
+import time
+from functools import wraps
+
+from requests import HTTPError
+
+from config import WB_RATE_LIMITS
+from metrics import registry, CallbackMetric
+from .accounts import get_current_account
+from .errors import get_retry_after
+
+
+class TokenBucket:
+    """Потокобезопасный ограничитель частоты по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        @param rate: Количество токенов, восстанавливаемых за секунду
+        @param capacity: Максимальное количество накопленных токенов (размер пачки)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """Забирает токен, при необходимости дожидаясь его появления
+        @return: Время ожидания в секундах
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(
+                    self._blocked_until - now,
+                    (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def block_for(self, seconds: float):
+        """Запрещает выдачу токенов на указанное время (например, по Retry-After)
+        @param seconds: Время блокировки в секундах
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class RateLimiter:
+    """Набор ограничителей частоты запросов по группам эндпоинтов со статистикой"""
+
+    def __init__(self, limits: dict[str, tuple[float, int]]):
+        """
+        @param limits: словарь {группа: (запросов в секунду, размер пачки)}
+        """
+        self._buckets = {
+            group: TokenBucket(rate, burst)
+            for group, (rate, burst) in limits.items()}
+        self._stats = {
+            group: {'requests': 0, 'throttled': 0, 'wait_time': 0.0, 'too_many_requests': 0}
+            for group in limits}
+        self._lock = threading.Lock()
+
+    def acquire(self, group: str):
+        """Дожидается разрешения на запрос к группе эндпоинтов
+        @param group: Группа эндпоинтов
+        """
+        waited = self._buckets[group].acquire()
+        with self._lock:
+            stats = self._stats[group]
+            stats['requests'] += 1
+            if waited:
+                stats['throttled'] += 1
+                stats['wait_time'] += waited
+
+    def report_too_many_requests(self, group: str, retry_after: float | None):
+        """Учитывает ответ 429 и приостанавливает запросы к группе
+        @param group: Группа эндпоинтов
+        @param retry_after: Значение заголовка Retry-After в секундах
+        """
+        bucket = self._buckets[group]
+        bucket.block_for(retry_after or 1 / bucket.rate)
+        with self._lock:
+            self._stats[group]['too_many_requests'] += 1
+
+    def get_stats(self) -> dict[str, dict]:
+        """Возвращает статистику ограничения запросов
+        @return: словарь {группа: {показатель: значение}}
+        """
+        with self._lock:
+            return {group: dict(stats) for group, stats in self._stats.items()}
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(account: str = None) -> RateLimiter:
+    """Возвращает ограничитель аккаунта. У каждого аккаунта свои лимиты WB_RATE_LIMITS
+    @param account: Имя аккаунта, по умолчанию - текущий аккаунт
+    """
+    account = account or get_current_account()
+    with _limiters_lock:
+        if (limiter := _limiters.get(account)) is None:
+            limiter = _limiters[account] = RateLimiter(WB_RATE_LIMITS)
+        return limiter
+
+
+for _stat, _description in [
+    ('requests', 'Запросы к API Wildberries, прошедшие через ограничитель'),
+    ('throttled', 'Запросы к API Wildberries, которым пришлось ждать ограничителя'),
+    ('wait_time', 'Суммарное время ожидания ограничителя в секундах'),
+    ('too_many_requests', 'Ответы 429 от API Wildberries')]:
+    registry.register(CallbackMetric(
+        f'wb_rate_limit_{_stat}_total',
+        _description,
+        lambda stat=_stat: {group: stats[stat] for group, stats in get_rate_limit_stats().items()},
+        label_name='group',
+        type='counter'))
+
+
+def rate_limited(group: str):
+    """Декоратор ограничивает частоту запросов к группе эндпоинтов API.
+    Ответ 429 приостанавливает всю группу на время из Retry-After.
+    Лимиты считаются отдельно для каждого аккаунта
+    @param group: Группа эндпоинтов из настройки WB_RATE_LIMITS
+    """
+
+    def rate_limited_decorator(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limiter = get_limiter()
+            limiter.acquire(group)
+            try:
+                return func(*args, **kwargs)
+            except HTTPError as ex:
+                if ex.response is not None and ex.response.status_code == 429:
+                    limiter.report_too_many_requests(group, get_retry_after(ex.response))
+                raise
+
+        return wrapper
+
+    return rate_limited_decorator
+
+
+def get_rate_limit_stats() -> dict[str, dict]:
+    """Возвращает статистику ограничения запросов к API по аккаунтам и группам эндпоинтов
+    @return: словарь {'аккаунт/группа': {показатель: значение}}
+    """
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {
+        f'{account}/{group}': stats
+        for account, limiter in limiters.items()
+        for group, stats in limiter.get_stats().items()}
@@ -1,3 +1,9 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import HTTPError
+
+from config import WB_BULK_WORKERS
 from .classes import Supply, Order, Product, Sticker, SupplySticker
 from .requests import get_product_response, get_new_orders_response, new_supply_response, delete_supply_response, \
     add_orders_to_supply_request
@@ -6,6 +12,9 @@ from .requests import get_orders_response
 from .requests import get_sticker_response
 from .requests import get_supplies_response
 from .requests import send_deliver_request
+from .errors import WBAPIError
+
+SUPPLIES_PAGE_LIMIT = 1000
 
 
 def get_orders(supply_id: str) -> list[Order]:
@@ -18,7 +27,7 @@ def get_orders(supply_id: str) -> list[Order]:
     """
     response = get_orders_response(
         supply_id=supply_id)
-    return [Order.parse_obj(order) for order in response.json()['orders']]
+    return Order.parse_list(response['orders'])
 
 
 def get_product(article: str) -> Product:
@@ -29,45 +38,36 @@ def get_product(article: str) -> Product:
     @raise: HTTPError, WBAPIError
     """
     response = get_product_response(article)
-    for product_card in response.json()["data"]:
+    for product_card in response["data"]:
         if product_card["vendorCode"] == article:
             return Product.parse_from_card(product_card)
     return Product(article=article)
 
 
-def get_supplies(
-        only_active: bool = True,
-        limit: int = 50) -> list[Supply]:
+def get_supplies_page(next_cursor: int = 0) -> tuple[list[Supply], int]:
     """
-    Получает и парсит информацию о поставках с Wildberries
-    @param only_active: Если True то возвращает только незакрытые поставки,
-    в противном случае - все
-    @param limit: Максимальное число возвращаемых поставок
+    Получает и парсит одну страницу списка поставок с Wildberries.
+    Поставки на странице идут от старых к новым
+    @param next_cursor: значение next, с которого начинается страница (0 - первая страница)
     @return: список поставок, представленных как результаты парсинга
-    запросов к API
+    запросов к API, и значение next для следующей страницы
     @raise: HTTPError, WBAPIError
     """
-    response = get_supplies_response()
-    supplies = []
-    for supply in response.json()["supplies"][::-1]:
-        if not supply['done'] or only_active is False:
-            supply = Supply.parse_obj(supply)
-            supplies.append(supply)
-        if len(supplies) == limit:
-            break
-    return supplies
+    response = get_supplies_response(next_cursor, SUPPLIES_PAGE_LIMIT)
+    return Supply.parse_list(response['supplies']), response['next']
 
 
-def get_stickers(order_ids: list[int]) -> list[Sticker]:
+def get_stickers(order_ids: list[int], sticker_type: str = 'png') -> list[Sticker]:
     """
     Получает и парсит информацию о стикерах с Wildberries
     @param order_ids: Список id заказов
+    @param sticker_type: Формат стикеров: png, svg, zplv или zplh
     @return: список стикеров, представленных как результаты парсинга
     запросов к API
     @raise: HTTPError, WBAPIError
     """
-    stickers_response = get_sticker_response(order_ids)
-    return [Sticker.parse_obj(sticker) for sticker in stickers_response.json()['stickers']]
+    stickers_response = get_sticker_response(order_ids, sticker_type)
+    return Sticker.parse_list(stickers_response['stickers'])
 
 
 def send_supply_to_deliver(supply_id: str) -> int:
@@ -88,7 +88,7 @@ def get_supply_sticker(supply_id: str) -> SupplySticker:
     @raise: HTTPError, WBAPIError
     """
     response = get_supply_sticker_response(supply_id)
-    return SupplySticker.parse_obj(response.json())
+    return SupplySticker.parse_obj(response)
 
 
 def get_new_orders() -> list[Order]:
@@ -99,7 +99,7 @@ def get_new_orders() -> list[Order]:
     @raise: HTTPError, WBAPIError
     """
     response = get_new_orders_response()
-    return [Order.parse_obj(order) for order in response.json()['orders']]
+    return Order.parse_list(response['orders'])
 
 
 def add_order_to_supply(supply_id: str, order_id: int | str) -> int:
@@ -114,6 +114,41 @@ def add_order_to_supply(supply_id: str, order_id: int | str) -> int:
     return response.status_code
 
 
+def add_orders_to_supply(
+        supply_id: str,
+        order_ids: list[int | str],
+        workers: int = WB_BULK_WORKERS
+) -> tuple[list[int | str], dict[int | str, Exception]]:
+    """
+    Добавляет несколько заказов к поставке, отправляя до workers запросов одновременно.
+    Частота запросов ограничивается лимитами группы supplies текущего аккаунта.
+    Ошибка одного заказа не прерывает перенос остальных
+    @param supply_id: id поставки
+    @param order_ids: id заказов
+    @param workers: Количество одновременных запросов
+    @return: id добавленных заказов и ошибки по id не добавленных заказов
+    """
+
+    def add_order(order_id: int | str) -> Exception | None:
+        try:
+            add_orders_to_supply_request(supply_id, order_id)
+        except (HTTPError, WBAPIError) as ex:
+            return ex
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='AddOrders') as executor:
+        # Каждый запрос выполняется в копии контекста, чтобы в потоке пула действовал аккаунт вызывающего
+        futures = [
+            executor.submit(contextvars.copy_context().run, add_order, order_id)
+            for order_id in order_ids]
+    added, errors = [], {}
+    for order_id, future in zip(order_ids, futures):
+        if (error := future.result()) is None:
+            added.append(order_id)
+        else:
+            errors[order_id] = error
+    return added, errors
+
+
 def create_new_supply(supply_name: str) -> str:
     """
     Добавляет заказ к поставке.
@@ -122,7 +157,7 @@ def create_new_supply(supply_name: str) -> str:
     @raise: HTTPError, WBAPIError
     """
     response = new_supply_response(supply_name)
-    return response.json()['id']
+    return response['id']
 
 
 def delete_supply_by_id(supply_id: str) -> int:
@@ -0,0 +1,38 @@
+import datetime
+import json
+
+from pydantic.datetime_parse import parse_datetime as pydantic_parse_datetime
+from requests import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes | str):
+    """Декодирует JSON. Использует orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_response(response: Response):
+    """Декодирует тело ответа API
+    @param response: Response от API
+    @return: тело ответа в виде словаря или списка
+    @raise: ValueError, если тело ответа не является JSON
+    """
+    return loads(response.content)
+
+
+def parse_datetime(value: str | datetime.datetime | None) -> datetime.datetime | None:
+    """Быстрый разбор даты из ответа API (формат ISO 8601, например '2022-05-04T07:56:29Z').
+    Для нестандартных форматов используется разбор pydantic
+    """
+    if not value or isinstance(value, datetime.datetime):
+        return value or None
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return pydantic_parse_datetime(value)
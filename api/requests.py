@@ -1,94 +1,181 @@
 import os
+import threading
 
 import requests
 from dotenv import load_dotenv
 from requests import Response
+from requests.adapters import HTTPAdapter
 
+from config import WB_API_URL, WB_API_TIMEOUT, WB_API_POOL_SIZE
+from config import WB_CASSETTE_MODE, WB_CASSETTE_PATH, WB_CASSETTE_TIME_SCALE
+from .accounts import DEFAULT_ACCOUNT, get_accounts, get_current_account
+from .cassette import Cassette
 from .errors import retry_on_network_error, check_response, WBAPIError
+from .limiter import rate_limited
+from metrics import track_wb_request
 
 load_dotenv()
-_headers = {'Authorization': os.environ['WB_API_KEY']}
 
 
-@retry_on_network_error
-def get_supplies_response() -> Response:
+class WBClient:
+    """Клиент API одного аккаунта продавца: пул соединений с ключом аккаунта
+    и кассета, если задан WB_CASSETTE_MODE"""
+
+    def __init__(self, account: str, api_key: str):
+        """
+        @param account: Имя аккаунта
+        @param api_key: API ключ аккаунта
+        """
+        self.account = account
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=WB_API_POOL_SIZE, pool_maxsize=WB_API_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Authorization'] = api_key
+        self.cassette = Cassette(
+            _get_cassette_path(account),
+            WB_CASSETTE_MODE,
+            WB_CASSETTE_TIME_SCALE,
+            api_key=api_key) if WB_CASSETTE_MODE else None
+
+    def send(self, method: str, path: str, **kwargs) -> Response:
+        """
+        Отправляет запрос к API Wildberries по адресу WB_API_URL.
+        Если задан WB_CASSETTE_MODE, запрос записывается в кассету или ответ берётся из неё
+        @param method: HTTP метод
+        @param path: путь запроса, например '/api/v3/orders/new'
+        @param kwargs: параметры requests.request (params, json и т.д.)
+        @return: Response от API
+        """
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self.cassette.replay(method, path, kwargs.get('params'), kwargs.get('json'))
+        response = self.session.request(
+            method,
+            f'{WB_API_URL}{path}',
+            timeout=WB_API_TIMEOUT,
+            **kwargs)
+        if self.cassette is not None:
+            self.cassette.record(method, path, response, kwargs.get('params'), kwargs.get('json'))
+        return response
+
+
+def _get_cassette_path(account: str) -> str:
+    """Кассета аккаунта default - WB_CASSETTE_PATH, остальных - с именем аккаунта в начале имени файла"""
+    if account == DEFAULT_ACCOUNT:
+        return WB_CASSETTE_PATH
+    directory, file_name = os.path.split(WB_CASSETTE_PATH)
+    return os.path.join(directory, f'{account}-{file_name}')
+
+
+_clients: dict[str, WBClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(account: str = None) -> WBClient:
+    """Возвращает клиент аккаунта, создавая его при первом обращении
+    @param account: Имя аккаунта, по умолчанию - текущий аккаунт
     """
-    Отправляет запрос к API. Получает список поставок.
+    account = account or get_current_account()
+    with _clients_lock:
+        if (client := _clients.get(account)) is None:
+            client = _clients[account] = WBClient(account, get_accounts()[account])
+        return client
+
+
+def _send_request(method: str, path: str, **kwargs) -> Response:
+    """
+    Отправляет запрос к API Wildberries от имени текущего аккаунта
+    @param method: HTTP метод
+    @param path: путь запроса, например '/api/v3/orders/new'
+    @param kwargs: параметры requests.request (params, json и т.д.)
     @return: Response от API
+    """
+    return get_client().send(method, path, **kwargs)
+
+
+@track_wb_request
+@retry_on_network_error
+@rate_limited('supplies')
+def get_supplies_response(next_cursor: int = 0, limit: int = 1000) -> dict:
+    """
+    Отправляет запрос к API. Получает одну страницу списка поставок.
+    Поставки в списке идут от старых к новым
+    @param next_cursor: значение next, с которого начинается страница (0 - первая страница)
+    @param limit: размер страницы (максимум 1000)
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
     params = {
-        'limit': 1000,
-        'next': 0}
-    # Находим последнюю страницу с поставками
-    while True:
-        response = requests.get(
-            'https://suppliers-api.wildberries.ru/api/v3/supplies',
-            headers=_headers,
-            params=params)
-        check_response(response)
-        if response.json()['supplies'] == params['limit']:
-            params['next'] = response.json()['next']
-            continue
-        else:
-            return response
+        'limit': limit,
+        'next': next_cursor}
+    response = _send_request(
+        'GET',
+        '/api/v3/supplies',
+        params=params)
+    return check_response(response)
 
 
+@track_wb_request
 @retry_on_network_error
-def get_orders_response(supply_id: str) -> Response:
+@rate_limited('orders')
+def get_orders_response(supply_id: str) -> dict:
     """
     Отправляет запрос к API. Получает список заказов по данной поставке.
     @param supply_id: id поставки, по которой требуется получить заказы
-    @return: Response от API
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
-    response = requests.get(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies/{supply_id}/orders',
-        headers=_headers)
-    check_response(response)
-    return response
+    response = _send_request(
+        'GET',
+        f'/api/v3/supplies/{supply_id}/orders')
+    return check_response(response)
 
 
+@track_wb_request
 @retry_on_network_error
-def get_product_response(article: str) -> Response:
+@rate_limited('content')
+def get_product_response(article: str) -> dict:
     """
     Отправляет запрос к API. Получает описание товара по артикулу.
     @param article: артикул товара
-    @return: Response от API
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
     request_json = {'vendorCodes': [article]}
-    response = requests.post(
-        'https://suppliers-api.wildberries.ru/content/v1/cards/filter',
-        json=request_json,
-        headers=_headers)
-    check_response(response)
-    return response
+    response = _send_request(
+        'POST',
+        '/content/v1/cards/filter',
+        json=request_json)
+    return check_response(response)
 
 
+@track_wb_request
 @retry_on_network_error
-def get_sticker_response(order_ids: list[int]) -> Response:
+@rate_limited('stickers')
+def get_sticker_response(order_ids: list[int], sticker_type: str = 'png') -> dict:
     """
     Отправляет запрос к API. Получает стикеры по списку заказов
     @param order_ids: Список id заказов
-    @return: Response от API
+    @param sticker_type: Формат стикеров: png, svg, zplv или zplh
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
     json_ = {'orders': order_ids}
     params = {
-        'type': 'png',
+        'type': sticker_type,
         'width': 58,
         'height': 40}
-    response = requests.post(
-        'https://suppliers-api.wildberries.ru/api/v3/orders/stickers',
-        headers=_headers,
+    response = _send_request(
+        'POST',
+        '/api/v3/orders/stickers',
         json=json_,
         params=params)
-    check_response(response)
-    return response
+    return check_response(response)
 
 
-@retry_on_network_error
+@track_wb_request
+@retry_on_network_error(idempotent=False)
+@rate_limited('supplies')
 def send_deliver_request(supply_id: str) -> int:
     """
     Отправляет запрос на отправку поставки в доставку.
@@ -96,75 +183,80 @@ def send_deliver_request(supply_id: str) -> int:
     @return: статус код запроса
     @raise: HTTPError, WBAPIError
     """
-    response = requests.patch(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies/{supply_id}/deliver',
-        headers=_headers)
+    response = _send_request(
+        'PATCH',
+        f'/api/v3/supplies/{supply_id}/deliver')
     response.raise_for_status()
     return response.status_code
 
 
+@track_wb_request
 @retry_on_network_error
-def get_supply_sticker_response(supply_id: str) -> Response:
+@rate_limited('stickers')
+def get_supply_sticker_response(supply_id: str) -> dict:
     """
     Получает QR-code поставки, которая уже находится в доставке
     @param supply_id: id поставки
-    @return: Response от API
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
     params = {
         'type': 'png',
         'width': 58,
         'height': 40}
-    response = requests.get(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies/{supply_id}/barcode',
-        headers=_headers,
+    response = _send_request(
+        'GET',
+        f'/api/v3/supplies/{supply_id}/barcode',
         params=params)
-    check_response(response)
-    return response
+    return check_response(response)
 
 
+@track_wb_request
 @retry_on_network_error
-def get_new_orders_response() -> Response:
+@rate_limited('orders')
+def get_new_orders_response() -> dict:
     """
     Отправляет запрос к API. Получает список новых заказов.
-    @return: Response от API
+    @return: Тело ответа API в виде словаря
     @raise: HTTPError, WBAPIError
     """
-    response = requests.get(
-        f'https://suppliers-api.wildberries.ru/api/v3/orders/new',
-        headers=_headers)
-    check_response(response)
-    return response
+    response = _send_request(
+        'GET',
+        '/api/v3/orders/new')
+    return check_response(response)
 
 
-@retry_on_network_error
+@track_wb_request
+@retry_on_network_error(idempotent=False)
+@rate_limited('supplies')
 def add_orders_to_supply_request(supply_id: str, order_id: int | str) -> Response:
-    response = requests.patch(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies/{supply_id}/orders/{order_id}',
-        headers=_headers)
-    if status_code := response.status_code != 204:
-        raise (WBAPIError(f'Статус запроса: {status_code}'))
+    response = _send_request(
+        'PATCH',
+        f'/api/v3/supplies/{supply_id}/orders/{order_id}')
     response.raise_for_status()
+    if (status_code := response.status_code) != 204:
+        raise WBAPIError(f'Статус запроса: {status_code}')
     return response
 
 
-@retry_on_network_error
-def new_supply_response(name: str) -> Response:
+@track_wb_request
+@retry_on_network_error(idempotent=False)
+@rate_limited('supplies')
+def new_supply_response(name: str) -> dict:
     json_ = {'name': name}
-    response = requests.post(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies',
-        headers=_headers,
-        json=json_
-    )
-    check_response(response)
-    return response
+    response = _send_request(
+        'POST',
+        '/api/v3/supplies',
+        json=json_)
+    return check_response(response)
 
 
+@track_wb_request
 @retry_on_network_error
+@rate_limited('supplies')
 def delete_supply_response(supply_id: str) -> Response:
-    response = requests.delete(
-        f'https://suppliers-api.wildberries.ru/api/v3/supplies/{supply_id}',
-        headers=_headers
-    )
+    response = _send_request(
+        'DELETE',
+        f'/api/v3/supplies/{supply_id}')
     response.raise_for_status()
     return response
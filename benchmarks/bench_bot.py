@@ -0,0 +1,414 @@
+"""Нагрузочный тест бота: синтетические обновления Telegram проходят через обработчики bot.py.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_bot --concurrency 1,4,8,16 --updates 200 --wb-latency 150
+    python -m benchmarks.bench_bot --mix menu=1,stickers=1 --compare benchmarks/results/bot-<коммит>.json
+
+Обновления (кнопки меню, открытие поставок, запросы стикеров) передаются в
+TeleBot.process_new_updates, ответы Telegram подменяются через apihelper.CUSTOM_REQUEST_SENDER,
+а запросы к API WB уходят в локальный симулятор (benchmarks.wb_simulator).
+Уровень параллельности соответствует размеру пула обработчиков бота.
+Для каждого уровня выводятся пропускная способность и перцентили времени обработки обновления.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from requests import Response
+from telebot import ExceptionHandler
+
+from benchmarks.common import get_commit, init_bench_db, RESULTS_DIR
+
+FIRST_USER_ID = 1000
+OWNER_ID = 999
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Бот'}
+DEFAULT_MIX = 'menu=4,supplies=2,new_orders=2,open_supply=3,stickers=1'
+
+
+def percentile(values: list[float], quantile: float) -> float:
+    """Перцентиль по ближайшему рангу
+    @param values: Отсортированные значения
+    @param quantile: Доля от 0 до 1
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(quantile * len(values) + 0.5) - 1))]
+
+
+def parse_mix(raw_mix: str) -> dict[str, float]:
+    """Разбирает строку вида 'сценарий=вес,...'"""
+    mix = {}
+    for item in filter(None, raw_mix.replace(' ', '').split(',')):
+        scenario, _, weight = item.partition('=')
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Неизвестный сценарий {scenario}, доступны: {", ".join(SCENARIOS)}')
+        mix[scenario] = float(weight or 1)
+    return mix
+
+
+class FakeTelegramAPI:
+    """Подменяет Bot API: отвечает успехом на любой метод с заданной задержкой и считает вызовы"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __call__(self, method: str, url: str, params: dict = None, files: dict = None, **kwargs) -> Response:
+        api_method = url.rsplit('/', 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[api_method] += 1
+            message_id = next(self._message_ids)
+        if api_method == 'answerCallbackQuery':
+            result = True
+        else:
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int((params or {}).get('chat_id', 0)), 'type': 'private'},
+                'from': BOT_USER}
+            # Документы и фото возвращаются с file_id, как у настоящего Bot API
+            if api_method == 'sendDocument':
+                result['document'] = {'file_id': f'document{message_id}', 'file_unique_id': f'd{message_id}'}
+            elif api_method == 'sendPhoto':
+                result['photo'] = [
+                    {'file_id': f'photo{message_id}', 'file_unique_id': f'p{message_id}', 'width': 90, 'height': 90}]
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps({'ok': True, 'result': result}).encode()
+        return response
+
+
+class ErrorRecorder(ExceptionHandler):
+    """Запоминает ошибку обработчика в потоке, который обрабатывал обновление.
+    Бот перехватывает ошибки обработчиков сам, поэтому они не доходят до бенчмарка"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def handle(self, exception):
+        self._local.error = exception
+        return True
+
+    def pop(self) -> Exception | None:
+        """Возвращает и сбрасывает ошибку последнего обновления текущего потока"""
+        error = getattr(self._local, 'error', None)
+        self._local.error = None
+        return error
+
+
+class UpdateFactory:
+    """Генерирует обновления Telegram от зарегистрированных пользователей"""
+
+    def __init__(self, users_count: int, supply_ids: list[str], seed: int = 0):
+        self.user_ids = [FIRST_USER_ID + number for number in range(users_count)]
+        self.supply_ids = supply_ids
+        self._rnd = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _next_ids(self) -> tuple[int, int]:
+        with self._lock:
+            return next(self._update_ids), self._rnd.choice(self.user_ids)
+
+    def choice(self, items: list):
+        with self._lock:
+            return self._rnd.choice(items)
+
+    def message(self, text: str) -> dict:
+        update_id, user_id = self._next_ids()
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Пользователь {user_id}'},
+            'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, data: str) -> dict:
+        update_id, user_id = self._next_ids()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(user_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Пользователь {user_id}'},
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'Текущие незакрытые поставки'}}}
+
+
+def _menu(factory: UpdateFactory, router) -> dict:
+    return factory.message(factory.choice(['/start', 'Основное меню']))
+
+
+def _supplies(factory: UpdateFactory, router) -> dict:
+    return factory.message('Показать поставки')
+
+
+def _new_orders(factory: UpdateFactory, router) -> dict:
+    return factory.message('Новые заказы')
+
+
+def _open_supply(factory: UpdateFactory, router) -> dict:
+    return factory.callback(router.callback_data('s', factory.choice(factory.supply_ids)))
+
+
+def _stickers(factory: UpdateFactory, router) -> dict:
+    return factory.callback(router.callback_data('st', factory.choice(factory.supply_ids)))
+
+
+def _orders_page(factory: UpdateFactory, router) -> dict:
+    # Список новых заказов сохраняется в курсоре так же, как при показе, и листается на вторую страницу
+    from api.classes import Order
+    from utils import create_orders_markup
+
+    orders = [
+        Order.construct(order_id=number, article=f'ART-{number % 7:05d}', created_at=datetime.datetime.now())
+        for number in range(45)]
+    # Последняя кнопка "Перенести все в поставку" несёт ключ курсора списка
+    _, (cursor_id,) = router.parse(create_orders_markup(orders).keyboard[-1][0].callback_data)
+    return factory.callback(router.callback_data('pg', cursor_id, '1'))
+
+
+# Сценарий: функция, создающая обновление
+SCENARIOS = {
+    'menu': _menu,
+    'supplies': _supplies,
+    'new_orders': _new_orders,
+    'open_supply': _open_supply,
+    'stickers': _stickers,
+    'orders_page': _orders_page,
+}
+
+
+def run_level(bot, router, factory: UpdateFactory, mix: dict[str, float], concurrency: int, updates_count: int,
+              seed: int, error_recorder: ErrorRecorder) -> dict:
+    """Прогоняет updates_count обновлений через бота в concurrency потоков
+    @return: замеры уровня
+    """
+    from telebot.types import Update
+
+    rnd = random.Random(seed)
+    scenarios = rnd.choices(list(mix), weights=list(mix.values()), k=updates_count)
+    tasks = queue.SimpleQueue()
+    for scenario in scenarios:
+        tasks.put((scenario, Update.de_json(SCENARIOS[scenario](factory, router))))
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                scenario, update = tasks.get_nowait()
+            except queue.Empty:
+                return
+            started_at = time.perf_counter()
+            try:
+                bot.process_new_updates([update])
+                failed = error_recorder.pop() is not None
+            except Exception:
+                failed = True
+            if failed:
+                with lock:
+                    errors[scenario] += 1
+            duration = time.perf_counter() - started_at
+            with lock:
+                latencies[scenario].append(duration)
+
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=work, name=f'BenchWorker-{number}') for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started_at
+
+    def summarize(values: list[float], errors_count: int) -> dict:
+        values = sorted(values)
+        return {
+            'updates': len(values),
+            'errors': errors_count,
+            'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 1)}
+
+    return {
+        'concurrency': concurrency,
+        'wall_time_s': round(wall_time, 3),
+        'throughput': round(updates_count / wall_time, 2),
+        **summarize(list(itertools.chain.from_iterable(latencies.values())), sum(errors.values())),
+        'scenarios': {scenario: summarize(values, errors[scenario]) for scenario, values in sorted(latencies.items())},
+    }
+
+
+def wait_for_outbox(outbox, timeout: float) -> float:
+    """Ждёт, пока очередь исходящих сообщений опустеет
+    @return: время ожидания в секундах
+    """
+    started_at = time.perf_counter()
+    while outbox.get_depth() and time.perf_counter() - started_at < timeout:
+        time.sleep(0.05)
+    return round(time.perf_counter() - started_at, 3)
+
+
+def print_results(results: list[dict], baseline: list[dict] = None):
+    baseline = {level['concurrency']: level for level in baseline or []}
+    print(f'{"потоков":>8} | {"обн./с":>8} | {"p50, мс":>8} | {"p95, мс":>8} | {"p99, мс":>8} | {"ошибок":>6}')
+    for level in results:
+        line = f'{level["concurrency"]:>8} | {level["throughput"]:>8.1f} | {level["p50_ms"]:>8.1f} | ' \
+               f'{level["p95_ms"]:>8.1f} | {level["p99_ms"]:>8.1f} | {level["errors"]:>6}'
+        if (old_level := baseline.get(level['concurrency'])) and old_level['throughput']:
+            line += f' | {level["throughput"] / old_level["throughput"] - 1:+.0%} к пропускной способности'
+        print(line)
+
+    print('\nПо сценариям (p95, мс / ошибок):')
+    scenarios = sorted({scenario for level in results for scenario in level['scenarios']})
+    print(f'{"потоков":>8} | ' + ' | '.join(f'{scenario:>14}' for scenario in scenarios))
+    for level in results:
+        cells = []
+        for scenario in scenarios:
+            stats = level['scenarios'].get(scenario)
+            cells.append(f'{stats["p95_ms"]:>9.1f} / {stats["errors"]:<2}' if stats else f'{"-":>14}')
+        print(f'{level["concurrency"]:>8} | ' + ' | '.join(cells))
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,4,8,16', help='уровни параллельности через запятую')
+    parser.add_argument('--updates', type=int, default=200, help='количество обновлений на каждом уровне')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f'веса сценариев ({DEFAULT_MIX}), доступны: {", ".join(SCENARIOS)}')
+    parser.add_argument('--users', type=int, default=20, help='количество пользователей бота')
+    parser.add_argument('--supplies', type=int, default=3000, help='количество поставок в симуляторе')
+    parser.add_argument('--active-supplies', type=int, default=10, help='количество незакрытых поставок')
+    parser.add_argument('--orders-per-supply', type=int, default=20, help='количество заказов в поставке')
+    parser.add_argument('--new-orders', type=int, default=100, help='количество новых заказов')
+    parser.add_argument('--wb-latency', type=float, default=100, help='задержка ответа симулятора WB в миллисекундах')
+    parser.add_argument('--wb-error-rate', type=float, default=0, help='доля ответов 500 симулятора WB')
+    parser.add_argument('--tg-latency', type=float, default=30, help='задержка ответа Bot API в миллисекундах')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора данных')
+    parser.add_argument('--output', help='файл для сохранения результатов (по умолчанию benchmarks/results/bot-<коммит>.json)')
+    parser.add_argument('--compare', help='файл с результатами другого запуска для сравнения')
+    parser.add_argument('--database-url', help='адрес отдельной БД для бенчмарка, например '
+                                               'postgresql+pool://postgres@localhost/bench (по умолчанию SQLite)')
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    # Настройки бота читаются при импорте, поэтому модули бота импортируются после заполнения окружения
+    simulator_port = _get_free_port()
+    os.environ['WB_API_URL'] = f'http://127.0.0.1:{simulator_port}'
+    os.environ.setdefault('WB_API_KEY', 'bench')
+    os.environ.setdefault('TG_BOT_TOKEN', '1:bench')
+    os.environ['OWNER_ID'] = str(OWNER_ID)
+    os.environ['OWNER_FULL_NAME'] = 'Бенчмарк'
+    os.environ['NEW_ORDERS_POLL_INTERVAL'] = '0'
+
+    from telebot import apihelper
+    from benchmarks.wb_simulator import WBDataset, WBSimulator, start_simulator
+
+    dataset = WBDataset(
+        supplies_count=args.supplies,
+        active_supplies=args.active_supplies,
+        orders_per_supply=args.orders_per_supply,
+        new_orders_count=args.new_orders,
+        seed=args.seed)
+    simulator = WBSimulator(
+        dataset,
+        latency=args.wb_latency / 1000,
+        jitter=args.wb_latency / 4000,
+        error_rate=args.wb_error_rate,
+        seed=args.seed)
+    server = start_simulator(simulator, port=simulator_port)
+    telegram_api = FakeTelegramAPI(args.tg_latency / 1000)
+    apihelper.CUSTOM_REQUEST_SENDER = telegram_api
+
+    work_dir = tempfile.mkdtemp(prefix='wb-bench-bot-')
+    current_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        from models import db
+        init_bench_db(work_dir, args.database_url)
+
+        import bot as bot_module
+        from db_client import prepare_db, insert_user
+
+        prepare_db(owner_id=OWNER_ID, owner_full_name='Бенчмарк')
+        factory = UpdateFactory(args.users, [supply['id'] for supply in dataset.supplies[-args.active_supplies:]], args.seed)
+        for user_id in factory.user_ids:
+            insert_user(user_id, f'Пользователь {user_id}')
+        bot = bot_module.bot
+        bot.threaded = False
+        error_recorder = ErrorRecorder()
+        bot.exception_handler = error_recorder
+        bot_module.outbox.start()
+
+        # Прогрев: загружаются страницы поставок и заказы всех незакрытых поставок
+        warmup = [factory.message('Показать поставки')] + [
+            factory.callback(bot_module.router.callback_data('s', supply_id)) for supply_id in factory.supply_ids]
+        from telebot.types import Update
+        bot.process_new_updates([Update.de_json(update) for update in warmup])
+        wait_for_outbox(bot_module.outbox, timeout=60)
+
+        results = []
+        for level_number, concurrency in enumerate(levels):
+            level = run_level(bot, bot_module.router, factory, args.mix, concurrency, args.updates,
+                              args.seed + level_number, error_recorder)
+            level['outbox_drain_s'] = wait_for_outbox(bot_module.outbox, timeout=120)
+            results.append(level)
+        database_name = db.obj.__class__.__name__
+        db.close()
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        server.shutdown()
+
+    report = {
+        'commit': get_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'database_url')},
+        'database': database_name,
+        'telegram_calls': dict(telegram_api.calls),
+        'wb_requests': simulator.get_stats(),
+        'results': results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f'bot-{report["commit"] or "local"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f'Результаты сохранены в {output_path}')
+
+
+if __name__ == '__main__':
+    main()
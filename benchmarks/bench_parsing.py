@@ -0,0 +1,143 @@
+"""Микро-бенчмарк декодирования и парсинга ответов API Wildberries.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_parsing
+    python -m benchmarks.bench_parsing --orders-file orders.json --stickers-file stickers.json
+
+Без файлов используются сгенерированные ответы той же структуры, что и у API.
+"""
+import argparse
+import base64
+import datetime
+import json
+import random
+import timeit
+
+from api.classes import Order, Supply, Sticker
+from api.parsing import orjson
+
+
+def make_orders_response(count: int) -> bytes:
+    """Генерирует ответ /api/v3/orders/new с заданным числом заказов"""
+    created_at = datetime.datetime(2023, 3, 1, tzinfo=datetime.timezone.utc)
+    orders = [
+        {
+            'id': 13833711 + number,
+            'rid': f'f884001e44e511edb8780242ac120002.{number}',
+            'createdAt': (created_at + datetime.timedelta(minutes=number)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'warehouseId': 658434,
+            'supplyId': None,
+            'offices': ['Калуга'],
+            'user': None,
+            'skus': [f'{6665956397512 + number % 50}'],
+            'price': 1014,
+            'convertedPrice': 28322,
+            'currencyCode': 933,
+            'convertedCurrencyCode': 643,
+            'orderUid': f'165918930_629fbc924b984618a44354475ca58675{number}',
+            'nmId': 12345678,
+            'chrtId': 987654321,
+            'article': f'one-ring-{number % 50:04d}',
+            'isLargeCargo': False,
+        }
+        for number in range(count)]
+    return json.dumps({'orders': orders}).encode()
+
+
+def make_supplies_response(count: int) -> bytes:
+    """Генерирует ответ /api/v3/supplies с заданным числом поставок"""
+    created_at = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    supplies = []
+    for number in range(count):
+        supply_created_at = created_at + datetime.timedelta(hours=number)
+        is_done = number < count - 3
+        supplies.append({
+            'id': f'WB-GI-{1234567 + number}',
+            'done': is_done,
+            'createdAt': supply_created_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'closedAt': (supply_created_at + datetime.timedelta(hours=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            if is_done else None,
+            'scanDt': None,
+            'name': f'Поставка {number}',
+            'isLargeCargo': False,
+        })
+    return json.dumps({'next': count, 'supplies': supplies}).encode()
+
+
+def make_stickers_response(count: int, sticker_size: int = 6000) -> bytes:
+    """Генерирует ответ /api/v3/orders/stickers с заданным числом стикеров"""
+    stickers = [
+        {
+            'orderId': 13833711 + number,
+            'partA': f'{231648 + number}',
+            'partB': f'{9753 + number % 1000}',
+            'barcode': f'!uKEtQZVx{number}',
+            'file': base64.b64encode(random.randbytes(sticker_size)).decode(),
+        }
+        for number in range(count)]
+    return json.dumps({'stickers': stickers}).encode()
+
+
+def measure(func, repeat: int) -> float:
+    """Возвращает лучшее время выполнения функции в миллисекундах"""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def run(payloads: dict[str, tuple[type, str, bytes]], repeat: int) -> list[dict]:
+    """Замеряет декодирование и парсинг каждого ответа
+    @param payloads: {название: (модель, ключ списка в ответе, тело ответа)}
+    @param repeat: количество повторов замера
+    @return: результаты замеров
+    """
+    results = []
+    for name, (model, key, body) in payloads.items():
+        items = json.loads(body)[key]
+        result = {
+            'payload': name,
+            'items': len(items),
+            'size_kb': round(len(body) / 1024, 1),
+            'json_loads_ms': measure(lambda: json.loads(body), repeat),
+            'orjson_loads_ms': measure(lambda: orjson.loads(body), repeat) if orjson else None,
+            'parse_obj_ms': measure(lambda: [model.parse_obj(item) for item in items], repeat),
+            'parse_list_ms': measure(lambda: model.parse_list(items, validate=False), repeat),
+        }
+        results.append(result)
+    return results
+
+
+def print_results(results: list[dict]):
+    columns = list(results[0])
+    print(' | '.join(f'{column:>15}' for column in columns))
+    for result in results:
+        print(' | '.join(
+            f'{value:>15.2f}' if isinstance(value, float) else f'{str(value):>15}'
+            for value in result.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=2000, help='число заказов в сгенерированном ответе')
+    parser.add_argument('--supplies', type=int, default=5000, help='число поставок в сгенерированном ответе')
+    parser.add_argument('--stickers', type=int, default=500, help='число стикеров в сгенерированном ответе')
+    parser.add_argument('--orders-file', help='записанный ответ /api/v3/orders или /api/v3/orders/new')
+    parser.add_argument('--supplies-file', help='записанный ответ /api/v3/supplies')
+    parser.add_argument('--stickers-file', help='записанный ответ /api/v3/orders/stickers')
+    parser.add_argument('--repeat', type=int, default=5, help='количество повторов замера')
+    args = parser.parse_args()
+
+    def read_or_generate(path: str | None, generate, count: int) -> bytes:
+        if path:
+            with open(path, 'rb') as file:
+                return file.read()
+        return generate(count)
+
+    payloads = {
+        'orders': (Order, 'orders', read_or_generate(args.orders_file, make_orders_response, args.orders)),
+        'supplies': (Supply, 'supplies', read_or_generate(args.supplies_file, make_supplies_response, args.supplies)),
+        'stickers': (Sticker, 'stickers', read_or_generate(args.stickers_file, make_stickers_response, args.stickers)),
+    }
+    print_results(run(payloads, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Бенчмарк горячих путей БД и создания стикеров на синтетической поставке.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_stickers --orders 500 --articles 40
+    python -m benchmarks.bench_stickers --compare benchmarks/results/<коммит>.json
+
+Для каждого этапа замеряются время, пиковый RSS процесса (максимум с начала запуска)
+и размер результата. Результаты сохраняются в JSON, чтобы сравнивать коммиты.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from api.classes import Supply
+from benchmarks.common import get_commit, init_bench_db, RESULTS_DIR
+from benchmarks.synthetic import make_supply, make_sticker_svg, make_sticker_zpl
+from db_client import prepare_db, bulk_insert_supplies, bulk_insert_orders, set_products_name_and_barcode
+from db_client import add_stickers_to_db, select_orders_by_supply
+from models import db
+from stickers import create_stickers_for_orders, create_supply_stickers, save_image_from_str_to_png, svg2rlg
+from utils import group_orders_by_article, prepare_stickers
+from zpl_stickers import create_zpl_stickers_for_orders
+
+SUPPLY_ID = 'WB-GI-BENCH'
+
+
+def get_peak_rss_mb() -> float | None:
+    """Возвращает пиковый RSS процесса в мегабайтах (None, если недоступно)"""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux ru_maxrss в килобайтах, в macOS - в байтах
+    return round(peak_rss / (2 ** 20 if platform.system() == 'Darwin' else 2 ** 10), 1)
+
+
+def measure(func, output_path: str = None) -> tuple[dict, object]:
+    """Выполняет функцию и замеряет время, пиковый RSS и размер результата
+    @param func: Замеряемая функция без аргументов
+    @param output_path: Путь к файлу результата, если есть
+    @return: замеры и результат функции
+    """
+    started_at = time.perf_counter()
+    result = func()
+    wall_time = time.perf_counter() - started_at
+    path = output_path(result) if callable(output_path) else output_path
+    return {
+        'wall_time_s': round(wall_time, 4),
+        'peak_rss_mb': get_peak_rss_mb(),
+        'output_bytes': os.path.getsize(path) if path else None,
+    }, result
+
+
+def run(orders_count: int, articles_count: int, seed: int) -> dict:
+    """Прогоняет все этапы на синтетической поставке во временной папке
+    @return: {этап: замеры}
+    """
+    orders, products, stickers = make_supply(orders_count, articles_count, seed)
+    supply = Supply.construct(
+        supply_id=SUPPLY_ID,
+        name='Бенчмарк',
+        closed_at=None,
+        created_at=datetime.datetime.now(),
+        is_done=False)
+
+    bulk_insert_supplies([supply])
+
+    results = {}
+    results['bulk_insert_orders'], _ = measure(lambda: bulk_insert_orders(orders, SUPPLY_ID))
+    set_products_name_and_barcode(products)
+    results['add_stickers_to_db'], _ = measure(lambda: add_stickers_to_db(stickers))
+    results['group_orders_by_article'], grouped_orders = measure(
+        lambda: group_orders_by_article(select_orders_by_supply(SUPPLY_ID)))
+
+    _, article_orders = max(grouped_orders.items(), key=lambda item: len(item[1]))
+    os.makedirs('stickers', exist_ok=True)
+    for order in article_orders:
+        save_image_from_str_to_png(order.sticker, order.sticker_path)
+    results['create_stickers_for_orders'], _ = measure(
+        lambda: create_stickers_for_orders(article_orders, 'article.pdf'),
+        output_path='article.pdf')
+    results['create_stickers_for_orders']['orders'] = len(article_orders)
+
+    # Те же заказы с векторными стикерами из API (STICKER_IMAGE_TYPE=svg), если установлен svglib
+    if svg2rlg is not None:
+        for order in article_orders:
+            order.sticker = make_sticker_svg(order.id, seed)
+        results['create_stickers_for_orders_svg'], _ = measure(
+            lambda: create_stickers_for_orders(article_orders, 'article-svg.pdf'),
+            output_path='article-svg.pdf')
+        results['create_stickers_for_orders_svg']['orders'] = len(article_orders)
+
+    # Те же заказы со стикерами из API в формате ZPL (STICKER_FORMAT=zpl)
+    for order in article_orders:
+        order.sticker = make_sticker_zpl(order.id, seed)
+    results['create_zpl_stickers_for_orders'], _ = measure(
+        lambda: create_zpl_stickers_for_orders(article_orders, 'article.zpl'),
+        output_path='article.zpl')
+    results['create_zpl_stickers_for_orders']['orders'] = len(article_orders)
+
+    results['prepare_stickers'], _ = measure(
+        lambda: prepare_stickers(SUPPLY_ID),
+        output_path=lambda result: result[0])
+    # Вся поставка одним pdf файлом (STICKER_PDF_LAYOUT=supply)
+    grouped_orders = group_orders_by_article(select_orders_by_supply(SUPPLY_ID))
+    results['create_supply_stickers'], _ = measure(
+        lambda: create_supply_stickers(grouped_orders, SUPPLY_ID),
+        output_path=lambda result: result[0])
+    return results
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f'{"этап":>32} | {"время, с":>10} | {"RSS, МБ":>8} | {"размер, КБ":>10}')
+    for stage, stats in results.items():
+        line = f'{stage:>32} | {stats["wall_time_s"]:>10.3f} | {stats["peak_rss_mb"] or "-":>8} | ' \
+               f'{stats["output_bytes"] / 1024 if stats["output_bytes"] else 0:>10.1f}'
+        if baseline and (old_stats := baseline.get(stage)):
+            if old_stats['wall_time_s']:
+                change = stats['wall_time_s'] / old_stats['wall_time_s'] - 1
+                line += f' | {change:+.0%} ко времени'
+            if old_stats['output_bytes'] and stats['output_bytes']:
+                change = stats['output_bytes'] / old_stats['output_bytes'] - 1
+                line += f', {change:+.0%} к размеру'
+            line += ' базового замера'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=200, help='количество заказов в поставке')
+    parser.add_argument('--articles', type=int, default=20, help='количество артикулов в поставке')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора данных')
+    parser.add_argument('--output', help='файл для сохранения результатов (по умолчанию benchmarks/results/<коммит>.json)')
+    parser.add_argument('--compare', help='файл с результатами другого запуска для сравнения')
+    parser.add_argument('--database-url', help='адрес отдельной БД для бенчмарка, например '
+                                               'postgresql+pool://postgres@localhost/bench (по умолчанию SQLite)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='wb-bench-')
+    current_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        init_bench_db(work_dir, args.database_url)
+        prepare_db(owner_id=0, owner_full_name='Бенчмарк')
+        results = run(args.orders, args.articles, args.seed)
+        db.close()
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': get_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': {'orders': args.orders, 'articles': args.articles, 'seed': args.seed,
+                   'database': db.obj.__class__.__name__},
+        'results': results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f'{report["commit"] or "local"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f'Результаты сохранены в {output_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""Общие функции бенчмарков. Модуль не импортирует модули бота,
+чтобы бенчмарки могли заполнить окружение до чтения настроек"""
+import os
+import subprocess
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PROJECT_DIR, 'benchmarks', 'results')
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def init_bench_db(work_dir: str, database_url: str = None):
+    """Подключает бота к БД бенчмарка
+    @param work_dir: Временная папка бенчмарка, в ней создаётся SQLite БД
+    @param database_url: Адрес отдельной БД для бенчмарка (например, локального PostgreSQL).
+    Все таблицы бота в ней пересоздаются
+    """
+    from models import ALL_MODELS, db, init_db
+
+    if database_url is None:
+        init_db(f'sqlite:///{os.path.join(work_dir, "bench.db")}')
+        return
+    init_db(database_url)
+    db.drop_tables(ALL_MODELS)
@@ -0,0 +1,193 @@
+"""Локальная замена Redis для хранилища состояний диалогов.
+
+Запуск из корня проекта:
+    python -m benchmarks.redis_stub --port 6390
+и затем бот с STATE_STORAGE_URL=redis://127.0.0.1:6390/0
+
+Сервер говорит на протоколе Redis (RESP2) и поддерживает только команды, которыми
+пользуются бот и клиент redis: PING, GET, GETDEL, SET (EX, PX, NX, XX), DEL, EXISTS, EXPIRE, TTL,
+DBSIZE, FLUSHDB, SELECT, CLIENT и HELLO. Клиенту, приславшему HELLO 3, ответы
+отдаются в формате RESP3.
+Данные хранятся в памяти процесса сервера, одна база на все номера.
+"""
+import argparse
+import threading
+import time
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+
+class RedisStub:
+    """Словарь ключей с временем жизни, общий для всех соединений"""
+
+    def __init__(self):
+        self._values: dict[bytes, tuple[bytes, float | None]] = {}
+        self._lock = threading.Lock()
+
+    def _get_alive(self, key: bytes) -> tuple[bytes, float | None] | None:
+        saved = self._values.get(key)
+        if saved is not None and saved[1] is not None and saved[1] <= time.monotonic():
+            del self._values[key]
+            saved = None
+        return saved
+
+    def execute(self, command: str, args: list[bytes]):
+        """Выполняет команду
+        @return: ответ для клиента: bytes, str (простая строка), int, dict, None или Exception
+        """
+        handler = getattr(self, f'cmd_{command}', None)
+        if handler is None:
+            return Exception(f"ERR unknown command '{command}'")
+        try:
+            with self._lock:
+                return handler(*args)
+        except (TypeError, ValueError):
+            return Exception(f"ERR wrong arguments for '{command}' command")
+
+    def cmd_ping(self, message: bytes = None):
+        return message if message is not None else 'PONG'
+
+    def cmd_get(self, key: bytes):
+        saved = self._get_alive(key)
+        return saved[0] if saved else None
+
+    def cmd_getdel(self, key: bytes):
+        saved = self._get_alive(key)
+        if saved is None:
+            return None
+        del self._values[key]
+        return saved[0]
+
+    def cmd_set(self, key: bytes, value: bytes, *options: bytes):
+        expires_at = None
+        options = [option.upper() for option in options]
+        if b'NX' in options and self._get_alive(key) is not None:
+            return None
+        if b'XX' in options and self._get_alive(key) is None:
+            return None
+        for unit, scale in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                expires_at = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+        self._values[key] = (value, expires_at)
+        return 'OK'
+
+    def cmd_del(self, *keys: bytes):
+        return sum(self._values.pop(key, None) is not None for key in keys)
+
+    def cmd_exists(self, *keys: bytes):
+        return sum(self._get_alive(key) is not None for key in keys)
+
+    def cmd_expire(self, key: bytes, seconds: bytes):
+        saved = self._get_alive(key)
+        if saved is None:
+            return 0
+        self._values[key] = (saved[0], time.monotonic() + int(seconds))
+        return 1
+
+    def cmd_ttl(self, key: bytes):
+        saved = self._get_alive(key)
+        if saved is None:
+            return -2
+        return -1 if saved[1] is None else round(saved[1] - time.monotonic())
+
+    def cmd_dbsize(self):
+        return len(self._values)
+
+    def cmd_flushdb(self, *options: bytes):
+        self._values.clear()
+        return 'OK'
+
+    def cmd_select(self, index: bytes):
+        return 'OK'
+
+    def cmd_client(self, *args: bytes):
+        return 'OK'
+
+    def cmd_hello(self, protocol: bytes = b'2', *options: bytes):
+        if protocol not in (b'2', b'3'):
+            return Exception('NOPROTO unsupported protocol version')
+        return {b'server': b'redis', b'version': b'7.0.0', b'proto': int(protocol), b'mode': b'standalone'}
+
+
+class _RedisRequestHandler(StreamRequestHandler):
+    stub: RedisStub
+    protocol = 2
+
+    def _read_command(self) -> list[bytes] | None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _write(self, reply):
+        if reply is None:
+            self.wfile.write(b'_\r\n' if self.protocol == 3 else b'$-1\r\n')
+        elif isinstance(reply, Exception):
+            self.wfile.write(f'-{reply}\r\n'.encode())
+        elif isinstance(reply, str):
+            self.wfile.write(f'+{reply}\r\n'.encode())
+        elif isinstance(reply, int):
+            self.wfile.write(f':{reply}\r\n'.encode())
+        elif isinstance(reply, dict):
+            # HELLO отвечает картой в RESP3 и плоским массивом в RESP2
+            if self.protocol == 3:
+                self.wfile.write(f'%{len(reply)}\r\n'.encode())
+            else:
+                self.wfile.write(f'*{len(reply) * 2}\r\n'.encode())
+            for key, value in reply.items():
+                self._write(key)
+                self._write(value)
+        else:
+            self.wfile.write(b'$%d\r\n%s\r\n' % (len(reply), reply))
+
+    def handle(self):
+        while (args := self._read_command()) is not None:
+            if not args:
+                continue
+            command = args[0].decode().lower()
+            if command == 'quit':
+                self._write('OK')
+                return
+            reply = self.stub.execute(command, args[1:])
+            if command == 'hello' and isinstance(reply, dict):
+                self.protocol = reply[b'proto']
+            self._write(reply)
+            self.wfile.flush()
+
+
+def start_redis_stub(stub: RedisStub, host: str = '127.0.0.1', port: int = 0) -> ThreadingTCPServer:
+    """Запускает сервер в фоновом потоке
+    @param stub: Хранилище ключей
+    @param host: Адрес сервера
+    @param port: Порт сервера, 0 - любой свободный
+    @return: запущенный сервер, адрес - server.server_address
+    """
+    handler = type('RedisRequestHandler', (_RedisRequestHandler,), {'stub': stub})
+    server = ThreadingTCPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='RedisStub', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='адрес сервера')
+    parser.add_argument('--port', type=int, default=6390, help='порт сервера')
+    args = parser.parse_args()
+
+    server = start_redis_stub(RedisStub(), args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f'Замена Redis запущена: STATE_STORAGE_URL=redis://{host}:{port}/0')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Генерация синтетических поставок для бенчмарков"""
+import base64
+import datetime
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from api.classes import Order, Product, Sticker
+
+# Размер стикера WB 58x40 мм при 8 точках на мм
+STICKER_SIZE_PX = (464, 320)
+
+
+def make_sticker_png(order_id: int, seed: int = 0) -> str:
+    """Генерирует похожий на стикер WB черно-белый PNG: QR-подобный блок и цифры заказа
+    @param order_id: ID заказа, от него зависит рисунок
+    @param seed: Зерно генератора
+    @return: PNG в base64, как в ответе API
+    """
+    rnd = random.Random(order_id * 7919 + seed)
+    image = Image.new('1', STICKER_SIZE_PX, 1)
+    draw = ImageDraw.Draw(image)
+    cell = 8
+    for row in range(25):
+        for column in range(25):
+            if rnd.random() < 0.5:
+                x, y = 24 + column * cell, 24 + row * cell
+                draw.rectangle([x, y, x + cell - 1, y + cell - 1], fill=0)
+    draw.text((250, 60), f'{order_id // 10000}', fill=0)
+    draw.text((250, 120), f'{order_id % 10000:04d}', fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def make_sticker_svg(order_id: int, seed: int = 0) -> str:
+    """Генерирует похожий на стикер WB SVG с тем же рисунком, что и make_sticker_png
+    @param order_id: ID заказа, от него зависит рисунок
+    @param seed: Зерно генератора
+    @return: SVG в base64, как в ответе API
+    """
+    rnd = random.Random(order_id * 7919 + seed)
+    cell = 8
+    # Генераторы QR-кодов рисуют все модули одним контуром
+    path = []
+    for row in range(25):
+        for column in range(25):
+            if rnd.random() < 0.5:
+                path.append(f'M{24 + column * cell} {24 + row * cell}h{cell}v{cell}h-{cell}z')
+    width, height = STICKER_SIZE_PX
+    svg = f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" ' \
+          f'viewBox="0 0 {width} {height}"><rect width="{width}" height="{height}" fill="white"/>' \
+          f'<path fill="black" d="{"".join(path)}"/>' \
+          f'<text x="250" y="90" font-size="40">{order_id // 10000}</text>' \
+          f'<text x="250" y="150" font-size="40">{order_id % 10000:04d}</text></svg>'
+    return base64.b64encode(svg.encode()).decode()
+
+
+def make_sticker_zpl(order_id: int, seed: int = 0) -> str:
+    """Генерирует похожий на стикер WB ZPL: QR-код и цифры заказа
+    @param order_id: ID заказа
+    @param seed: Зерно генератора
+    @return: ZPL в base64, как в ответе API
+    """
+    zpl = f'^XA^PW{STICKER_SIZE_PX[0]}^LL{STICKER_SIZE_PX[1]}' \
+          f'^FO24,24^BQN,2,8^FDMA,*{order_id}-{seed}^FS' \
+          f'^FO250,60^A0N,48,48^FD{order_id // 10000}^FS' \
+          f'^FO250,120^A0N,48,48^FD{order_id % 10000:04d}^FS^XZ'
+    return base64.b64encode(zpl.encode()).decode()
+
+
+def make_sticker(order_id: int, seed: int = 0, sticker_type: str = 'png') -> str:
+    """Генерирует стикер заказа в формате, который запрашивается у API
+    @param sticker_type: png, svg, zplv или zplh
+    """
+    if sticker_type.startswith('zpl'):
+        return make_sticker_zpl(order_id, seed)
+    if sticker_type == 'svg':
+        return make_sticker_svg(order_id, seed)
+    return make_sticker_png(order_id, seed)
+
+
+def make_barcode(article_number: int) -> str:
+    """Генерирует корректный EAN-13 (подходит и для Code128)"""
+    digits = f'20{article_number:010d}'
+    checksum = (10 - sum(int(digit) * (3 if position % 2 else 1)
+                         for position, digit in enumerate(digits)) % 10) % 10
+    return f'{digits}{checksum}'
+
+
+def make_supply(
+        orders_count: int,
+        articles_count: int,
+        seed: int = 0,
+        sticker_type: str = 'png'
+) -> tuple[list[Order], list[Product], list[Sticker]]:
+    """Генерирует поставку
+    @param orders_count: Количество заказов
+    @param articles_count: Количество разных артикулов
+    @param seed: Зерно генератора
+    @param sticker_type: Формат стикеров, как в запросе к API
+    @return: заказы, товары и стикеры, как если бы они были получены от API
+    """
+    rnd = random.Random(seed)
+    created_at = datetime.datetime(2023, 3, 1, 9, tzinfo=datetime.timezone.utc)
+    products = [
+        Product(
+            article=f'ART-{number:05d}',
+            name=f'Товар номер {number} {"очень длинное наименование " * rnd.randint(0, 3)}'.strip(),
+            barcode=make_barcode(number))
+        for number in range(articles_count)]
+    orders = [
+        Order.construct(
+            order_id=100000000 + number,
+            article=products[rnd.randrange(articles_count)].article,
+            created_at=created_at + datetime.timedelta(seconds=number * 37))
+        for number in range(orders_count)]
+    stickers = [
+        Sticker.construct(
+            order_id=order.order_id,
+            file=make_sticker(order.order_id, seed, sticker_type),
+            partA=str(order.order_id // 10000),
+            partB=str(order.order_id % 10000))
+        for order in orders]
+    return orders, products, stickers
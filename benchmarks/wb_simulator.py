@@ -0,0 +1,438 @@
+"""Локальный симулятор API Wildberries для нагрузочного тестирования без обращения к WB.
+
+Запуск из корня проекта:
+    python -m benchmarks.wb_simulator --port 8090 --supplies 3000 --latency 150 --error-rate 0.01
+и затем бот или бенчмарк с WB_API_URL=http://127.0.0.1:8090
+
+Поддерживаются эндпоинты, которыми пользуется бот: список, создание, удаление
+и отправка в доставку поставок, QR-код поставки, заказы поставки, новые заказы,
+добавление заказа в поставку, стикеры и карточки товаров.
+Задержка ответа, доля ошибок 500 и ответов 429 настраиваются параметрами.
+Статистика запросов симулятора доступна по адресу /_stats.
+"""
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from benchmarks.synthetic import make_sticker, make_sticker_png, make_barcode
+
+SUPPLY_ID_PREFIX = 'WB-GI-'
+FIRST_ORDER_ID = 100000000
+MAX_SUPPLIES_PAGE = 1000
+_FAULT_RESPONSES = {
+    429: {'code': 'TooManyRequests', 'message': 'Слишком много запросов'},
+    500: {'code': 'InternalServerError', 'message': 'Внутренняя ошибка'},
+}
+
+
+def _format_datetime(value: datetime.datetime | None) -> str | None:
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value else None
+
+
+class WBDataset:
+    """Данные симулятора: поставки, заказы и товары. Все методы потокобезопасны"""
+
+    def __init__(
+            self,
+            supplies_count: int = 100,
+            active_supplies: int = 3,
+            orders_per_supply: int = 20,
+            new_orders_count: int = 50,
+            articles_count: int = 30,
+            seed: int = 0):
+        """
+        @param supplies_count: Количество поставок
+        @param active_supplies: Сколько последних поставок не закрыто
+        @param orders_per_supply: Количество заказов в каждой поставке
+        @param new_orders_count: Количество новых заказов, не добавленных в поставки
+        @param articles_count: Количество разных артикулов
+        @param seed: Зерно генератора
+        """
+        self.seed = seed
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.articles = [f'ART-{number:05d}' for number in range(articles_count)]
+        self.products = {
+            article: {
+                'vendorCode': article,
+                'characteristics': [{'Наименование': f'Товар номер {number}'}],
+                'sizes': [{'skus': [make_barcode(number)]}]}
+            for number, article in enumerate(self.articles)}
+
+        self._started_at = datetime.datetime(2023, 1, 1, 9)
+        self._next_order_id = FIRST_ORDER_ID
+        self._next_supply_number = 0
+        self.supplies: list[dict] = []
+        self.supply_orders: dict[str, list[dict]] = {}
+        for number in range(supplies_count):
+            supply = self._add_supply(f'Поставка {number + 1}')
+            self.supply_orders[supply['id']] = [self._make_order() for _ in range(orders_per_supply)]
+            if number < supplies_count - active_supplies:
+                supply['done'] = True
+                supply['closedAt'] = supply['createdAt']
+        self.new_orders: dict[int, dict] = {}
+        for _ in range(new_orders_count):
+            order = self._make_order()
+            self.new_orders[order['id']] = order
+
+    def _now(self, shift: int) -> str:
+        return _format_datetime(self._started_at + datetime.timedelta(minutes=shift))
+
+    def _add_supply(self, name: str) -> dict:
+        supply = {
+            'id': f'{SUPPLY_ID_PREFIX}{self._next_supply_number + 1:08d}',
+            'name': name,
+            'done': False,
+            'createdAt': self._now(self._next_supply_number * 60),
+            'closedAt': None,
+            'scanDt': None,
+            'isLargeCargo': False}
+        self._next_supply_number += 1
+        self.supplies.append(supply)
+        self.supply_orders[supply['id']] = []
+        return supply
+
+    def _make_order(self) -> dict:
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        article = self._rnd.choice(self.articles)
+        return {
+            'id': order_id,
+            'rid': f'{order_id}.0.0',
+            'createdAt': self._now((order_id - FIRST_ORDER_ID) // 10),
+            'warehouseId': 1,
+            'article': article,
+            'skus': self.products[article]['sizes'][0]['skus'],
+            'price': 100000,
+            'convertedPrice': 100000,
+            'currencyCode': 643,
+            'isLargeCargo': False}
+
+    def get_supplies_page(self, limit: int, next_cursor: int) -> dict:
+        with self._lock:
+            page = [dict(supply) for supply in self.supplies[next_cursor:next_cursor + limit]]
+        return {'next': next_cursor + len(page), 'supplies': page}
+
+    def find_supply(self, supply_id: str) -> dict | None:
+        with self._lock:
+            return next((supply for supply in self.supplies if supply['id'] == supply_id), None)
+
+    def create_supply(self, name: str) -> dict:
+        with self._lock:
+            return {'id': self._add_supply(name)['id']}
+
+    def delete_supply(self, supply_id: str) -> int:
+        with self._lock:
+            supply = next((supply for supply in self.supplies if supply['id'] == supply_id), None)
+            if supply is None:
+                return 404
+            if supply['done'] or self.supply_orders[supply_id]:
+                return 409
+            self.supplies.remove(supply)
+            del self.supply_orders[supply_id]
+            return 204
+
+    def deliver_supply(self, supply_id: str) -> int:
+        with self._lock:
+            supply = next((supply for supply in self.supplies if supply['id'] == supply_id), None)
+            if supply is None:
+                return 404
+            if supply['done'] or not self.supply_orders[supply_id]:
+                return 409
+            supply['done'] = True
+            supply['closedAt'] = _format_datetime(datetime.datetime.utcnow())
+            return 204
+
+    def get_supply_orders(self, supply_id: str) -> list[dict] | None:
+        with self._lock:
+            orders = self.supply_orders.get(supply_id)
+            return list(orders) if orders is not None else None
+
+    def add_order_to_supply(self, supply_id: str, order_id: int) -> int:
+        with self._lock:
+            supply = next((supply for supply in self.supplies if supply['id'] == supply_id), None)
+            if supply is None:
+                return 404
+            if supply['done'] or order_id not in self.new_orders:
+                return 409
+            self.supply_orders[supply_id].append(self.new_orders.pop(order_id))
+            return 204
+
+    def get_new_orders(self) -> list[dict]:
+        with self._lock:
+            return list(self.new_orders.values())
+
+    def add_new_orders(self, count: int):
+        """Добавляет новые заказы, как если бы их оформили покупатели"""
+        with self._lock:
+            for _ in range(count):
+                order = self._make_order()
+                self.new_orders[order['id']] = order
+
+    def get_stickers(self, order_ids: list[int], sticker_type: str = 'png') -> list[dict]:
+        return [{
+            'orderId': order_id,
+            'partA': str(order_id // 10000),
+            'partB': str(order_id % 10000),
+            'barcode': f'*{order_id}',
+            'file': self._get_sticker_file(order_id, sticker_type)}
+            for order_id in order_ids]
+
+    @lru_cache(maxsize=10000)
+    def _get_sticker_file(self, order_id: int, sticker_type: str) -> str:
+        return make_sticker(order_id, self.seed, sticker_type)
+
+    def get_cards(self, vendor_codes: list[str]) -> list[dict]:
+        return [self.products[code] for code in vendor_codes if code in self.products]
+
+
+class WBSimulator:
+    """Поведение симулятора: задержки, ошибки и ответы 429"""
+
+    def __init__(
+            self,
+            dataset: WBDataset,
+            latency: float = 0,
+            jitter: float = 0,
+            error_rate: float = 0,
+            too_many_requests_rate: float = 0,
+            max_rps: float = 0,
+            retry_after: int = 1,
+            seed: int = 0):
+        """
+        @param dataset: Данные симулятора
+        @param latency: Средняя задержка ответа в секундах
+        @param jitter: Разброс задержки в секундах (равномерно в обе стороны)
+        @param error_rate: Доля ответов 500
+        @param too_many_requests_rate: Доля случайных ответов 429
+        @param max_rps: Максимум запросов в секунду, сверх него отдаётся 429 (0 - без ограничения)
+        @param retry_after: Значение заголовка Retry-After в ответах 429
+        @param seed: Зерно генератора
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.too_many_requests_rate = too_many_requests_rate
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.stats = Counter()
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_started_at = time.monotonic()
+        self._window_requests = 0
+
+    def get_fault(self) -> int | None:
+        """Решает, нужно ли ответить ошибкой вместо обработки запроса
+        @return: статус ошибки или None
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_started_at >= 1:
+                self._window_started_at = now
+                self._window_requests = 0
+            self._window_requests += 1
+            if self.max_rps and self._window_requests > self.max_rps:
+                return 429
+            value = self._rnd.random()
+        if value < self.too_many_requests_rate:
+            return 429
+        if value < self.too_many_requests_rate + self.error_rate:
+            return 500
+        return None
+
+    def get_delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._rnd.uniform(-self.jitter, self.jitter))
+
+    def count(self, endpoint: str, status: int):
+        with self._lock:
+            self.stats[f'{endpoint} {status}'] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+class _SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    simulator: WBSimulator
+
+    routes = [
+        ('GET', re.compile(r'/api/v3/supplies'), 'supplies_list'),
+        ('POST', re.compile(r'/api/v3/supplies'), 'supplies_create'),
+        ('DELETE', re.compile(r'/api/v3/supplies/(?P<supply_id>[^/]+)'), 'supplies_delete'),
+        ('GET', re.compile(r'/api/v3/supplies/(?P<supply_id>[^/]+)/orders'), 'supply_orders'),
+        ('PATCH', re.compile(r'/api/v3/supplies/(?P<supply_id>[^/]+)/orders/(?P<order_id>\d+)'), 'supply_add_order'),
+        ('PATCH', re.compile(r'/api/v3/supplies/(?P<supply_id>[^/]+)/deliver'), 'supply_deliver'),
+        ('GET', re.compile(r'/api/v3/supplies/(?P<supply_id>[^/]+)/barcode'), 'supply_barcode'),
+        ('GET', re.compile(r'/api/v3/orders/new'), 'orders_new'),
+        ('POST', re.compile(r'/api/v3/orders/stickers'), 'orders_stickers'),
+        ('POST', re.compile(r'/content/v1/cards/filter'), 'cards_filter'),
+    ]
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method: str):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if method == 'GET' and url.path == '/_stats':
+            self._send(200, self.simulator.get_stats())
+            return
+
+        for route_method, pattern, endpoint in self.routes:
+            if route_method == method and (match := pattern.fullmatch(url.path)):
+                break
+        else:
+            self._send(404, {'code': 'NotFound', 'message': 'Не найдено'})
+            return
+
+        time.sleep(self.simulator.get_delay())
+        if 'Authorization' not in self.headers:
+            status, response = 401, {'code': 'Unauthorized', 'message': 'Не передан API ключ'}
+        elif fault := self.simulator.get_fault():
+            status, response = fault, _FAULT_RESPONSES[fault]
+        else:
+            try:
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                payload = json.loads(body) if body else {}
+                status, response = getattr(self, endpoint)(query, payload, **match.groupdict())
+            except (ValueError, KeyError, TypeError):
+                status, response = 400, {'code': 'IncorrectRequest', 'message': 'Некорректный запрос'}
+        self.simulator.count(endpoint, status)
+        self._send(status, response)
+
+    def _send(self, status: int, response: dict | None):
+        body = json.dumps(response, ensure_ascii=False).encode() if response is not None else b''
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', str(self.simulator.retry_after))
+        if body:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def supplies_list(self, query: dict, payload: dict):
+        limit = int(query['limit'])
+        next_cursor = int(query['next'])
+        if not 1 <= limit <= MAX_SUPPLIES_PAGE or next_cursor < 0:
+            raise ValueError
+        return 200, self.simulator.dataset.get_supplies_page(limit, next_cursor)
+
+    def supplies_create(self, query: dict, payload: dict):
+        return 201, self.simulator.dataset.create_supply(payload['name'])
+
+    def supplies_delete(self, query: dict, payload: dict, supply_id: str):
+        return self.simulator.dataset.delete_supply(supply_id), None
+
+    def supply_orders(self, query: dict, payload: dict, supply_id: str):
+        orders = self.simulator.dataset.get_supply_orders(supply_id)
+        if orders is None:
+            return 404, {'code': 'NotFound', 'message': 'Поставка не найдена'}
+        return 200, {'orders': orders}
+
+    def supply_add_order(self, query: dict, payload: dict, supply_id: str, order_id: str):
+        return self.simulator.dataset.add_order_to_supply(supply_id, int(order_id)), None
+
+    def supply_deliver(self, query: dict, payload: dict, supply_id: str):
+        return self.simulator.dataset.deliver_supply(supply_id), None
+
+    def supply_barcode(self, query: dict, payload: dict, supply_id: str):
+        if self.simulator.dataset.find_supply(supply_id) is None:
+            return 404, {'code': 'NotFound', 'message': 'Поставка не найдена'}
+        return 200, {'barcode': supply_id, 'file': make_sticker_png(len(supply_id), self.simulator.dataset.seed)}
+
+    def orders_new(self, query: dict, payload: dict):
+        return 200, {'orders': self.simulator.dataset.get_new_orders()}
+
+    def orders_stickers(self, query: dict, payload: dict):
+        order_ids = [int(order_id) for order_id in payload['orders']]
+        return 200, {'stickers': self.simulator.dataset.get_stickers(order_ids, query.get('type', 'png'))}
+
+    def cards_filter(self, query: dict, payload: dict):
+        return 200, {'data': self.simulator.dataset.get_cards(payload['vendorCodes']), 'error': False}
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_simulator(simulator: WBSimulator, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Запускает симулятор в фоновом потоке
+    @param simulator: Настроенный симулятор
+    @param host: Адрес сервера
+    @param port: Порт сервера, 0 - любой свободный
+    @return: запущенный сервер, адрес - server.server_address
+    """
+    handler = type('SimulatorRequestHandler', (_SimulatorRequestHandler,), {'simulator': simulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='WBSimulator', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='адрес сервера')
+    parser.add_argument('--port', type=int, default=8090, help='порт сервера')
+    parser.add_argument('--supplies', type=int, default=100, help='количество поставок')
+    parser.add_argument('--active-supplies', type=int, default=3, help='сколько последних поставок не закрыто')
+    parser.add_argument('--orders-per-supply', type=int, default=20, help='количество заказов в поставке')
+    parser.add_argument('--new-orders', type=int, default=50, help='количество новых заказов')
+    parser.add_argument('--articles', type=int, default=30, help='количество артикулов')
+    parser.add_argument('--latency', type=float, default=0, help='средняя задержка ответа в миллисекундах')
+    parser.add_argument('--jitter', type=float, default=0, help='разброс задержки в миллисекундах')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 500')
+    parser.add_argument('--429-rate', dest='too_many_requests_rate', type=float, default=0,
+                        help='доля случайных ответов 429')
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help='максимум запросов в секунду, сверх него отдаётся 429 (0 - без ограничения)')
+    parser.add_argument('--retry-after', type=int, default=1, help='значение Retry-After в ответах 429')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора данных')
+    args = parser.parse_args()
+
+    dataset = WBDataset(
+        supplies_count=args.supplies,
+        active_supplies=args.active_supplies,
+        orders_per_supply=args.orders_per_supply,
+        new_orders_count=args.new_orders,
+        articles_count=args.articles,
+        seed=args.seed)
+    simulator = WBSimulator(
+        dataset,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        too_many_requests_rate=args.too_many_requests_rate,
+        max_rps=args.max_rps,
+        retry_after=args.retry_after,
+        seed=args.seed)
+    server = start_simulator(simulator, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f'Симулятор API WB запущен: WB_API_URL=http://{host}:{port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
+import startup  # импортируется первым, чтобы замерить время импорта остальных модулей
 import os
-import re
 
 import telebot
 from dotenv import load_dotenv
@@ -7,43 +7,94 @@ from requests import HTTPError
 from telebot.types import Message, CallbackQuery, KeyboardButton, ReplyKeyboardMarkup
 from telebot.util import quick_markup
 
+from api.accounts import get_accounts, get_current_account, use_account
 from api.errors import WBAPIError
+from config import METRICS_HOST, METRICS_PORT, STARTUP_REPORT, WB_CASSETTE_MODE
 from api.methods import get_new_orders
 from api.methods import get_orders, add_order_to_supply, create_new_supply, delete_supply_by_id
-from api.methods import get_supplies
+from api.methods import add_orders_to_supply
 from api.methods import get_supply_sticker
 from api.methods import send_supply_to_deliver
+from cursors import Cursor, cursors
 from db_client import bulk_insert_orders, delete_supply_from_db, get_user, get_all_users
-from db_client import bulk_insert_supplies
+from db_client import insert_new_orders, toggle_subscription
 from db_client import get_order_by_id
 from db_client import insert_user
-from db_client import prepare_db
-from stickers import save_image_from_str_to_png, rotate_image
+from db_client import get_user_accounts, set_user_account, grant_account, revoke_account
+from db_client import prepare_db, DBConnectionMiddleware
+from db_client import mark_supply_closed, rebuild_shipping_stats
+from models import db, get_pool_stats
+from metrics import track_handler, registry, CallbackMetric, start_metrics_server, format_summary
+from outbox import SendQueue
+from profiling import profiled, get_profiles, get_profile_files
+from poller import NewOrdersPoller
+from retention import RetentionJob
+from router import router
+from states import DialogRouter, create_state_storage
 from utils import add_stickers_and_products_to_orders, make_menu_from_list, convert_to_created_ago
-from utils import check_registration, create_orders_markup
-from utils import create_supplies_markup
+from utils import check_registration, create_orders_markup, get_supplies
+from utils import format_shipping_report
+from utils import create_move_orders_markup, toggle_article_to_move, get_orders_to_move, format_move_report
+from utils import get_move_account
+from utils import create_supplies_markup, create_page_markup
 from utils import delete_temp_sticker_files
 from utils import join_orders
 from utils import prepare_stickers
 
+# Сколько последних поставок можно запросить за раз
+MAX_SUPPLIES_NUMBER = 50
+
 load_dotenv()
-bot = telebot.TeleBot(os.environ['TG_BOT_TOKEN'], parse_mode=None)
+state_storage = create_state_storage()
+bot = telebot.TeleBot(
+    os.environ['TG_BOT_TOKEN'], parse_mode=None, state_storage=state_storage, use_class_middlewares=True)
+bot.setup_middleware(DBConnectionMiddleware())
+dialogs = DialogRouter(state_storage)
+outbox = SendQueue(bot)
+new_orders_poller = NewOrdersPoller(outbox)
+retention_job = RetentionJob()
+registry.register(CallbackMetric(
+    'telegram_send_queue_depth', 'Сообщения Telegram, ожидающие отправки', outbox.get_depth))
+registry.register(CallbackMetric(
+    'bot_startup_seconds', 'Время от начала запуска до окончания этапа', startup.get_stages, label_name='stage'))
+registry.register(CallbackMetric(
+    'db_pool_connections', 'Соединения пула БД', get_pool_stats, label_name='state'))
+startup.mark('imports')
+
+
+@bot.message_handler(func=dialogs.is_waiting)
+def continue_dialog(message: Message):
+    """
+    Передаёт ответ пользователя обработчику шага диалога.
+    Регистрируется первым, чтобы ответ не перехватили обработчики кнопок меню
+    """
+    dialogs.dispatch(message)
 
 
 def ask_for_registration(message: Message):
-    """Отправляет администратору запрос на регистрацию пользователя"""
+    """Отправляет администратору запрос на регистрацию пользователя.
+    Зарегистрированному пользователю без доступа к аккаунтам продавца сообщает об этом"""
     user_id = message.chat.id
+    if get_user(user_id) is not None:
+        outbox.send_message(
+            chat_id=user_id,
+            text='У вас нет доступа ни к одному аккаунту продавца. Обратитесь к администратору')
+        outbox.send_message(
+            chat_id=os.environ['OWNER_ID'],
+            text=f'У пользователя {message.from_user.full_name} нет доступа к аккаунтам.\n'
+                 f'Открыть доступ: /grant {user_id} <аккаунт>')
+        return
     register_markup = quick_markup(
         {
-            'Одобрить': {'callback_data': f'register_{user_id}_{message.from_user.full_name}'},
-            'Отказать': {'callback_data': f'deny_{user_id}'}
+            'Одобрить': {'callback_data': router.callback_data('reg', user_id, message.from_user.full_name)},
+            'Отказать': {'callback_data': router.callback_data('deny', user_id)}
         }
     )
-    bot.send_message(
+    outbox.send_message(
         chat_id=os.environ['OWNER_ID'],
         text=f'Запрос на регистрацию пользователя\n{message.from_user.full_name}',
         reply_markup=register_markup)
-    bot.send_message(
+    outbox.send_message(
         chat_id=user_id,
         text='Бот находится в разработке')
     # text='Запрос на регистрацию отправлен администратору. Ожидайте ответа.')
@@ -52,14 +103,14 @@ def ask_for_registration(message: Message):
 def send_message_on_error(exception: Exception, message: Message):
     """Отправляет сообщение администратору и пользователю при ошибке запроса к API"""
     if isinstance(exception, WBAPIError):
-        bot.send_message(
+        outbox.send_message(
             chat_id=message.chat.id,
             text='Что-то пошло не так. Администратор уже разбирается')
     if isinstance(exception, HTTPError):
-        bot.send_message(
+        outbox.send_message(
             chat_id=message.chat.id,
             text='Ошибка сервера. Попробуйте позже')
-    bot.send_message(
+    outbox.send_message(
         chat_id=os.environ['OWNER_ID'],
         text=f'Ошибка у пользователя: {message.from_user.id}\n{exception}')
 
@@ -69,41 +120,44 @@ def send_message_on_rights_error(message: Message):
     pass
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('register_'))
+@router.route('reg')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def register_user(call: CallbackQuery):
+def register_user(call: CallbackQuery, user_id: str, user_full_name: str):
     """
     Регистрирует пользователя
     """
-    user_id = re.search(r'_\d+_', call.data).group().strip('_')
-    user_full_name = call.data.lstrip(f'register_{user_id}_')
     insert_user(
         user_id=user_id,
         user_full_name=user_full_name)
     bot.answer_callback_query(
         call.id,
         text='Пользователь зарегистрирован')
-    bot.send_message(
+    outbox.send_message(
         user_id,
         text='Ваша регистрация одобрена. Можно начать работать.\n/start')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('deny_'))
+@router.route('deny')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def deny_registration(call: CallbackQuery):
+def deny_registration(call: CallbackQuery, user_id: str):
     """
     Отклоняет запрос регистрации
     """
-    user_id = call.data.lstrip('deny_')
     bot.answer_callback_query(
         call.id,
         text='Регистрация отклонена')
-    bot.send_message(
+    outbox.send_message(
         int(user_id),
         text='Ваш запрос на регистрацию отклонен')
 
 
 @bot.message_handler(regexp='Управление пользователями')
+@track_handler
+@profiled
 @check_registration(send_message_on_rights_error, is_admin=True)
 def start(message: Message):
     """
@@ -112,14 +166,158 @@ def start(message: Message):
     """
     users = (user.full_name for user in get_all_users())
     joined_users = "\n".join(users)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         text=f'Все пользователи:\n{joined_users}'
     )
 
 
+@bot.message_handler(commands=['accounts'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def show_accounts(message: Message):
+    """
+    Показывает администратору аккаунты продавца и пользователей с доступом к ним.
+    /grant ID аккаунт и /revoke ID аккаунт открывают и закрывают доступ
+    """
+    lines = []
+    users = list(get_all_users())
+    for account in get_accounts():
+        account_users = [user.full_name for user in users if account in get_user_accounts(user)]
+        lines.append(f'{account}: {", ".join(account_users) or "нет пользователей"}')
+    joined_lines = '\n'.join(lines)
+    outbox.send_message(
+        message.chat.id,
+        f'Аккаунты:\n{joined_lines}\n\n/grant ID аккаунт - открыть доступ\n/revoke ID аккаунт - закрыть доступ')
+
+
+@bot.message_handler(commands=['grant', 'revoke'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def change_account_access(message: Message):
+    """
+    Открывает (/grant) или закрывает (/revoke) пользователю доступ к аккаунту продавца
+    """
+    command, *args = message.text.split()
+    if len(args) != 2 or not args[0].isdigit() or args[1] not in get_accounts():
+        outbox.send_message(
+            message.chat.id,
+            f'Формат: {command} ID аккаунт. Аккаунты: {", ".join(get_accounts())}')
+        return
+    user_id, account = int(args[0]), args[1]
+    if get_user(user_id) is None:
+        outbox.send_message(message.chat.id, f'Пользователь {user_id} не зарегистрирован')
+        return
+    if command.startswith('/grant'):
+        grant_account(user_id, account)
+        outbox.send_message(message.chat.id, f'Пользователю {user_id} открыт доступ к аккаунту {account}')
+    elif revoke_account(user_id, account):
+        outbox.send_message(message.chat.id, f'Пользователю {user_id} закрыт доступ к аккаунту {account}')
+    else:
+        outbox.send_message(message.chat.id, f'У пользователя {user_id} не было доступа к аккаунту {account}')
+
+
+@bot.message_handler(commands=['stats'])
+@track_handler
+@profiled
+@check_registration(send_message_on_rights_error, is_admin=True)
+def show_stats(message: Message):
+    """
+    Показывает администратору сводку метрик: время обработчиков, запросов к API и БД,
+    попадания в кеши и очереди
+    """
+    outbox.send_message(message.chat.id, format_summary())
+
+
+@bot.message_handler(commands=['cleanup'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def run_cleanup(message: Message):
+    """
+    Запускает очистку БД: удаление старых стикеров, перенос старых поставок в архив
+    и возврат освободившегося места. Присылает администратору результат
+    """
+    outbox.send_message(message.chat.id, 'Очистка БД запущена')
+    report = retention_job.run()
+    if report is None:
+        outbox.send_message(message.chat.id, 'Очистка БД уже выполняется')
+        return
+    outbox.send_message(message.chat.id, report.format())
+
+
+@bot.message_handler(commands=['shipping'])
+@track_handler
+@check_registration(ask_for_registration)
+def show_shipping_report(message: Message):
+    """
+    Показывает отгрузки текущего аккаунта за 7 дней, /shipping week - за 8 недель.
+    Отчёт строится по сводным таблицам, которые обновляются при синхронизации и закрытии поставок
+    """
+    by_weeks = message.text.split()[1:2] == ['week']
+    outbox.send_message(message.chat.id, format_shipping_report(by_weeks))
+
+
+@bot.message_handler(commands=['shipping_rebuild'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def rebuild_shipping_report(message: Message):
+    """
+    Пересчитывает сводные таблицы отгрузок всех аккаунтов по заказам в БД и в архиве
+    """
+    supplies_count, orders_count = rebuild_shipping_stats()
+    outbox.send_message(
+        message.chat.id,
+        f'Сводка отгрузок пересчитана: поставок {supplies_count}, заказов {orders_count}')
+
+
+@bot.message_handler(commands=['startup'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def show_startup_report(message: Message):
+    """
+    Показывает администратору время этапов запуска и самые долгие импорты модулей
+    """
+    outbox.send_message(message.chat.id, startup.format_report())
+
+
+@bot.message_handler(commands=['profiles'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def show_profiles(message: Message):
+    """
+    Показывает администратору список последних сохранённых профилей.
+    /profile N присылает файлы профиля с номером N
+    """
+    profiles = get_profiles()
+    if not profiles:
+        outbox.send_message(message.chat.id, 'Сохранённых профилей нет. Профилирование включается PROFILING=1')
+        return
+    joined_profiles = '\n'.join(f'{number}. {name}' for number, name in enumerate(profiles, start=1))
+    outbox.send_message(message.chat.id, f'Последние профили:\n{joined_profiles}\n\n/profile N - получить файлы')
+
+
+@bot.message_handler(commands=['profile'])
+@track_handler
+@check_registration(send_message_on_rights_error, is_admin=True)
+def send_profile(message: Message):
+    """
+    Присылает администратору файлы профиля (.prof и снимок памяти) по номеру из /profiles
+    """
+    profiles = get_profiles()
+    try:
+        profile_name = profiles[int(message.text.split()[1]) - 1]
+    except (IndexError, ValueError):
+        outbox.send_message(message.chat.id, 'Укажите номер профиля из списка /profiles, например /profile 1')
+        return
+    for path in get_profile_files(profile_name):
+        with open(path, 'rb') as file:
+            outbox.send_document(message.chat.id, file)
+
+
 @bot.message_handler(regexp='Основное меню')
 @bot.message_handler(commands=['start'])
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def start(message: Message):
     """
@@ -127,18 +325,61 @@ def start(message: Message):
     @param message:
     """
     user = get_user(message.chat.id)
-    buttons = ['Показать поставки', 'Новые заказы']
+    buttons = ['Показать поставки', 'Новые заказы', 'Уведомления о новых заказах']
+    text = 'Основное меню'
+    if len(get_user_accounts(user)) > 1:
+        buttons.append('Сменить аккаунт')
+        text = f'Основное меню. Аккаунт: {get_current_account()}'
     if user.is_admin:
         buttons.append('Управление пользователями')
     supplies_markup = make_menu_from_list(buttons)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
-        text='Основное меню',
+        text=text,
         reply_markup=supplies_markup
     )
 
 
+@bot.message_handler(regexp='Сменить аккаунт')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def choose_account(message: Message):
+    """
+    Предлагает выбрать аккаунт продавца, с которым работать
+    """
+    current_account = get_current_account()
+    accounts_markup = quick_markup({
+        f'{"✅ " if account == current_account else ""}{account}': {
+            'callback_data': router.callback_data('acc', account)}
+        for account in get_user_accounts(get_user(message.chat.id))
+    }, row_width=1)
+    outbox.send_message(
+        message.chat.id,
+        text='Выберите аккаунт',
+        reply_markup=accounts_markup)
+
+
+@router.route('acc')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def switch_account(call: CallbackQuery, account: str):
+    """
+    Переключает пользователя на аккаунт продавца
+    @param account: Имя аккаунта
+    """
+    if account not in get_user_accounts(get_user(call.message.chat.id)):
+        bot.answer_callback_query(call.id, 'Нет доступа к аккаунту')
+        return
+    set_user_account(call.message.chat.id, account)
+    bot.answer_callback_query(call.id, f'Аккаунт: {account}')
+    outbox.send_message(call.message.chat.id, f'Вы работаете с аккаунтом {account}')
+
+
 @bot.message_handler(regexp='Показать поставки')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def show_active_supplies(message: Message):
     """
@@ -151,7 +392,7 @@ def show_active_supplies(message: Message):
         send_message_on_error(ex, message)
         return
 
-    bot.send_message(
+    outbox.send_message(
         chat_id=message.chat.id,
         text='Текущие незакрытые поставки',
         reply_markup=create_supplies_markup(
@@ -159,46 +400,66 @@ def show_active_supplies(message: Message):
             show_create_new=True
         )
     )
-    bulk_insert_supplies(active_supplies)
 
 
 @bot.message_handler(regexp='Новые заказы')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def show_new_orders(message: Message):
     """
     Запрашивает новые заказы, отправляет клиенту в виде кнопок
     """
-    try:
-        new_orders = get_new_orders()
-    except (HTTPError, WBAPIError) as ex:
-        send_message_on_error(ex, message)
-        return
+    new_orders = new_orders_poller.get_recent_orders()
+    if new_orders is None:
+        try:
+            new_orders = get_new_orders()
+        except (HTTPError, WBAPIError) as ex:
+            send_message_on_error(ex, message)
+            return
+        insert_new_orders(new_orders)
 
     orders_markup = create_orders_markup(new_orders)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         'Новые заказы:\n(Артикул | Время с момента заказа)',
         reply_markup=orders_markup
     )
-    bulk_insert_orders(new_orders)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('order_'))
+@bot.message_handler(regexp='Уведомления о новых заказах')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def switch_new_orders_notifications(message: Message):
+    """
+    Включает или выключает уведомления о новых заказах
+    """
+    if toggle_subscription(message.chat.id):
+        text = 'Уведомления о новых заказах включены'
+    else:
+        text = 'Уведомления о новых заказах выключены'
+    outbox.send_message(message.chat.id, text)
+
+
+@router.route('o')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def show_order_details(call: CallbackQuery):
+def show_order_details(call: CallbackQuery, order_id: str):
     """
     Показывает детали заказа и прелагает переместить его в поставку
     @param call:
+    @param order_id: ID заказа
     """
-    order_id = call.data.lstrip('order_')
     order = get_order_by_id(int(order_id))
     bot.answer_callback_query(call.id, f'Информация по заказу {order.id}')
     order_markup = quick_markup(
         {
-            'Перенести в поставку': {'callback_data': f'move_to_supply_{order.id}'}
+            'Перенести в поставку': {'callback_data': router.callback_data('mv', order.id)}
         }
     )
-    bot.send_message(
+    outbox.send_message(
         call.message.chat.id,
         f'Номер заказа: {order.id}\n'
         f'Поставка: {order.supply}\n'
@@ -208,15 +469,16 @@ def show_order_details(call: CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('move_to_supply_'))
+@router.route('mv')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def move_order_to_supply(call: CallbackQuery):
+def move_order_to_supply(call: CallbackQuery, order_id: str):
     """
     Предлагает выбрать поставку, в которую добавится заказ
     @param call:
+    @param order_id: ID заказа
     """
-    order_id = call.data.lstrip('move_to_supply_')
-
     try:
         active_supplies = get_supplies()
     except (HTTPError, WBAPIError) as ex:
@@ -228,7 +490,7 @@ def move_order_to_supply(call: CallbackQuery):
     else:
         bot.answer_callback_query(call.id, 'Нет активных поставок')
 
-    bot.send_message(
+    outbox.send_message(
         chat_id=call.message.chat.id,
         text='Выберите поставку',
         reply_markup=create_supplies_markup(
@@ -239,16 +501,17 @@ def move_order_to_supply(call: CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('append_o_to_s_'))
+@router.route('ap')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def append_order_to_supply(call: CallbackQuery):
+def append_order_to_supply(call: CallbackQuery, order_id: str, supply_id: str):
     """
     Добавляет заказ к поставке
     @param call:
+    @param order_id: ID заказа
+    @param supply_id: ID поставки
     """
-    order_id = re.search(r'_\d+_', call.data).group().strip('_')
-    supply_id = call.data.lstrip(f'append_o_to_s_{order_id}_')
-
     try:
         add_order_to_supply(supply_id, order_id)
     except (HTTPError, WBAPIError) as ex:
@@ -256,18 +519,127 @@ def append_order_to_supply(call: CallbackQuery):
         return
     else:
         bot.answer_callback_query(call.id, 'Добавлено')
-        bot.send_message(call.message.chat.id, 'Заказ добавлен в поставку')
+        outbox.send_message(call.message.chat.id, 'Заказ добавлен в поставку')
+
+
+@router.route('ma')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def choose_orders_to_move(call: CallbackQuery, cursor_id: str):
+    """
+    Предлагает выбрать артикулы для массового переноса новых заказов в поставку.
+    Заказы берутся из сохранённого списка новых заказов
+    @param call:
+    @param cursor_id: ключ курсора списка новых заказов
+    """
+    orders_cursor = cursors.get(cursor_id)
+    if orders_cursor is None:
+        bot.answer_callback_query(call.id, 'Список устарел, запросите его заново')
+        return
+    # Заказы переносятся от имени аккаунта, под которым был получен список, даже если пользователь его сменит
+    move_id = cursors.put(Cursor(
+        kind='move_orders',
+        items=orders_cursor.items,
+        options={'selected': []},
+        account=orders_cursor.account or get_current_account()))
+    bot.answer_callback_query(call.id)
+    outbox.send_message(
+        call.message.chat.id,
+        'Выберите артикулы или перенесите все заказы',
+        reply_markup=create_move_orders_markup(move_id))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('supply_'))
+@router.route('mt')
+@track_handler
 @check_registration(ask_for_registration)
-def handle_orders(call: CallbackQuery):
+def toggle_orders_article(call: CallbackQuery, move_id: str, index: str):
+    """
+    Включает или выключает артикул для массового переноса в том же сообщении
+    @param call:
+    @param move_id: ключ курсора массового переноса
+    @param index: номер артикула
+    """
+    if not toggle_article_to_move(move_id, int(index)):
+        bot.answer_callback_query(call.id, 'Список устарел, запросите его заново')
+        return
+    bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=create_move_orders_markup(move_id))
+    bot.answer_callback_query(call.id)
+
+
+@router.route('mc')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def choose_supply_to_move(call: CallbackQuery, move_id: str):
+    """
+    Предлагает выбрать поставку, в которую перенесутся выбранные заказы
+    @param call:
+    @param move_id: ключ курсора массового переноса
+    """
+    account = get_move_account(move_id)
+    if account is None:
+        bot.answer_callback_query(call.id, 'Список устарел, запросите его заново')
+        return
+    try:
+        with use_account(account):
+            active_supplies = get_supplies()
+    except (HTTPError, WBAPIError) as ex:
+        send_message_on_error(ex, call.message)
+        return
+
+    if active_supplies:
+        bot.answer_callback_query(call.id, 'Поставки загружены')
+    else:
+        bot.answer_callback_query(call.id, 'Нет активных поставок')
+
+    outbox.send_message(
+        chat_id=call.message.chat.id,
+        text='Выберите поставку',
+        reply_markup=create_supplies_markup(
+            active_supplies,
+            show_more_supplies=False,
+            orders_to_move=move_id
+        )
+    )
+
+
+@router.route('mp')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def move_orders_to_supply(call: CallbackQuery, move_id: str, supply_id: str):
+    """
+    Переносит выбранные заказы в поставку несколькими одновременными запросами
+    и присылает один итог переноса
+    @param call:
+    @param move_id: ключ курсора массового переноса
+    @param supply_id: ID поставки
+    """
+    account = get_move_account(move_id)
+    orders = get_orders_to_move(move_id)
+    if account is None or orders is None:
+        bot.answer_callback_query(call.id, 'Список устарел, запросите его заново')
+        return
+    bot.answer_callback_query(call.id, f'Переносим заказов: {len(orders)}')
+    with use_account(account):
+        moved, errors = add_orders_to_supply(supply_id, [order.order_id for order in orders])
+    outbox.send_message(call.message.chat.id, format_move_report(supply_id, moved, errors))
+
+
+@router.route('s')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def handle_orders(call: CallbackQuery, supply_id: str):
     """
     Обработчик заказов.
     Запрашивает заказы по данной поставке, отправляет их одним сообщением клиенту,
     после чего загружает в базу данных
     """
-    supply_id = call.data.lstrip('supply_')
     try:
         orders = get_orders(supply_id)
     except (HTTPError, WBAPIError) as ex:
@@ -275,18 +647,18 @@ def handle_orders(call: CallbackQuery):
     else:
         if orders:
             order_markup = quick_markup({
-                'Создать стикеры': {'callback_data': f'stickers_for_supply_{supply_id}'},
-                'Отправить в доставку': {'callback_data': f'close_supply_{supply_id}'}
+                'Создать стикеры': {'callback_data': router.callback_data('st', supply_id)},
+                'Отправить в доставку': {'callback_data': router.callback_data('cl', supply_id)}
             }, row_width=1)
-            bot.send_message(
+            outbox.send_message(
                 chat_id=call.message.chat.id,
                 text=f'Заказы по поставке {supply_id}:\n\n{join_orders(orders)}',
                 reply_markup=order_markup)
         else:
             order_markup = quick_markup({
-                'Удалить поставку': {'callback_data': f'delete_supply_{supply_id}'}
+                'Удалить поставку': {'callback_data': router.callback_data('ds', supply_id)}
             }, row_width=1)
-            bot.send_message(
+            outbox.send_message(
                 chat_id=call.message.chat.id,
                 text=f'В поставке нет заказов',
                 reply_markup=order_markup)
@@ -295,29 +667,51 @@ def handle_orders(call: CallbackQuery):
         bot.answer_callback_query(call.id, 'Заказы загружены')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('more_supplies'))
+@router.route('pg')
+@track_handler
+@profiled
+@check_registration(ask_for_registration)
+def turn_page(call: CallbackQuery, cursor_id: str, page: str):
+    """
+    Перелистывает страницу списка заказов или поставок в том же сообщении.
+    Список берётся из сохранённого курсора, без повторных запросов к API
+    """
+    page_markup = create_page_markup(cursor_id, int(page))
+    if page_markup is None:
+        bot.answer_callback_query(call.id, 'Список устарел, запросите его заново')
+        return
+    bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=page_markup)
+    bot.answer_callback_query(call.id)
+
+
+@router.route('ms')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def get_supplies_number(call: CallbackQuery):
     """
     Запрашивает количество требуемых поставок
     (если пользователю нужно посмотреть не только текущие открытые поставки, но и более ранние)
     """
-    bot.clear_reply_handlers(call.message)
-    bot.register_next_step_handler(
-        call.message,
-        show_number_of_supplies,
-        call=call)
+    dialogs.start(call.message.chat.id, call.from_user.id, 'supplies_number')
+    bot.answer_callback_query(call.id)
     cancel_markup = ReplyKeyboardMarkup(resize_keyboard=True)
     cancel_markup.add(KeyboardButton('Отмена'))
-    bot.send_message(
+    outbox.send_message(
         chat_id=call.message.chat.id,
-        text='Сколько последних поставок вы хотите посмотреть? (максимум 50)',
+        text=f'Сколько последних поставок вы хотите посмотреть? (максимум {MAX_SUPPLIES_NUMBER})',
         reply_markup=cancel_markup
     )
 
 
+@dialogs.step('supplies_number')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def show_number_of_supplies(message: Message, call: CallbackQuery):
+def show_number_of_supplies(message: Message):
     """
     Отображает требуемое число поставок, начиная с самых поздних
     """
@@ -329,54 +723,57 @@ def show_number_of_supplies(message: Message, call: CallbackQuery):
     try:
         number_of_supplies = int(message_text)
     except ValueError:
-        bot.clear_reply_handlers(call.message)
-        bot.register_next_step_handler(
-            call.message,
-            show_number_of_supplies,
-            call=call)
-        bot.send_message(
-            chat_id=call.message.chat.id,
+        dialogs.start(message.chat.id, message.from_user.id, 'supplies_number')
+        outbox.send_message(
+            chat_id=message.chat.id,
             text='Не понял Вас. Введите ещё раз')
         return
+    if not 1 <= number_of_supplies <= MAX_SUPPLIES_NUMBER:
+        dialogs.start(message.chat.id, message.from_user.id, 'supplies_number')
+        outbox.send_message(
+            chat_id=message.chat.id,
+            text=f'Введите число от 1 до {MAX_SUPPLIES_NUMBER}')
+        return
 
-    bot.answer_callback_query(call.id, 'Идёт загрузка. Подождите')
     try:
         supplies = get_supplies(
             only_active=False,
             limit=number_of_supplies)
     except (HTTPError, WBAPIError) as ex:
-        send_message_on_error(ex, call.message)
+        send_message_on_error(ex, message)
     else:
-        bot.send_message(
-            chat_id=call.message.chat.id,
+        outbox.send_message(
+            chat_id=message.chat.id,
             text=f'Последние {number_of_supplies} поставок',
             reply_markup=create_supplies_markup(
                 supplies,
                 show_create_new=True
             )
         )
-        bulk_insert_supplies(supplies)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('create_supply'))
+@router.route('cs')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def delete_supply(call: CallbackQuery):
     """
     Запрашивает имя новой поставки
     """
-    bot.clear_reply_handlers(call.message)
-    bot.register_next_step_handler(
-        call.message,
-        create_supply)
+    dialogs.start(call.message.chat.id, call.from_user.id, 'supply_name')
+    bot.answer_callback_query(call.id)
     cancel_markup = ReplyKeyboardMarkup(resize_keyboard=True)
     cancel_markup.add(KeyboardButton('Отмена'))
-    bot.send_message(
+    outbox.send_message(
         chat_id=call.message.chat.id,
         text='Введите название новой поставки',
         reply_markup=cancel_markup
     )
 
 
+@dialogs.step('supply_name')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
 def create_supply(message: Message):
     """
@@ -391,19 +788,20 @@ def create_supply(message: Message):
     except (HTTPError, WBAPIError) as ex:
         send_message_on_error(ex, message)
     else:
-        bot.send_message(
+        outbox.send_message(
             chat_id=message.chat.id,
             text=f'Новая поставка {new_supply_id} успешно создана')
         show_active_supplies(message)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('delete_supply_'))
+@router.route('ds')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def delete_supply(call: CallbackQuery):
+def delete_supply(call: CallbackQuery, supply_id: str):
     """
     Удаляет поставку
     """
-    supply_id = call.data.lstrip('delete_supply_')
     try:
         delete_supply_by_id(supply_id)
     except (HTTPError, WBAPIError) as ex:
@@ -414,22 +812,26 @@ def delete_supply(call: CallbackQuery):
         show_active_supplies(call.message)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('close_supply_'))
+@router.route('cl')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def close_supply(call: CallbackQuery):
+def close_supply(call: CallbackQuery, supply_id: str):
     """
     Отправляет поставку в доставку и присылает пользователю QR код
     """
-    supply_id = call.data.lstrip('close_supply_')
+    from stickers import save_image_from_str_to_png, rotate_image
+
     try:
         status_code = send_supply_to_deliver(supply_id)
         if status_code != 204:
-            raise WBAPIError(message=call.data, code=status_code)
+            raise WBAPIError(message=f'Не удалось отправить в доставку поставку {supply_id}', code=status_code)
     except (HTTPError, WBAPIError) as ex:
         send_message_on_error(ex, call.message)
         return
     else:
         bot.answer_callback_query(call.id, 'Отправлено в доставку')
+        mark_supply_closed(supply_id)
 
         supply_sticker = get_supply_sticker(supply_id)
 
@@ -439,19 +841,21 @@ def close_supply(call: CallbackQuery):
         save_image_from_str_to_png(supply_sticker.image_string, image_file_path)
         rotate_image(image_file_path)
         with open(image_file_path, 'rb') as image:
-            bot.send_photo(call.message.chat.id, image)
+            outbox.send_photo(call.message.chat.id, image)
     finally:
         delete_temp_sticker_files()
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('stickers_for_supply_'))
+@router.route('st')
+@track_handler
+@profiled
 @check_registration(ask_for_registration)
-def send_stickers(call: CallbackQuery):
+def send_stickers(call: CallbackQuery, supply_id: str):
     """
     Подготавливает и отправляет пользователю стикеры по данной поставке
     """
-    supply_id = call.data.lstrip('stickers_for_supply_')
     bot.answer_callback_query(call.id, 'Запущена подготовка стикеров. Подождите')
+    sticker_file_name = None
     try:
         add_stickers_and_products_to_orders(supply_id)
         sticker_file_name, stickers_report = prepare_stickers(supply_id=supply_id)
@@ -460,16 +864,33 @@ def send_stickers(call: CallbackQuery):
         return
     else:
         with open(sticker_file_name, 'rb') as file:
-            bot.send_document(call.message.chat.id, file)
+            outbox.send_document(call.message.chat.id, file)
         if failed_stickers := stickers_report['failed']:
             missing_articles = "\n".join(failed_stickers)
             message_text = f'Стикеры по поставке {supply_id}.\n' \
                            f'Не удалось создать стикеры для товаров:\n{missing_articles}'
         else:
             message_text = f'Стикеры по поставке {supply_id}'
-        bot.send_message(call.message.chat.id, message_text)
+        outbox.send_message(call.message.chat.id, message_text)
     finally:
-        delete_temp_sticker_files()
+        delete_temp_sticker_files(sticker_file_name)
+
+
+@router.route('noop')
+def do_nothing(call: CallbackQuery):
+    """
+    Обработчик кнопок без действия (например, номер текущей страницы)
+    """
+    bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def dispatch_callback(call: CallbackQuery):
+    """
+    Передаёт нажатие на inline кнопку обработчику из таблицы маршрутов
+    """
+    if not router.dispatch(call):
+        bot.answer_callback_query(call.id, 'Кнопка устарела, запросите список заново')
 
 
 def main():
@@ -478,9 +899,21 @@ def main():
     except ValueError:
         print('OWNER_ID должен быть целым числом')
         return
-    prepare_db(
-        owner_id=owner_id,
-        owner_full_name=os.environ['OWNER_FULL_NAME'])
+    if WB_CASSETTE_MODE != 'replay' and not all(get_accounts().values()):
+        print('Не заданы API ключи: WB_API_KEY или WB_ACCOUNTS в формате имя=ключ,...')
+        return
+    with db.connection_context():
+        prepare_db(
+            owner_id=owner_id,
+            owner_full_name=os.environ['OWNER_FULL_NAME'])
+    startup.mark('db')
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+    outbox.start()
+    new_orders_poller.start()
+    retention_job.start()
+    startup.mark('ready')
+    if STARTUP_REPORT:
+        startup.log_report()
     bot.infinity_polling()
 
 
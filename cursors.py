@@ -0,0 +1,67 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from config import CURSOR_CACHE_SIZE, CURSOR_TTL
+from metrics import count_cache_request
+
+
+@dataclass
+class Cursor:
+    """Полный результат запроса, который показывается пользователю по страницам.
+    options передаются функции, которая рисует страницу, account - аккаунт, под которым получен список
+    """
+    kind: str
+    items: list
+    options: dict = field(default_factory=dict)
+    account: str = None
+
+
+class CursorStore:
+    """Потокобезопасное хранилище значений под короткими случайными ключами.
+    Старые записи вытесняются по количеству и по времени жизни.
+    """
+
+    def __init__(self, name: str, max_size: int = CURSOR_CACHE_SIZE, ttl: float = CURSOR_TTL):
+        """
+        @param name: Название хранилища для метрик
+        @param max_size: Максимальное количество хранимых записей
+        @param ttl: Время жизни записи в секундах
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value) -> str:
+        """Сохраняет значение
+        @param value: Сохраняемое значение
+        @return: Ключ, по которому значение можно получить
+        """
+        key = secrets.token_urlsafe(6)
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return key
+
+    def get(self, key: str):
+        """Достаёт значение по ключу
+        @param key: Ключ, полученный от put
+        @return: Сохранённое значение или None, если запись не найдена или устарела
+        """
+        with self._lock:
+            saved = self._items.get(key)
+            if saved is not None and time.monotonic() - saved[0] > self.ttl:
+                del self._items[key]
+                saved = None
+            if saved is not None:
+                self._items.move_to_end(key)
+        count_cache_request(self.name, hit=saved is not None)
+        return saved[1] if saved is not None else None
+
+
+cursors = CursorStore('cursors')
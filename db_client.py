@@ -1,18 +1,32 @@
+import datetime
+import json
 import os
+from collections import Counter
 
 import pytz
-from peewee import ModelSelect
+from peewee import CharField, EXCLUDED, ModelSelect, PostgresqlDatabase, SqliteDatabase, chunked, fn
+from playhouse.migrate import SqliteMigrator, migrate
+from telebot.handler_backends import BaseMiddleware
 
+from api.accounts import DEFAULT_ACCOUNT, get_accounts, get_current_account
 from api.classes import Supply, Order, Product, Sticker
-from models import db, UserModel, SupplyModel, OrderModel, ProductModel
+from metrics import track_db
+from models import db, UserModel, SupplyModel, OrderModel, ProductModel, SubscriptionModel, SupplyPageModel
+from models import UserAccountModel, SupplyArchiveModel, OrderArchiveModel, ALL_MODELS
+from models import SupplyStatsModel, ArticleDayStatsModel, TelegramFileModel
 
 
+@track_db
 def prepare_db(owner_id: int, owner_full_name: str):
     """Создает БД. Регистрирует владельца как единственного администратора
     @param owner_id: Telegram ID владельца бота
     @param owner_full_name: Полное имя владельца бота
     """
-    db.create_tables([UserModel, SupplyModel, OrderModel, ProductModel])
+    _migrate_to_accounts()
+    if isinstance(db.obj, SqliteDatabase):
+        # Действует только для новой БД, существующая переводится на инкрементальную очистку в compact_db
+        db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    db.create_tables(ALL_MODELS)
     UserModel.update({'is_admin': False}) \
         .where(UserModel.is_admin, UserModel.id != owner_id) \
         .execute()
@@ -23,15 +37,70 @@ def prepare_db(owner_id: int, owner_full_name: str):
     ).on_conflict_ignore().execute()
 
 
+def _migrate_to_accounts():
+    """Переводит БД, созданную до появления аккаунтов продавца, на новую схему.
+    Все данные относятся к аккаунту default. Товары и заказы переносятся в новые таблицы,
+    потому что у товаров сменился первичный ключ, а кеш страниц поставок создаётся заново.
+    Старая схема бывает только у SQLite, другие БД создаются сразу по новой
+    """
+    if not isinstance(db.obj, SqliteDatabase):
+        return
+    if not db.table_exists(SupplyModel._meta.table_name):
+        return
+    if 'account' in {column.name for column in db.get_columns(SupplyModel._meta.table_name)}:
+        return
+
+    migrator = SqliteMigrator(db)
+    with db.atomic():
+        migrate(
+            migrator.add_column(UserModel._meta.table_name, 'account', UserModel.account),
+            # Индекс по аккаунту создаст create_tables, под тем же именем, что и в новой БД
+            migrator.add_column(SupplyModel._meta.table_name, 'account', CharField(64, default=DEFAULT_ACCOUNT)))
+        db.drop_tables([SupplyPageModel])
+
+        old_tables = {}
+        for model in (ProductModel, OrderModel):
+            table_name = model._meta.table_name
+            old_tables[model] = f'{table_name}_old'
+            for index in db.get_indexes(table_name):
+                if index.sql:  # автоматические индексы первичного ключа удаляются вместе с таблицей
+                    db.execute_sql(f'DROP INDEX IF EXISTS "{index.name}"')
+            db.execute_sql(f'ALTER TABLE "{table_name}" RENAME TO "{old_tables[model]}"')
+        db.create_tables([ProductModel, OrderModel, SupplyPageModel])
+
+        db.execute_sql(
+            f'INSERT INTO "{ProductModel._meta.table_name}" (account, article, barcode, name) '
+            f'SELECT ?, article, barcode, name FROM "{old_tables[ProductModel]}"',
+            (DEFAULT_ACCOUNT,))
+        db.execute_sql(
+            f'INSERT INTO "{OrderModel._meta.table_name}" '
+            f'(id, account, supply_id, product_id, sticker, sticker_path, created_at) '
+            f'SELECT orders.id, ?, orders.supply_id, products.id, orders.sticker, orders.sticker_path, '
+            f'orders.created_at FROM "{old_tables[OrderModel]}" AS orders '
+            f'JOIN "{ProductModel._meta.table_name}" AS products ON products.article = orders.product_id',
+            (DEFAULT_ACCOUNT,))
+        for old_table in old_tables.values():
+            db.execute_sql(f'DROP TABLE "{old_table}"')
+
+
+@track_db
 def insert_user(user_id: int | str, user_full_name: str) -> UserModel:
     """Регистрирует пользователя в базе
     @param user_id: Telegram ID пользователя
     @param user_full_name: Полное имя пользователя
     @return: Объект пользователя из БД
     """
-    return UserModel.insert(id=user_id, full_name=user_full_name).on_conflict_replace().execute()
+    return UserModel.insert(
+        id=user_id,
+        full_name=user_full_name
+    ).on_conflict(
+        conflict_target=[UserModel.id],
+        preserve=[UserModel.full_name, UserModel.registered_at, UserModel.is_admin, UserModel.is_active,
+                  UserModel.account]
+    ).execute()
 
 
+@track_db
 def get_user(user_id: int | str) -> UserModel:
     """Достает пользователя из базы
     @param user_id: Telegram ID пользователя
@@ -40,6 +109,7 @@ def get_user(user_id: int | str) -> UserModel:
     return UserModel.get_or_none(UserModel.id == user_id)
 
 
+@track_db
 def get_all_users() -> ModelSelect:
     """Достает всех пользователей из базы
     @return: Объект пользователя из БД
@@ -47,25 +117,96 @@ def get_all_users() -> ModelSelect:
     return UserModel.select()
 
 
+@track_db
 def bulk_insert_supplies(supplies: list[Supply]):
-    """Добавляет поставки в базу
+    """Добавляет поставки в базу. У уже известных поставок обновляются название и статус
     @param supplies: список поставок, представленных как результаты парсинга
     запросов к API
     """
-    supplies_rows = [supply.to_tuple() for supply in supplies]
+    account = get_current_account()
+    supplies_rows = [(*supply.to_tuple(), account) for supply in supplies]
+    done_supply_ids = [supply.supply_id for supply in supplies if supply.is_done]
     supplies_fields = [
         SupplyModel.id,
         SupplyModel.name,
         SupplyModel.closed_at,
         SupplyModel.created_at,
-        SupplyModel.is_done]
+        SupplyModel.is_done,
+        SupplyModel.account]
     with db.atomic():
         SupplyModel.insert_many(
             rows=supplies_rows,
             fields=supplies_fields
-        ).on_conflict_ignore().execute()
+        ).on_conflict(
+            conflict_target=[SupplyModel.id],
+            preserve=[SupplyModel.name, SupplyModel.closed_at, SupplyModel.is_done]
+        ).execute()
+
+    # Поставки, закрытые не через бота, попадают в сводку отгрузок при обновлении списка поставок
+    for ids_chunk in chunked(done_supply_ids, 500):
+        for supply_id, in SupplyStatsModel.select(SupplyStatsModel.supply_id).distinct() \
+                .where(SupplyStatsModel.supply_id.in_(ids_chunk), SupplyStatsModel.day.is_null()) \
+                .tuples():
+            refresh_supply_stats(supply_id)
+
+
+@track_db
+def get_supply_pages() -> list[SupplyPageModel]:
+    """Достаёт из базы известные заполненные страницы списка поставок текущего аккаунта
+    @return: страницы в порядке следования в API (от старых поставок к новым)
+    """
+    return list(SupplyPageModel.select()
+                .where(SupplyPageModel.account == get_current_account())
+                .order_by(SupplyPageModel.cursor))
+
+
+@track_db
+def save_supply_page(cursor: int, next_cursor: int, supplies: list[Supply]):
+    """Сохраняет заполненную страницу списка поставок
+    @param cursor: значение next, с которым запрашивалась страница
+    @param next_cursor: значение next для следующей страницы
+    @param supplies: поставки страницы в порядке API
+    """
+    SupplyPageModel.insert(
+        account=get_current_account(),
+        cursor=cursor,
+        next_cursor=next_cursor,
+        supply_ids=json.dumps([supply.supply_id for supply in supplies]),
+        all_done=all(supply.is_done for supply in supplies)
+    ).on_conflict(
+        conflict_target=[SupplyPageModel.account, SupplyPageModel.cursor],
+        preserve=[SupplyPageModel.next_cursor, SupplyPageModel.supply_ids, SupplyPageModel.all_done]
+    ).execute()
 
 
+@track_db
+def select_supplies_by_ids(supply_ids: list[str]) -> list[Supply]:
+    """Выгружает из базы поставки в порядке переданных id.
+    Поставки, перенесённые в архив, берутся из архива, а которых нет в базе - пропускаются
+    @param supply_ids: список ID поставок
+    @return: список поставок, представленных как результаты парсинга
+    запросов к API
+    """
+    supplies_by_id = {}
+    account = get_current_account()
+    for model in (SupplyModel, SupplyArchiveModel):
+        missing_ids = [supply_id for supply_id in supply_ids if supply_id not in supplies_by_id]
+        for ids_chunk in chunked(missing_ids, 500):
+            for supply in model.select() \
+                    .where(model.id.in_(ids_chunk), model.account == account) \
+                    .dicts():
+                supplies_by_id[supply['id']] = {
+                    'id': supply['id'],
+                    'name': supply['name'],
+                    'closedAt': supply['closed_at'],
+                    'createdAt': supply['created_at'],
+                    'done': supply['is_done']}
+    return Supply.parse_list(
+        [supplies_by_id[supply_id] for supply_id in supply_ids if supply_id in supplies_by_id],
+        validate=False)
+
+
+@track_db
 def bulk_insert_orders(orders: list[Order], supply_id: str = None):
     """Загружает в базу все заказы и продукты по данной поставке
     @param orders: список заказов, представленных как результаты парсинга
@@ -73,46 +214,96 @@ def bulk_insert_orders(orders: list[Order], supply_id: str = None):
     @param supply_id: ID поставки
     """
     OrderModel.delete().where(OrderModel.supply == supply_id)
-    products_rows = [[order.article] for order in orders]
+    account = get_current_account()
+    articles = list({order.article for order in orders})
     with db.atomic():
         ProductModel.insert_many(
-            rows=products_rows,
-            fields=[ProductModel.article]
+            rows=[[account, article] for article in articles],
+            fields=[ProductModel.account, ProductModel.article]
         ).on_conflict_ignore().execute()
+    product_ids = {}
+    for articles_chunk in chunked(articles, 500):
+        product_ids.update(
+            ProductModel.select(ProductModel.article, ProductModel.id)
+            .where(ProductModel.account == account, ProductModel.article.in_(articles_chunk))
+            .tuples())
 
     orders_data = []
     for order in orders:
-        product = ProductModel.get(ProductModel.article == order.article)
         orders_data.append(
             [order.order_id,
-             product,
+             account,
+             product_ids[order.article],
              order.created_at.astimezone(pytz.timezone('Europe/Samara')).strftime('%Y-%m-%d %H:%M:%S'),
              supply_id,
              os.path.join('stickers', f'{order.order_id}.png')])
     order_fields = [
         OrderModel.id,
+        OrderModel.account,
         OrderModel.product,
         OrderModel.created_at,
         OrderModel.supply,
         OrderModel.sticker_path]
     with db.atomic():
-        OrderModel.insert_many(rows=orders_data, fields=order_fields).on_conflict_replace().execute()
+        OrderModel.insert_many(
+            rows=orders_data,
+            fields=order_fields
+        ).on_conflict(
+            conflict_target=[OrderModel.id],
+            preserve=order_fields[1:],
+            update={OrderModel.sticker: None}
+        ).execute()
+    if supply_id is not None:
+        refresh_supply_stats(supply_id)
 
 
+@track_db
+def select_known_order_ids(order_ids: list[int]) -> set[int]:
+    """Находит среди переданных id заказы, которые уже есть в базе.
+    Поиск идёт по первичному ключу, поэтому не требует просмотра всей таблицы
+    @param order_ids: Список id заказов
+    @return: Множество id заказов, уже сохранённых в БД
+    """
+    known_ids = set()
+    for ids_chunk in chunked(order_ids, 500):
+        known_ids.update(
+            order_id for order_id, in OrderModel.select(OrderModel.id)
+            .where(OrderModel.id.in_(ids_chunk))
+            .tuples())
+    return known_ids
+
+
+@track_db
+def insert_new_orders(orders: list[Order]) -> list[Order]:
+    """Добавляет в базу только те заказы, которых в ней ещё нет
+    @param orders: список заказов, представленных как результаты парсинга
+    запросов к API
+    @return: список добавленных (ранее неизвестных) заказов
+    """
+    known_ids = select_known_order_ids([order.order_id for order in orders])
+    new_orders = [order for order in orders if order.order_id not in known_ids]
+    if new_orders:
+        bulk_insert_orders(new_orders)
+    return new_orders
+
+
+@track_db
 def set_products_name_and_barcode(products: list[Product]):
     """
-    Добавляет к товарам в БД данные: наименование и штрихкод.
+    Добавляет к товарам текущего аккаунта в БД данные: наименование и штрихкод.
     Все товары должны быть уже созданы в БД
     @param products: список товаров, представленных как результаты парсинга
     запросов к API
     """
+    account = get_current_account()
     for product in products:
         ProductModel.update(
             {ProductModel.name: product.name,
              ProductModel.barcode: product.barcode}
-        ).where(ProductModel.article == product.article).execute()
+        ).where(ProductModel.account == account, ProductModel.article == product.article).execute()
 
 
+@track_db
 def add_stickers_to_db(stickers: list[Sticker]):
     """Заполняет у заказов в БД поле со стикером
     @param stickers: список стикеров, представленных как результаты парсинга
@@ -123,6 +314,7 @@ def add_stickers_to_db(stickers: list[Sticker]):
             where(OrderModel.id == sticker.order_id).execute()
 
 
+@track_db
 def select_orders_by_supply(supply_id: str) -> ModelSelect:
     """
     Выгружает из БД все заказы по данной поставке
@@ -132,6 +324,7 @@ def select_orders_by_supply(supply_id: str) -> ModelSelect:
     return OrderModel.select().where(OrderModel.supply_id == supply_id)
 
 
+@track_db
 def get_order_by_id(order_id: int) -> OrderModel | None:
     """
     Выгружает из БД все заказы по данной поставке
@@ -141,6 +334,7 @@ def get_order_by_id(order_id: int) -> OrderModel | None:
     return OrderModel.get_or_none(OrderModel.id == order_id)
 
 
+@track_db
 def check_user_registration(user_id: int, is_admin: bool = False) -> UserModel | None:
     """Проверяет зарегистрирован ли пользователь в БД
     @param user_id: Telegram ID пользователя
@@ -152,7 +346,431 @@ def check_user_registration(user_id: int, is_admin: bool = False) -> UserModel |
     return UserModel.get_or_none(UserModel.id == user_id)
 
 
+@track_db
 def delete_supply_from_db(supply_id: str):
     supply = SupplyModel.get_or_none(SupplyModel.id == supply_id)
     if supply:
         supply.delete_instance()
+
+
+@track_db
+def toggle_subscription(user_id: int | str) -> bool:
+    """Включает или выключает подписку пользователя на уведомления о новых заказах
+    @param user_id: Telegram ID пользователя
+    @return: True, если после вызова пользователь подписан
+    """
+    deleted = SubscriptionModel.delete().where(SubscriptionModel.user == user_id).execute()
+    if deleted:
+        return False
+    SubscriptionModel.insert(user=user_id).on_conflict_ignore().execute()
+    return True
+
+
+@track_db
+def get_subscribers(account: str = None) -> list[UserModel]:
+    """Достаёт из базы активных пользователей, подписанных на уведомления о новых заказах
+    @param account: Если задан, то возвращаются только пользователи с доступом к аккаунту
+    @return: список пользователей из БД
+    """
+    subscribers = UserModel.select() \
+        .join(SubscriptionModel) \
+        .where(UserModel.is_active == True)
+    if account is None:
+        return list(subscribers)
+    return [user for user in subscribers if account in get_user_accounts(user)]
+
+
+@track_db
+def get_user_accounts(user: UserModel) -> list[str]:
+    """Возвращает аккаунты продавца, доступные пользователю.
+    Администраторам и всем пользователям при единственном аккаунте доступны все аккаунты
+    @param user: Пользователь из БД
+    @return: имена аккаунтов в порядке WB_ACCOUNTS
+    """
+    accounts = list(get_accounts())
+    if user.is_admin or len(accounts) == 1:
+        return accounts
+    granted = {row.account for row in UserAccountModel.select().where(UserAccountModel.user == user.id)}
+    return [account for account in accounts if account in granted]
+
+
+@track_db
+def get_user_current_account(user_id: int | str) -> str | None:
+    """Возвращает аккаунт, с которым сейчас работает пользователь
+    @param user_id: Telegram ID пользователя
+    @return: выбранный аккаунт, первый доступный, если выбор не сделан или доступ отозван,
+    или None, если пользователю не доступен ни один аккаунт
+    """
+    user = UserModel.get_or_none(UserModel.id == user_id)
+    if user is None:
+        return None
+    accounts = get_user_accounts(user)
+    if user.account in accounts:
+        return user.account
+    return accounts[0] if accounts else None
+
+
+@track_db
+def set_user_account(user_id: int | str, account: str):
+    """Запоминает аккаунт, с которым работает пользователь
+    @param user_id: Telegram ID пользователя
+    @param account: Имя аккаунта
+    """
+    UserModel.update({UserModel.account: account}).where(UserModel.id == user_id).execute()
+
+
+@track_db
+def grant_account(user_id: int | str, account: str):
+    """Открывает пользователю доступ к аккаунту продавца
+    @param user_id: Telegram ID пользователя
+    @param account: Имя аккаунта
+    """
+    UserAccountModel.insert(user=user_id, account=account).on_conflict_ignore().execute()
+
+
+@track_db
+def revoke_account(user_id: int | str, account: str) -> bool:
+    """Закрывает пользователю доступ к аккаунту продавца
+    @param user_id: Telegram ID пользователя
+    @param account: Имя аккаунта
+    @return: True, если доступ был
+    """
+    return bool(UserAccountModel.delete()
+                .where(UserAccountModel.user == user_id, UserAccountModel.account == account)
+                .execute())
+
+
+def _select_closed_supply_ids(days: int) -> ModelSelect:
+    """Подзапрос id поставок, закрытых больше days дней назад"""
+    closed_before = datetime.datetime.now() - datetime.timedelta(days=days)
+    return SupplyModel.select(SupplyModel.id).where(SupplyModel.is_done == True, SupplyModel.closed_at < closed_before)
+
+
+@track_db
+def drop_old_stickers(days: int) -> int:
+    """Удаляет стикеры заказов из поставок, закрытых больше days дней назад
+    @param days: Сколько дней хранить стикеры после закрытия поставки
+    @return: количество заказов, у которых удалён стикер
+    """
+    return OrderModel.update({OrderModel.sticker: None}) \
+        .where(OrderModel.supply.in_(_select_closed_supply_ids(days)), OrderModel.sticker.is_null(False)) \
+        .execute()
+
+
+def _archive_orders(condition) -> int:
+    """Переносит в архив заказы, подходящие под условие
+    @return: количество перенесённых заказов
+    """
+    OrderArchiveModel.insert_from(
+        OrderModel.select(OrderModel.id, OrderModel.account, OrderModel.supply, OrderModel.product,
+                          OrderModel.sticker_path, OrderModel.created_at).where(condition),
+        [OrderArchiveModel.id, OrderArchiveModel.account, OrderArchiveModel.supply_id,
+         OrderArchiveModel.product_id, OrderArchiveModel.sticker_path, OrderArchiveModel.created_at]
+    ).on_conflict(
+        conflict_target=[OrderArchiveModel.id],
+        preserve=[OrderArchiveModel.supply_id, OrderArchiveModel.sticker_path, OrderArchiveModel.created_at]
+    ).execute()
+    return OrderModel.delete().where(condition).execute()
+
+
+@track_db
+def archive_old_supplies(days: int) -> tuple[int, int]:
+    """Переносит в архивные таблицы поставки, закрытые больше days дней назад, и их заказы,
+    а также заказы без поставки старше days дней. Стикеры в архив не переносятся
+    @param days: Сколько дней хранить поставку после закрытия в основной таблице
+    @return: количество перенесённых поставок и заказов
+    """
+    created_before = datetime.datetime.now() - datetime.timedelta(days=days)
+    supply_ids = [supply_id for supply_id, in _select_closed_supply_ids(days).tuples()]
+    supplies_count = 0
+    with db.atomic():
+        orders_count = _archive_orders(OrderModel.supply.is_null() & (OrderModel.created_at < created_before))
+        for ids_chunk in chunked(supply_ids, 500):
+            orders_count += _archive_orders(OrderModel.supply.in_(ids_chunk))
+            SupplyArchiveModel.insert_from(
+                SupplyModel.select(SupplyModel.id, SupplyModel.account, SupplyModel.name, SupplyModel.closed_at,
+                                   SupplyModel.created_at, SupplyModel.is_done).where(SupplyModel.id.in_(ids_chunk)),
+                [SupplyArchiveModel.id, SupplyArchiveModel.account, SupplyArchiveModel.name,
+                 SupplyArchiveModel.closed_at, SupplyArchiveModel.created_at, SupplyArchiveModel.is_done]
+            ).on_conflict(
+                conflict_target=[SupplyArchiveModel.id],
+                preserve=[SupplyArchiveModel.name, SupplyArchiveModel.closed_at, SupplyArchiveModel.is_done]
+            ).execute()
+            supplies_count += SupplyModel.delete().where(SupplyModel.id.in_(ids_chunk)).execute()
+    return supplies_count, orders_count
+
+
+def get_db_size() -> int:
+    """Возвращает размер БД в байтах"""
+    if isinstance(db.obj, PostgresqlDatabase):
+        return db.execute_sql('SELECT pg_database_size(current_database())').fetchone()[0]
+    if isinstance(db.obj, SqliteDatabase):
+        page_count, = db.execute_sql('PRAGMA page_count').fetchone()
+        page_size, = db.execute_sql('PRAGMA page_size').fetchone()
+        return page_count * page_size
+    return 0
+
+
+@track_db
+def compact_db():
+    """Возвращает освободившееся место. SQLite переводится на инкрементальную очистку
+    (один раз с полным VACUUM), после чего очищаются только свободные страницы.
+    В PostgreSQL выполняется VACUUM ANALYZE таблиц заказов и поставок: место становится
+    доступно для новых строк, но размер файлов БД почти не меняется
+    """
+    if isinstance(db.obj, SqliteDatabase):
+        auto_vacuum, = db.execute_sql('PRAGMA auto_vacuum').fetchone()
+        if auto_vacuum != 2:
+            db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute_sql('VACUUM')
+        else:
+            # Каждый шаг execute освобождает одну страницу, executescript выполняет прагму до конца
+            db.connection().executescript('PRAGMA incremental_vacuum;')
+    elif isinstance(db.obj, PostgresqlDatabase):
+        # VACUUM нельзя выполнить внутри транзакции
+        connection = db.connection()
+        autocommit = connection.autocommit
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                for model in (OrderModel, SupplyModel):
+                    cursor.execute(f'VACUUM ANALYZE "{model._meta.table_name}"')
+        finally:
+            connection.autocommit = autocommit
+
+
+def _get_shipping_day(closed_at: datetime.datetime | str | None) -> datetime.date | None:
+    """Возвращает день отгрузки поставки по времени её закрытия"""
+    if closed_at is None:
+        return None
+    if isinstance(closed_at, str):
+        closed_at = datetime.datetime.fromisoformat(closed_at)
+    if closed_at.tzinfo is not None:
+        closed_at = closed_at.astimezone(pytz.timezone('Europe/Samara'))
+    return closed_at.date()
+
+
+def _add_to_day_stats(day_units: Counter):
+    """Прибавляет к сводке отгрузок по дням изменения вида {(аккаунт, артикул, день): количество}"""
+    rows = [(account, article, day, units) for (account, article, day), units in day_units.items() if units]
+    for rows_chunk in chunked(rows, 500):
+        ArticleDayStatsModel.insert_many(
+            rows=rows_chunk,
+            fields=[ArticleDayStatsModel.account, ArticleDayStatsModel.article, ArticleDayStatsModel.day,
+                    ArticleDayStatsModel.units]
+        ).on_conflict(
+            conflict_target=[ArticleDayStatsModel.account, ArticleDayStatsModel.article, ArticleDayStatsModel.day],
+            update={ArticleDayStatsModel.units: ArticleDayStatsModel.units + EXCLUDED.units}
+        ).execute()
+
+
+def _write_atomic():
+    """Транзакция, которая сразу берёт блокировку на запись.
+    В SQLite обычная транзакция после чтения не может получить блокировку на запись,
+    пока пишет другое соединение, и падает с database is locked
+    """
+    if isinstance(db.obj, SqliteDatabase):
+        return db.atomic('IMMEDIATE')
+    return db.atomic()
+
+
+@track_db
+def refresh_supply_stats(supply_id: str):
+    """Пересчитывает сводку по поставке из её заказов и переносит разницу в сводку отгрузок по дням.
+    Заказы закрытой поставки считаются отгруженными в день закрытия.
+    Одновременные пересчёты одной поставки выполняются по очереди: в SQLite под блокировкой
+    на запись, в PostgreSQL под блокировкой строки поставки
+    @param supply_id: ID поставки
+    """
+    day_units = Counter()
+    with _write_atomic():
+        supply_query = SupplyModel.select().where(SupplyModel.id == supply_id)
+        if isinstance(db.obj, PostgresqlDatabase):
+            supply_query = supply_query.for_update()
+        supply = supply_query.get_or_none()
+        if supply is None:
+            return
+        day = _get_shipping_day(supply.closed_at) if supply.is_done else None
+        units_by_article = dict(
+            OrderModel.select(ProductModel.article, fn.COUNT(OrderModel.id))
+            .join(ProductModel)
+            .where(OrderModel.supply == supply_id)
+            .group_by(ProductModel.article)
+            .tuples())
+
+        for old_stats in SupplyStatsModel.select().where(SupplyStatsModel.supply_id == supply_id):
+            if old_stats.day is not None:
+                day_units[(old_stats.account, old_stats.article, old_stats.day)] -= old_stats.units
+        if day is not None:
+            for article, units in units_by_article.items():
+                day_units[(supply.account, article, day)] += units
+        SupplyStatsModel.delete().where(SupplyStatsModel.supply_id == supply_id).execute()
+        SupplyStatsModel.insert_many(
+            rows=[(supply_id, supply.account, article, units, day) for article, units in units_by_article.items()],
+            fields=[SupplyStatsModel.supply_id, SupplyStatsModel.account, SupplyStatsModel.article,
+                    SupplyStatsModel.units, SupplyStatsModel.day]
+        ).execute()
+        _add_to_day_stats(day_units)
+
+
+@track_db
+def mark_supply_closed(supply_id: str):
+    """Отмечает поставку закрытой после отправки в доставку и добавляет её заказы в сводку отгрузок
+    @param supply_id: ID поставки
+    """
+    SupplyModel.update({SupplyModel.is_done: True, SupplyModel.closed_at: datetime.datetime.now()}) \
+        .where(SupplyModel.id == supply_id, SupplyModel.is_done == False) \
+        .execute()
+    refresh_supply_stats(supply_id)
+
+
+@track_db
+def rebuild_shipping_stats() -> tuple[int, int]:
+    """Пересчитывает сводки отгрузок всех аккаунтов с нуля по заказам, в том числе архивным
+    @return: количество поставок и отгруженных заказов в сводке
+    """
+    days = {}
+    for model in (SupplyModel, SupplyArchiveModel):
+        for supply_id, account, closed_at, is_done in model.select(
+                model.id, model.account, model.closed_at, model.is_done).tuples():
+            days[supply_id] = (account, _get_shipping_day(closed_at) if is_done else None)
+
+    supply_rows = []
+    day_units = Counter()
+    for order_model, supply_field, product_field in (
+            (OrderModel, OrderModel.supply, OrderModel.product),
+            (OrderArchiveModel, OrderArchiveModel.supply_id, OrderArchiveModel.product_id)):
+        for supply_id, article, units in order_model \
+                .select(supply_field, ProductModel.article, fn.COUNT(order_model.id)) \
+                .join(ProductModel, on=(product_field == ProductModel.id)) \
+                .where(supply_field.is_null(False)) \
+                .group_by(supply_field, ProductModel.article) \
+                .tuples():
+            if supply_id not in days:
+                continue
+            account, day = days[supply_id]
+            supply_rows.append((supply_id, account, article, units, day))
+            if day is not None:
+                day_units[(account, article, day)] += units
+
+    with db.atomic():
+        SupplyStatsModel.delete().execute()
+        ArticleDayStatsModel.delete().execute()
+        for rows_chunk in chunked(supply_rows, 500):
+            SupplyStatsModel.insert_many(
+                rows=rows_chunk,
+                fields=[SupplyStatsModel.supply_id, SupplyStatsModel.account, SupplyStatsModel.article,
+                        SupplyStatsModel.units, SupplyStatsModel.day]
+            ).on_conflict(
+                conflict_target=[SupplyStatsModel.supply_id, SupplyStatsModel.article],
+                update={SupplyStatsModel.units: SupplyStatsModel.units + EXCLUDED.units}
+            ).execute()
+        _add_to_day_stats(day_units)
+    return len({row[0] for row in supply_rows if row[4] is not None}), sum(day_units.values())
+
+
+@track_db
+def get_shipped_by_day(since: datetime.date) -> list[tuple[datetime.date, int]]:
+    """Выгружает из сводки количество отгруженных заказов текущего аккаунта по дням
+    @param since: Первый день периода
+    @return: список (день, количество) по возрастанию дней
+    """
+    return list(ArticleDayStatsModel
+                .select(ArticleDayStatsModel.day, fn.SUM(ArticleDayStatsModel.units))
+                .where(ArticleDayStatsModel.account == get_current_account(), ArticleDayStatsModel.day >= since)
+                .group_by(ArticleDayStatsModel.day)
+                .order_by(ArticleDayStatsModel.day)
+                .tuples())
+
+
+@track_db
+def get_shipped_by_article(since: datetime.date, limit: int) -> list[tuple[str, int]]:
+    """Выгружает из сводки самые отгружаемые артикулы текущего аккаунта
+    @param since: Первый день периода
+    @param limit: Количество артикулов
+    @return: список (артикул, количество), начиная с самых отгружаемых
+    """
+    units = fn.SUM(ArticleDayStatsModel.units)
+    return list(ArticleDayStatsModel
+                .select(ArticleDayStatsModel.article, units)
+                .where(ArticleDayStatsModel.account == get_current_account(), ArticleDayStatsModel.day >= since)
+                .group_by(ArticleDayStatsModel.article)
+                .order_by(units.desc(), ArticleDayStatsModel.article)
+                .limit(limit)
+                .tuples())
+
+
+@track_db
+def get_shipped_supplies(limit: int) -> list[tuple[str, datetime.date, int]]:
+    """Выгружает из сводки последние отгруженные поставки текущего аккаунта
+    @param limit: Количество поставок
+    @return: список (ID поставки, день отгрузки, количество заказов), начиная с последних
+    """
+    return list(SupplyStatsModel
+                .select(SupplyStatsModel.supply_id, SupplyStatsModel.day, fn.SUM(SupplyStatsModel.units))
+                .where(SupplyStatsModel.account == get_current_account(), SupplyStatsModel.day.is_null(False))
+                .group_by(SupplyStatsModel.supply_id, SupplyStatsModel.day)
+                .order_by(SupplyStatsModel.day.desc(), SupplyStatsModel.supply_id.desc())
+                .limit(limit)
+                .tuples())
+
+
+@track_db
+def get_telegram_file_id(content_hash: str, method: str) -> str | None:
+    """Ищет file_id файла, который уже загружался в Telegram
+    @param content_hash: хеш содержимого файла
+    @param method: метод отправки, например send_document
+    @return: file_id или None, если файл не загружался
+    """
+    return TelegramFileModel \
+        .select(TelegramFileModel.file_id) \
+        .where(TelegramFileModel.content_hash == content_hash, TelegramFileModel.method == method) \
+        .scalar()
+
+
+@track_db
+def save_telegram_file_id(content_hash: str, method: str, file_id: str):
+    """Сохраняет file_id загруженного в Telegram файла
+    @param content_hash: хеш содержимого файла
+    @param method: метод отправки, например send_document
+    @param file_id: file_id из ответа Telegram
+    """
+    TelegramFileModel.insert(
+        content_hash=content_hash,
+        method=method,
+        file_id=file_id,
+        uploaded_at=datetime.datetime.now()
+    ).on_conflict(
+        conflict_target=[TelegramFileModel.content_hash, TelegramFileModel.method],
+        preserve=[TelegramFileModel.file_id, TelegramFileModel.uploaded_at]
+    ).execute()
+
+
+@track_db
+def delete_telegram_file_id(content_hash: str, method: str):
+    """Удаляет file_id, который Telegram больше не принимает
+    @param content_hash: хеш содержимого файла
+    @param method: метод отправки, например send_document
+    """
+    TelegramFileModel.delete().where(
+        TelegramFileModel.content_hash == content_hash,
+        TelegramFileModel.method == method
+    ).execute()
+
+
+class DBConnectionMiddleware(BaseMiddleware):
+    """Открывает соединение с БД на время обработки обновления Telegram и закрывает после.
+    Соединение пула при закрытии возвращается в пул.
+    Фильтры обработчиков (например, проверка шага диалога) тоже выполняются внутри
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        db.connect(reuse_if_open=True)
+
+    def post_process(self, message, data, exception):
+        if not db.is_closed():
+            db.close()
@@ -0,0 +1,334 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Ограничение Telegram на длину текста сообщения
+MAX_SUMMARY_LENGTH = 4096
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """Счётчик событий с метками"""
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get_values(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} {value}'
+                for key, value in self.get_values().items()]
+
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            counts, total = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key][1] = total + value
+
+    @contextmanager
+    def time(self, **labels):
+        """Контекстный менеджер замеряет время выполнения блока"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def get_summary(self) -> dict[tuple, dict]:
+        """Возвращает сводку по каждому набору меток
+        @return: {метки: {'count': ..., 'sum': ..., 'p50': ..., 'p95': ...}}.
+        Перцентили оцениваются по верхней границе корзины гистограммы
+        """
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        summary = {}
+        for key, (counts, total) in values.items():
+            count = sum(counts)
+            summary[key] = {
+                'count': count,
+                'sum': total,
+                'p50': self._estimate_quantile(counts, count, 0.5),
+                'p95': self._estimate_quantile(counts, count, 0.95)}
+        return summary
+
+    def _estimate_quantile(self, counts: list[int], count: int, quantile: float) -> float:
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+            cumulative += bucket_count
+            if cumulative >= quantile * count:
+                return bound
+        return float('inf')
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    """Показатель, значение которого вычисляется функцией в момент чтения.
+    Функция возвращает число или словарь {значение метки: число}
+    """
+
+    def __init__(self, name: str, description: str, func: Callable, label_name: str = None, type: str = 'gauge'):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.label_names = (label_name,) if label_name else ()
+        self.type = type
+
+    def get_values(self) -> dict[tuple, float]:
+        values = self.func()
+        if isinstance(values, dict):
+            return {(label,): value for label, value in values.items()}
+        return {(): values}
+
+    def render(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} {value}'
+                for key, value in self.get_values().items()]
+
+
+class Registry:
+    """Реестр показателей"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get_all(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        """Возвращает все показатели в текстовом формате Prometheus"""
+        lines = []
+        for metric in self.get_all():
+            try:
+                metric_lines = metric.render()
+            except Exception:
+                logger.exception('Не удалось получить значение показателя %s', metric.name)
+                continue
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric_lines)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.register(Histogram(
+    'bot_handler_seconds', 'Время работы обработчиков бота', ('handler',)))
+HANDLER_ERRORS = registry.register(Counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках бота', ('handler',)))
+WB_LATENCY = registry.register(Histogram(
+    'wb_request_seconds', 'Время запросов к API Wildberries с учётом повторов', ('endpoint',)))
+WB_ERRORS = registry.register(Counter(
+    'wb_request_errors_total', 'Ошибки запросов к API Wildberries', ('endpoint',)))
+DB_LATENCY = registry.register(Histogram(
+    'db_query_seconds', 'Время работы функций БД', ('function',)))
+DB_ERRORS = registry.register(Counter(
+    'db_query_errors_total', 'Ошибки функций БД', ('function',)))
+STICKER_RENDER_LATENCY = registry.register(Histogram(
+    'sticker_render_seconds', 'Время создания стикеров одного артикула по формату файла', ('format',)))
+CACHE_REQUESTS = registry.register(Counter(
+    'cache_requests_total', 'Обращения к кешам', ('cache', 'result')))
+
+
+def _timed(histogram: Histogram, errors: Counter, label_name: str):
+
+    def timed_decorator(func: Callable):
+        labels = {label_name: func.__name__}
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started_at, **labels)
+
+        return wrapper
+
+    return timed_decorator
+
+
+def track_handler(func: Callable):
+    """Декоратор замеряет время работы и ошибки обработчика бота"""
+    return _timed(HANDLER_LATENCY, HANDLER_ERRORS, 'handler')(func)
+
+
+def track_wb_request(func: Callable):
+    """Декоратор замеряет время и ошибки запроса к API Wildberries"""
+    return _timed(WB_LATENCY, WB_ERRORS, 'endpoint')(func)
+
+
+def track_db(func: Callable):
+    """Декоратор замеряет время работы и ошибки функции БД"""
+    return _timed(DB_LATENCY, DB_ERRORS, 'function')(func)
+
+
+def count_cache_request(cache: str, hit: bool):
+    """Учитывает попадание или промах кеша
+    @param cache: Название кеша
+    @param hit: True, если значение найдено в кеше
+    """
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def get_cache_hit_rates() -> dict[str, float]:
+    """Возвращает долю попаданий для каждого кеша"""
+    requests_count = {}
+    for (cache, result), count in CACHE_REQUESTS.get_values().items():
+        hits, total = requests_count.get(cache, (0, 0))
+        requests_count[cache] = (hits + count * (result == 'hit'), total + count)
+    return {cache: hits / total for cache, (hits, total) in requests_count.items() if total}
+
+
+registry.register(CallbackMetric(
+    'cache_hit_ratio', 'Доля попаданий в кеш', get_cache_hit_rates, label_name='cache'))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer | None:
+    """Запускает HTTP сервер, отдающий показатели по адресу /metrics
+    @param host: Адрес, на котором слушает сервер
+    @param port: Порт сервера. 0 - сервер не запускается
+    @return: запущенный сервер или None
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as ex:
+        logger.error('Не удалось запустить сервер метрик на %s:%s: %s', host, port, ex)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
+
+
+def format_summary(top_rows: int = 10) -> str:
+    """Собирает краткую сводку показателей для отправки в чат.
+    Сводка укладывается в одно сообщение Telegram
+    @param top_rows: Сколько строк с наибольшим суммарным временем показывать в каждом разделе
+    """
+    lines = []
+    sections = [
+        ('Обработчики', HANDLER_LATENCY, HANDLER_ERRORS),
+        ('Запросы к API WB', WB_LATENCY, WB_ERRORS),
+        ('БД', DB_LATENCY, DB_ERRORS)]
+    for title, histogram, errors in sections:
+        summary = histogram.get_summary()
+        if not summary:
+            continue
+        errors_count = errors.get_values()
+        lines.append(f'{title}:')
+        rows = sorted(summary.items(), key=lambda item: -item[1]['sum'])
+        for key, stats in rows[:top_rows]:
+            average = stats['sum'] / stats['count'] * 1000
+            lines.append(
+                f'  {key[0]}: {stats["count"]} шт., ср. {average:.0f} мс, '
+                f'p95 ≤ {stats["p95"] * 1000:.0f} мс, ошибок {errors_count.get(key, 0):.0f}')
+        if len(rows) > top_rows:
+            lines.append(f'  и ещё {len(rows) - top_rows}')
+
+    if hit_rates := get_cache_hit_rates():
+        lines.append('Кеши:')
+        lines.extend(f'  {cache}: {rate:.0%} попаданий' for cache, rate in hit_rates.items())
+
+    other_lines = []
+    for metric in registry.get_all():
+        if not isinstance(metric, CallbackMetric) or metric.name == 'cache_hit_ratio':
+            continue
+        try:
+            values = metric.get_values()
+        except Exception:
+            continue
+        for key, value in values.items():
+            if value:
+                label = f'[{key[0]}]' if key else ''
+                other_lines.append(f'  {metric.name}{label}: {value:g}')
+    if other_lines:
+        lines.append('Прочее:')
+        lines.extend(other_lines)
+    summary_text = '\n'.join(lines) or 'Данных пока нет'
+    if len(summary_text) > MAX_SUMMARY_LENGTH:
+        summary_text = summary_text[:summary_text.rfind('\n', 0, MAX_SUMMARY_LENGTH - 2)] + '\n…'
+    return summary_text
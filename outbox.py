@@ -0,0 +1,265 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from peewee import PeeweeException
+from requests.exceptions import ConnectionError, Timeout
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+from telebot.types import Message
+
+from api.limiter import TokenBucket
+from config import TG_GLOBAL_RATE, TG_CHAT_INTERVAL, TG_SEND_WORKERS, TG_SEND_ATTEMPTS, TG_FILE_ID_CACHE
+from db_client import get_telegram_file_id, save_telegram_file_id, delete_telegram_file_id
+from metrics import count_cache_request
+from models import db
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+# Параметр метода отправки, в котором передаётся файл или его file_id
+FILE_PARAMS = {'send_document': 'document', 'send_photo': 'photo'}
+
+
+@dataclass
+class OutgoingMessage:
+    """Сообщение, ожидающее отправки в Telegram"""
+    method: str
+    chat_id: int | str
+    kwargs: dict
+    attempts: int = field(default=0, compare=False)
+    content_hash: str = field(default=None, compare=False)
+
+    def __post_init__(self):
+        # OWNER_ID из окружения и id из Message должны попадать в один и тот же чат очереди
+        if isinstance(self.chat_id, str) and self.chat_id.lstrip('-').isdigit():
+            self.chat_id = int(self.chat_id)
+
+    def can_merge(self, other: 'OutgoingMessage') -> bool:
+        """Проверяет, можно ли дописать текст другого сообщения к этому
+        @param other: Следующее сообщение в тот же чат
+        """
+        if self.method != 'send_message' or other.method != 'send_message':
+            return False
+        if set(self.kwargs) - {'text', 'parse_mode'}:
+            return False
+        if set(other.kwargs) - {'text', 'parse_mode', 'reply_markup'}:
+            return False
+        if self.kwargs.get('parse_mode') != other.kwargs.get('parse_mode'):
+            return False
+        return len(self.kwargs['text']) + len(other.kwargs['text']) + 2 <= MAX_MESSAGE_LENGTH
+
+    def merge(self, other: 'OutgoingMessage'):
+        """Дописывает текст (и клавиатуру) другого сообщения к этому
+        @param other: Следующее сообщение в тот же чат
+        """
+        self.kwargs['text'] = f'{self.kwargs["text"]}\n\n{other.kwargs["text"]}'
+        if 'reply_markup' in other.kwargs:
+            self.kwargs['reply_markup'] = other.kwargs['reply_markup']
+
+
+def get_file_id(sent: Message) -> str | None:
+    """Достаёт file_id из отправленного документа или фото. У фото берётся самый большой размер
+    @return: file_id или None, если в ответе Telegram нет файла
+    """
+    if sent.photo:
+        return sent.photo[-1].file_id
+    if sent.document:
+        return sent.document.file_id
+    return None
+
+
+class SendQueue:
+    """Очередь исходящих сообщений Telegram.
+    Соблюдает общий лимит отправки и паузу между сообщениями в один чат,
+    склеивает идущие подряд текстовые сообщения в один чат
+    и повторяет отправку при ответе 429 с учётом retry_after.
+    Документы и фото, которые уже загружались, отправляются по сохранённому в БД file_id.
+    Обработчики только ставят сообщения в очередь и не ждут отправки.
+    """
+
+    def __init__(
+            self,
+            bot: TeleBot,
+            global_rate: float = TG_GLOBAL_RATE,
+            chat_interval: float = TG_CHAT_INTERVAL,
+            workers: int = TG_SEND_WORKERS,
+            max_attempts: int = TG_SEND_ATTEMPTS,
+            file_id_cache: bool = TG_FILE_ID_CACHE
+    ):
+        """
+        @param bot: Экземпляр бота, через который отправляются сообщения
+        @param global_rate: Максимум сообщений в секунду для всего бота
+        @param chat_interval: Минимальная пауза между сообщениями в один чат в секундах
+        @param workers: Количество потоков отправки
+        @param max_attempts: Максимальное число попыток отправки одного сообщения
+        @param file_id_cache: Отправлять уже загруженные файлы по file_id
+        """
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.file_id_cache = file_id_cache
+        self._global_bucket = TokenBucket(global_rate, max(int(global_rate), 1))
+        self._chats: dict[int | str, deque[OutgoingMessage]] = {}
+        self._next_send_at: dict[int | str, float] = {}
+        self._busy_chats = set()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        """Запускает потоки отправки"""
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                name=f'SendQueue-{number}',
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def send_message(self, chat_id: int | str, text: str, **kwargs):
+        """Ставит текстовое сообщение в очередь. Параметры как у TeleBot.send_message"""
+        self._put(OutgoingMessage('send_message', chat_id, {'text': text, **kwargs}))
+
+    def send_document(self, chat_id: int | str, document, **kwargs):
+        """Ставит документ в очередь. Параметры как у TeleBot.send_document.
+        Содержимое открытого файла читается сразу, поэтому файл можно закрыть и удалить.
+        """
+        if hasattr(document, 'read'):
+            kwargs.setdefault('visible_file_name', os.path.basename(getattr(document, 'name', '')) or None)
+            document = document.read()
+        content_hash = self._hash_file(document, kwargs.get('visible_file_name'))
+        self._put(OutgoingMessage(
+            'send_document', chat_id, {'document': document, **kwargs}, content_hash=content_hash))
+
+    def send_photo(self, chat_id: int | str, photo, **kwargs):
+        """Ставит фото в очередь. Параметры как у TeleBot.send_photo.
+        Содержимое открытого файла читается сразу, поэтому файл можно закрыть и удалить.
+        """
+        if hasattr(photo, 'read'):
+            photo = photo.read()
+        self._put(OutgoingMessage(
+            'send_photo', chat_id, {'photo': photo, **kwargs}, content_hash=self._hash_file(photo)))
+
+    def _hash_file(self, content, file_name: str = None) -> str | None:
+        """Считает ключ файла для поиска его file_id: хеш содержимого и имени файла,
+        потому что по file_id документ приходит с именем, под которым его загрузили
+        @param content: содержимое файла. Для file_id, ссылки или выключенного кеша ключа нет
+        @param file_name: имя файла
+        """
+        if not self.file_id_cache or not isinstance(content, bytes):
+            return None
+        content_hash = hashlib.sha256(content)
+        if file_name:
+            content_hash.update(file_name.encode())
+        return content_hash.hexdigest()
+
+    @staticmethod
+    def _call_db(func, *args):
+        """Вызывает функцию кеша file_id в отдельном соединении с БД.
+        Ошибка БД не мешает отправке: файл просто загружается заново
+        """
+        try:
+            with db.connection_context():
+                return func(*args)
+        except PeeweeException:
+            logger.exception('Ошибка кеша file_id')
+            return None
+
+    def get_depth(self) -> int:
+        """Возвращает количество сообщений, ожидающих отправки"""
+        with self._condition:
+            return sum(len(messages) for messages in self._chats.values())
+
+    def _put(self, message: OutgoingMessage):
+        with self._condition:
+            self._chats.setdefault(message.chat_id, deque()).append(message)
+            self._condition.notify()
+
+    def _take(self) -> OutgoingMessage:
+        """Забирает из очереди следующее сообщение в чат, в который уже можно писать"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                ready_chats = [
+                    chat_id for chat_id, messages in self._chats.items()
+                    if messages and chat_id not in self._busy_chats]
+                if ready_chats:
+                    chat_id = min(ready_chats, key=lambda chat: self._next_send_at.get(chat, 0))
+                    delay = self._next_send_at.get(chat_id, 0) - now
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+
+            messages = self._chats[chat_id]
+            message = messages.popleft()
+            while messages and message.can_merge(messages[0]):
+                message.merge(messages.popleft())
+            if not messages:
+                del self._chats[chat_id]
+            self._busy_chats.add(chat_id)
+            return message
+
+    def _release(self, message: OutgoingMessage, retry_after: float = None):
+        """Освобождает чат после попытки отправки
+        @param message: Отправленное сообщение
+        @param retry_after: Если указано, сообщение возвращается в начало очереди чата
+        и чат приостанавливается на это время
+        """
+        with self._condition:
+            chat_id = message.chat_id
+            self._busy_chats.discard(chat_id)
+            pause = self.chat_interval if retry_after is None else max(self.chat_interval, retry_after)
+            self._next_send_at[chat_id] = time.monotonic() + pause
+            if retry_after is not None:
+                self._chats.setdefault(chat_id, deque()).appendleft(message)
+            self._forget_idle_chats()
+            self._condition.notify_all()
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, send_at in self._next_send_at.items()
+                        if send_at < now and chat_id not in self._chats]:
+            del self._next_send_at[chat_id]
+
+    def _work(self):
+        while True:
+            message = self._take()
+            retry_after = None
+            file_id = None
+            try:
+                kwargs = message.kwargs
+                if message.content_hash:
+                    file_id = self._call_db(get_telegram_file_id, message.content_hash, message.method)
+                    count_cache_request('telegram_file_id', hit=file_id is not None)
+                    if file_id:
+                        kwargs = {**kwargs, FILE_PARAMS[message.method]: file_id}
+                self._global_bucket.acquire()
+                message.attempts += 1
+                sent = getattr(self.bot, message.method)(message.chat_id, **kwargs)
+                if message.content_hash and not file_id and (sent_file_id := get_file_id(sent)):
+                    self._call_db(save_telegram_file_id, message.content_hash, message.method, sent_file_id)
+            except ApiTelegramException as ex:
+                if file_id and ex.error_code == 400 and message.attempts < self.max_attempts:
+                    # Telegram не принял сохранённый file_id, например после смены токена бота: загружаем файл заново
+                    self._call_db(delete_telegram_file_id, message.content_hash, message.method)
+                    retry_after = 0
+                elif ex.error_code == 429 and message.attempts < self.max_attempts:
+                    retry_after = (ex.result_json.get('parameters') or {}).get('retry_after', 1)
+                else:
+                    logger.error('Не удалось отправить сообщение в чат %s: %s', message.chat_id, ex)
+            except (ConnectionError, Timeout) as ex:
+                if message.attempts < self.max_attempts:
+                    retry_after = message.attempts * self.chat_interval
+                else:
+                    logger.error('Не удалось отправить сообщение в чат %s: %s', message.chat_id, ex)
+            except Exception:
+                logger.exception('Ошибка при отправке сообщения в чат %s', message.chat_id)
+            finally:
+                self._release(message, retry_after)
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+from requests import HTTPError
+
+from api.accounts import get_accounts, get_current_account, use_account
+from api.classes import Order
+from api.errors import WBAPIError
+from api.methods import get_new_orders
+from config import NEW_ORDERS_POLL_INTERVAL
+from db_client import insert_new_orders, get_subscribers
+from metrics import count_cache_request
+from models import db
+from outbox import SendQueue, MAX_MESSAGE_LENGTH
+from utils import create_orders_markup, join_orders
+
+logger = logging.getLogger(__name__)
+
+
+class NewOrdersPoller:
+    """Фоновый опрос новых заказов.
+    Раз в интервал запрашивает /api/v3/orders/new по каждому аккаунту продавца, сравнивает
+    результат с известными заказами в БД и рассылает подписчикам с доступом к аккаунту
+    одно сообщение с появившимися заказами.
+    Последний полученный список заказов используется обработчиком "Новые заказы"
+    вместо повторного запроса к API.
+    """
+
+    def __init__(self, outbox: SendQueue, interval: float = NEW_ORDERS_POLL_INTERVAL):
+        """
+        @param outbox: Очередь исходящих сообщений
+        @param interval: Интервал опроса в секундах. 0 отключает опрос
+        """
+        self.outbox = outbox
+        self.interval = interval
+        self._orders: dict[str, tuple[float, list[Order]]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает опрос в отдельном потоке"""
+        if self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='NewOrdersPoller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает опрос"""
+        self._stop_event.set()
+
+    def get_recent_orders(self) -> list[Order] | None:
+        """Возвращает новые заказы текущего аккаунта из последнего опроса
+        @return: список заказов или None, если опрос выключен или результат устарел
+        """
+        with self._lock:
+            polled_at, orders = self._orders.get(get_current_account(), (0.0, None))
+            is_fresh = orders is not None and time.monotonic() - polled_at <= self.interval * 2
+            orders = list(orders) if is_fresh else None
+        count_cache_request('new_orders', hit=is_fresh)
+        return orders
+
+    def poll(self) -> list[Order]:
+        """Один цикл опроса текущего аккаунта: запрашивает новые заказы,
+        сохраняет неизвестные в БД и оповещает подписчиков
+        @return: список заказов, появившихся с прошлого опроса
+        @raise: HTTPError, WBAPIError
+        """
+        orders = get_new_orders()
+        with self._lock:
+            self._orders[get_current_account()] = (time.monotonic(), orders)
+        new_orders = insert_new_orders(orders)
+        if new_orders:
+            self.notify(new_orders)
+        return new_orders
+
+    def notify(self, new_orders: list[Order]):
+        """Отправляет подписчикам с доступом к текущему аккаунту одно сообщение со всеми новыми заказами
+        @param new_orders: список заказов, представленных как результаты парсинга
+        запросов к API
+        """
+        account = get_current_account()
+        header = f'Новых заказов: {len(new_orders)}\n\n'
+        if len(get_accounts()) > 1:
+            header = f'Аккаунт {account}. {header}'
+        text = header + join_orders(new_orders, max_length=MAX_MESSAGE_LENGTH - len(header))
+        orders_markup = create_orders_markup(new_orders)
+        for user in get_subscribers(account):
+            self.outbox.send_message(
+                user.id,
+                text,
+                reply_markup=orders_markup)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            for account in get_accounts():
+                try:
+                    with use_account(account), db.connection_context():
+                        self.poll()
+                except (HTTPError, WBAPIError) as ex:
+                    logger.warning('Не удалось получить новые заказы аккаунта %s: %s', account, ex)
+                except Exception:
+                    logger.exception('Ошибка при опросе новых заказов аккаунта %s', account)
+            self._stop_event.wait(self.interval)
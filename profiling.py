@@ -0,0 +1,149 @@
+import cProfile
+import glob
+import inspect
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+from typing import Callable
+
+from config import PROFILING_ENABLED, PROFILE_TIME_THRESHOLD, PROFILE_MEMORY_THRESHOLD
+from config import PROFILES_DIR, PROFILES_KEEP
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# tracemalloc общий на процесс, поэтому память честно измеряется только у запуска,
+# во время которого не шли другие профилируемые вызовы
+_tracing_lock = threading.Lock()
+_tracing = {'active_runs': 0, 'overlaps': 0, 'started_by_us': False}
+
+
+def _start_tracing() -> tuple[bool, int, int]:
+    """Отмечает начало профилируемого вызова и включает tracemalloc для первого из одновременных
+    @return: (вызов единственный, число наложений на момент начала, занятая память на момент начала)
+    """
+    with _tracing_lock:
+        exclusive = _tracing['active_runs'] == 0
+        memory_before = 0
+        if exclusive:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing['started_by_us'] = True
+            tracemalloc.reset_peak()
+            memory_before, _ = tracemalloc.get_traced_memory()
+        else:
+            _tracing['overlaps'] += 1
+        _tracing['active_runs'] += 1
+        return exclusive, _tracing['overlaps'], memory_before
+
+
+def _stop_tracing(
+        exclusive: bool, overlaps: int, memory_before: int, duration: float
+) -> tuple[float | None, tracemalloc.Snapshot | None]:
+    """Отмечает конец профилируемого вызова и выключает tracemalloc, когда одновременных вызовов не осталось
+    @return: (пик памяти в МБ или None, если вызов пересекался с другими, снимок памяти для сохранения профиля)
+    """
+    with _tracing_lock:
+        _tracing['active_runs'] -= 1
+        memory_used = None
+        if exclusive and _tracing['overlaps'] == overlaps:
+            _, memory_peak = tracemalloc.get_traced_memory()
+            memory_used = (memory_peak - memory_before) / 2 ** 20
+        snapshot = None
+        if duration >= PROFILE_TIME_THRESHOLD or (memory_used or 0) >= PROFILE_MEMORY_THRESHOLD:
+            snapshot = tracemalloc.take_snapshot()
+        if _tracing['active_runs'] == 0 and _tracing['started_by_us']:
+            tracemalloc.stop()
+            _tracing['started_by_us'] = False
+        return memory_used, snapshot
+
+
+def profiled(func: Callable):
+    """Декоратор профилирует функцию через cProfile и tracemalloc, если включён PROFILING.
+    Профиль сохраняется, только если выполнение заняло больше PROFILE_TIME_THRESHOLD секунд
+    или пик памяти превысил PROFILE_MEMORY_THRESHOLD мегабайт. Память измеряется, только если
+    одновременно не выполнялись другие профилируемые вызовы, tracemalloc работает только во время вызовов.
+    Файлы называются по имени функции и id поставки, если у функции есть аргумент supply_id.
+    При выключенном профилировании функция возвращается без изменений
+    """
+    if not PROFILING_ENABLED:
+        return func
+
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # cProfile не умеет вложенное профилирование в одном потоке,
+        # внутренние вызовы попадают в профиль внешнего
+        if getattr(_local, 'is_profiling', False):
+            return func(*args, **kwargs)
+
+        try:
+            supply_id = signature.bind_partial(*args, **kwargs).arguments.get('supply_id')
+        except TypeError:
+            supply_id = None
+        exclusive, overlaps, memory_before = _start_tracing()
+
+        profile = cProfile.Profile()
+        _local.is_profiling = True
+        started_at = time.perf_counter()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - started_at
+            _local.is_profiling = False
+            memory_used, snapshot = _stop_tracing(exclusive, overlaps, memory_before, duration)
+            if snapshot is not None:
+                try:
+                    _save_profile(profile, snapshot, func.__name__, supply_id, duration, memory_used)
+                except OSError as ex:
+                    logger.error('Не удалось сохранить профиль %s: %s', func.__name__, ex)
+
+    return wrapper
+
+
+def _save_profile(
+        profile: cProfile.Profile,
+        snapshot: tracemalloc.Snapshot,
+        name: str,
+        supply_id: str | None,
+        duration: float,
+        memory_used: float | None):
+    """Сохраняет профиль cProfile и снимок памяти tracemalloc, удаляет самые старые профили"""
+    from pathvalidate import sanitize_filename
+
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    file_name = sanitize_filename(
+        '_'.join(filter(None, [datetime.now().strftime('%Y%m%d-%H%M%S'), name, supply_id])))
+    path = os.path.join(PROFILES_DIR, file_name)
+    profile.dump_stats(f'{path}.prof')
+    snapshot.dump(f'{path}.snapshot')
+    memory_text = f'{memory_used:.1f} МБ' if memory_used is not None else 'память не измерена'
+    logger.warning('Сохранён профиль %s: %.1f с, %s', file_name, duration, memory_text)
+
+    for old_profile in get_profiles()[PROFILES_KEEP:]:
+        for old_path in get_profile_files(old_profile):
+            os.remove(old_path)
+
+
+def get_profiles() -> list[str]:
+    """Возвращает имена сохранённых профилей, начиная с самых новых"""
+    return sorted(
+        (os.path.splitext(os.path.basename(path))[0]
+         for path in glob.glob(os.path.join(PROFILES_DIR, '*.prof'))),
+        reverse=True)
+
+
+def get_profile_files(profile_name: str) -> list[str]:
+    """Возвращает пути к файлам профиля (.prof и .snapshot)
+    @param profile_name: Имя профиля из get_profiles
+    """
+    paths = [os.path.join(PROFILES_DIR, f'{profile_name}{extension}') for extension in ('.prof', '.snapshot')]
+    return [path for path in paths if os.path.exists(path)]
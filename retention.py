@@ -0,0 +1,95 @@
+import logging
+import threading
+from dataclasses import dataclass
+
+from config import RETENTION_ARCHIVE_DAYS, RETENTION_INTERVAL, RETENTION_STICKER_DAYS
+from db_client import archive_old_supplies, compact_db, drop_old_stickers, get_db_size
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RetentionReport:
+    """Результат очистки БД"""
+    stickers_dropped: int
+    supplies_archived: int
+    orders_archived: int
+    size_before: int
+    size_after: int
+
+    @property
+    def reclaimed(self) -> int:
+        return self.size_before - self.size_after
+
+    def format(self) -> str:
+        return f'Удалено стикеров: {self.stickers_dropped}\n' \
+               f'Перенесено в архив поставок: {self.supplies_archived}, заказов: {self.orders_archived}\n' \
+               f'Размер БД: {self.size_before / 2 ** 20:.1f} МБ -> {self.size_after / 2 ** 20:.1f} МБ, ' \
+               f'освобождено {self.reclaimed / 2 ** 20:.1f} МБ'
+
+
+class RetentionJob:
+    """Периодическая очистка БД: удаляет стикеры заказов из давно закрытых поставок,
+    переносит старые поставки и заказы в архивные таблицы и возвращает освободившееся место.
+    Запускается раз в интервал в отдельном потоке и по команде администратора
+    """
+
+    def __init__(
+            self,
+            sticker_days: int = RETENTION_STICKER_DAYS,
+            archive_days: int = RETENTION_ARCHIVE_DAYS,
+            interval: float = RETENTION_INTERVAL):
+        """
+        @param sticker_days: Через сколько дней после закрытия поставки удаляются стикеры. 0 - не удалять
+        @param archive_days: Через сколько дней после закрытия поставка переносится в архив. 0 - не переносить
+        @param interval: Интервал очистки в секундах. 0 отключает очистку по расписанию
+        """
+        self.sticker_days = sticker_days
+        self.archive_days = archive_days
+        self.interval = interval
+        self._run_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает очистку по расписанию в отдельном потоке"""
+        if self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='RetentionJob', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает очистку по расписанию"""
+        self._stop_event.set()
+
+    def run(self) -> RetentionReport | None:
+        """Выполняет очистку
+        @return: результат очистки или None, если очистка уже выполняется
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            size_before = get_db_size()
+            stickers_dropped = drop_old_stickers(self.sticker_days) if self.sticker_days > 0 else 0
+            supplies_archived, orders_archived = \
+                archive_old_supplies(self.archive_days) if self.archive_days > 0 else (0, 0)
+            compact_db()
+            report = RetentionReport(
+                stickers_dropped=stickers_dropped,
+                supplies_archived=supplies_archived,
+                orders_archived=orders_archived,
+                size_before=size_before,
+                size_after=get_db_size())
+        finally:
+            self._run_lock.release()
+        logger.info('Очистка БД: %s', report.format().replace('\n', '; '))
+        return report
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                with db.connection_context():
+                    self.run()
+            except Exception:
+                logger.exception('Ошибка при очистке БД')
@@ -0,0 +1,79 @@
+from typing import Callable
+
+from telebot.types import CallbackQuery
+
+from cursors import CursorStore, cursors
+
+MAX_CALLBACK_DATA_LENGTH = 64
+
+
+class CallbackRouter:
+    """Маршрутизатор нажатий на inline кнопки.
+    callback_data имеет вид 'код_действия:аргумент1:аргумент2'. Обработчик находится
+    одним поиском по словарю. Аргументы, которые не помещаются в 64 байта
+    или содержат разделитель, хранятся на сервере под коротким ключом: 'код_действия:~ключ'.
+    """
+    SEPARATOR = ':'
+    STORED_ARGS_PREFIX = '~'
+
+    def __init__(self, store: CursorStore = cursors):
+        """
+        @param store: Хранилище для аргументов, не помещающихся в callback_data
+        """
+        self.store = store
+        self._handlers: dict[str, Callable] = {}
+
+    def route(self, action: str):
+        """Декоратор регистрирует обработчик кнопок с данным кодом действия.
+        Обработчик получает CallbackQuery и аргументы кнопки в виде строк
+        @param action: Короткий код действия
+        """
+
+        def route_decorator(func: Callable):
+            if action in self._handlers:
+                raise ValueError(f'Код действия {action} уже занят обработчиком {self._handlers[action].__name__}')
+            self._handlers[action] = func
+            return func
+
+        return route_decorator
+
+    def callback_data(self, action: str, *args) -> str:
+        """Собирает callback_data для кнопки
+        @param action: Код действия
+        @param args: Аргументы, которые получит обработчик
+        @return: Строка callback_data
+        """
+        args = [str(arg) for arg in args]
+        callback_data = self.SEPARATOR.join([action, *args])
+        has_unsafe_args = any(
+            self.SEPARATOR in arg or arg.startswith(self.STORED_ARGS_PREFIX)
+            for arg in args)
+        if has_unsafe_args or len(callback_data.encode()) > MAX_CALLBACK_DATA_LENGTH:
+            callback_data = f'{action}{self.SEPARATOR}{self.STORED_ARGS_PREFIX}{self.store.put(args)}'
+        return callback_data
+
+    def parse(self, callback_data: str) -> tuple[Callable | None, list[str] | None]:
+        """Разбирает callback_data
+        @return: обработчик и аргументы. Обработчик равен None для неизвестного действия,
+        аргументы равны None, если сохранённые на сервере аргументы устарели
+        """
+        action, _, raw_args = callback_data.partition(self.SEPARATOR)
+        handler = self._handlers.get(action)
+        if raw_args.startswith(self.STORED_ARGS_PREFIX):
+            args = self.store.get(raw_args.removeprefix(self.STORED_ARGS_PREFIX))
+        else:
+            args = raw_args.split(self.SEPARATOR) if raw_args else []
+        return handler, args
+
+    def dispatch(self, call: CallbackQuery) -> bool:
+        """Вызывает обработчик нажатой кнопки
+        @return: False, если кнопка неизвестна или устарела
+        """
+        handler, args = self.parse(call.data)
+        if handler is None or args is None:
+            return False
+        handler(call, *args)
+        return True
+
+
+router = CallbackRouter()
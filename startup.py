@@ -0,0 +1,104 @@
+"""Замеры времени запуска бота.
+
+Модуль импортируется первым в bot.py и запоминает время начала импорта.
+Этапы запуска отмечаются функцией mark, подробный отчёт по импортам модулей
+(как python -X importtime) строится в отдельном процессе, чтобы не замедлять запуск.
+Отчёт можно получить командой администратора /startup или запуском
+    python startup.py
+"""
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTED_AT = time.perf_counter()
+
+_stages: dict[str, float] = {}
+_import_times: tuple[float, list[tuple[str, float]]] | None = None
+_lock = threading.Lock()
+
+
+def mark(stage: str):
+    """Отмечает окончание этапа запуска
+    @param stage: Название этапа
+    """
+    with _lock:
+        _stages[stage] = time.perf_counter() - STARTED_AT
+
+
+def get_stages() -> dict[str, float]:
+    """Возвращает время от начала запуска до окончания каждого этапа в секундах"""
+    with _lock:
+        return dict(_stages)
+
+
+def measure_import_times(module: str = 'bot') -> tuple[float, list[tuple[str, float]]]:
+    """Импортирует модуль в отдельном процессе с -X importtime
+    @param module: Имя модуля
+    @return: общее время импорта модуля в секундах и список его прямых импортов
+    (модуль, время с вложенными импортами), начиная с самых долгих
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=PROJECT_DIR, capture_output=True, text=True, timeout=120)
+    if result.returncode:
+        logger.error('Не удалось замерить импорт %s: %s', module, result.stderr.strip().splitlines()[-1:])
+
+    # Вложенные импорты выводятся раньше импортирующего модуля и с отступом на 2 пробела больше
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative_time, name = line.removeprefix('import time:').split('|')
+        if not cumulative_time.strip().isdigit():
+            continue
+        level = (len(name) - len(name.lstrip())) // 2
+        if level == 1:
+            children.append((name.strip(), int(cumulative_time) / 1e6))
+        elif level == 0:
+            if name.strip() == module:
+                return int(cumulative_time) / 1e6, sorted(children, key=lambda item: -item[1])
+            children = []
+    return 0.0, []
+
+
+def get_import_times() -> tuple[float, list[tuple[str, float]]]:
+    """Возвращает замеры импорта bot, замеряя их при первом обращении"""
+    global _import_times
+    with _lock:
+        if _import_times is None:
+            _import_times = measure_import_times()
+        return _import_times
+
+
+def format_report(limit: int = 15) -> str:
+    """Собирает отчёт о запуске: этапы и самые долгие импорты bot
+    @param limit: Сколько импортов показать
+    """
+    lines = []
+    if stages := get_stages():
+        lines.append('Этапы запуска:')
+        lines.extend(f'  {stage}: {seconds:.2f} с' for stage, seconds in stages.items())
+
+    total, import_times = get_import_times()
+    if import_times:
+        lines.append(f'Импорт bot: {total:.2f} с, дольше всего:')
+        lines.extend(f'  {name}: {seconds * 1000:.0f} мс' for name, seconds in import_times[:limit])
+    return '\n'.join(lines) or 'Данных о запуске нет'
+
+
+def log_report():
+    """Пишет отчёт о запуске в лог в фоновом потоке"""
+    threading.Thread(
+        target=lambda: logger.warning('%s', format_report()),
+        name='StartupReport',
+        daemon=True).start()
+
+
+if __name__ == '__main__':
+    print(format_report(limit=30))
@@ -0,0 +1,250 @@
+import datetime
+import json
+from abc import ABC, abstractmethod
+from typing import Callable
+
+from telebot.storage import StateStorageBase, StateContext
+from telebot.types import Message
+
+from config import STATE_STORAGE_URL, STATE_TTL
+from models import DialogStateModel
+
+
+class KeyValueStateStorage(StateStorageBase, ABC):
+    """Хранилище состояний telebot, в котором состояние и данные пользователя в чате
+    хранятся одной записью {'state': ..., 'data': {...}}.
+    Наследники реализуют чтение, запись и удаление записи, а также атомарное извлечение pop_record
+    """
+
+    def __init__(self, ttl: int = STATE_TTL):
+        """
+        @param ttl: Через сколько секунд без изменений запись считается устаревшей
+        """
+        super().__init__()
+        self.ttl = ttl
+
+    @abstractmethod
+    def _load(self, chat_id: int, user_id: int) -> dict | None:
+        """Читает запись пользователя в чате
+        @return: запись или None, если записи нет или она устарела
+        """
+
+    @abstractmethod
+    def _store(self, chat_id: int, user_id: int, record: dict):
+        """Сохраняет запись пользователя в чате"""
+
+    @abstractmethod
+    def _delete(self, chat_id: int, user_id: int):
+        """Удаляет запись пользователя в чате"""
+
+    @abstractmethod
+    def pop_record(self, chat_id: int, user_id: int) -> dict | None:
+        """Атомарно достаёт и удаляет запись: из нескольких одновременных вызовов запись получит только один
+        @return: запись {'state': ..., 'data': {...}} или None, если записи нет или её уже забрали
+        """
+
+    def set_state(self, chat_id, user_id, state):
+        record = self._load(chat_id, user_id) or {'data': {}}
+        record['state'] = getattr(state, 'name', state)
+        self._store(chat_id, user_id, record)
+        return True
+
+    def get_state(self, chat_id, user_id):
+        record = self._load(chat_id, user_id)
+        return record['state'] if record else None
+
+    def delete_state(self, chat_id, user_id):
+        if self._load(chat_id, user_id) is None:
+            return False
+        self._delete(chat_id, user_id)
+        return True
+
+    def set_data(self, chat_id, user_id, key, value):
+        record = self._load(chat_id, user_id)
+        if record is None:
+            raise RuntimeError(f'Состояние пользователя {user_id} в чате {chat_id} не задано')
+        record['data'][key] = value
+        self._store(chat_id, user_id, record)
+        return True
+
+    def get_data(self, chat_id, user_id):
+        record = self._load(chat_id, user_id)
+        return record['data'] if record else {}
+
+    def reset_data(self, chat_id, user_id):
+        record = self._load(chat_id, user_id)
+        if record is None:
+            return False
+        record['data'] = {}
+        self._store(chat_id, user_id, record)
+        return True
+
+    def get_interactive_data(self, chat_id, user_id):
+        return StateContext(self, chat_id, user_id)
+
+    def save(self, chat_id, user_id, data):
+        record = self._load(chat_id, user_id)
+        if record is None:
+            return False
+        record['data'] = data
+        self._store(chat_id, user_id, record)
+        return True
+
+
+class DatabaseStateStorage(KeyValueStateStorage):
+    """Хранилище состояний в таблице DialogStates БД бота"""
+
+    def _load(self, chat_id: int, user_id: int) -> dict | None:
+        row = DialogStateModel.get_or_none(
+            DialogStateModel.chat_id == chat_id,
+            DialogStateModel.user_id == user_id)
+        if row is None:
+            return None
+        if datetime.datetime.now() - row.updated_at > datetime.timedelta(seconds=self.ttl):
+            self._delete(chat_id, user_id)
+            return None
+        return {'state': row.state, 'data': json.loads(row.data), 'updated_at': row.updated_at}
+
+    def _store(self, chat_id: int, user_id: int, record: dict):
+        DialogStateModel.insert(
+            chat_id=chat_id,
+            user_id=user_id,
+            state=record['state'],
+            data=json.dumps(record['data'], ensure_ascii=False),
+            updated_at=datetime.datetime.now()
+        ).on_conflict(
+            conflict_target=[DialogStateModel.chat_id, DialogStateModel.user_id],
+            preserve=[DialogStateModel.state, DialogStateModel.data, DialogStateModel.updated_at]
+        ).execute()
+
+    def _delete(self, chat_id: int, user_id: int):
+        DialogStateModel.delete().where(
+            DialogStateModel.chat_id == chat_id,
+            DialogStateModel.user_id == user_id
+        ).execute()
+
+    def pop_record(self, chat_id: int, user_id: int) -> dict | None:
+        record = self._load(chat_id, user_id)
+        if record is None:
+            return None
+        # Удаляется только та версия записи, которую прочитали. Если запись уже удалил
+        # или изменил другой обработчик, удалено 0 строк и запись достаётся ему
+        deleted = DialogStateModel.delete().where(
+            DialogStateModel.chat_id == chat_id,
+            DialogStateModel.user_id == user_id,
+            DialogStateModel.updated_at == record['updated_at']
+        ).execute()
+        return record if deleted else None
+
+
+class RedisStateStorage(KeyValueStateStorage):
+    """Хранилище состояний в Redis или совместимом с ним сервере.
+    Устаревшие записи удаляет сам сервер по времени жизни ключа
+    """
+
+    def __init__(self, client, ttl: int = STATE_TTL, prefix: str = 'wbbot:state:'):
+        """
+        @param client: Клиент redis.Redis или объект с такими же методами get, set и delete
+        @param ttl: Время жизни записи в секундах
+        @param prefix: Префикс ключей
+        """
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'RedisStateStorage':
+        """Создаёт хранилище по адресу вида redis://host:port/db. Требует пакет redis"""
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Для хранения состояний в Redis установите пакет redis') from None
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, chat_id: int, user_id: int) -> str:
+        return f'{self.prefix}{chat_id}:{user_id}'
+
+    def _load(self, chat_id: int, user_id: int) -> dict | None:
+        value = self.client.get(self._key(chat_id, user_id))
+        return json.loads(value) if value else None
+
+    def _store(self, chat_id: int, user_id: int, record: dict):
+        self.client.set(self._key(chat_id, user_id), json.dumps(record, ensure_ascii=False), ex=self.ttl)
+
+    def _delete(self, chat_id: int, user_id: int):
+        self.client.delete(self._key(chat_id, user_id))
+
+    def pop_record(self, chat_id: int, user_id: int) -> dict | None:
+        value = self.client.getdel(self._key(chat_id, user_id))
+        return json.loads(value) if value else None
+
+
+def create_state_storage(url: str = STATE_STORAGE_URL) -> KeyValueStateStorage:
+    """Создаёт хранилище состояний по настройке STATE_STORAGE_URL
+    @param url: Пустая строка - таблица в БД бота, redis://, rediss:// или unix:// - Redis
+    """
+    if not url:
+        return DatabaseStateStorage()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStorage.from_url(url)
+    raise ValueError(f'Неизвестное хранилище состояний: {url}')
+
+
+class DialogRouter:
+    """Маршрутизатор шагов диалога с пользователем.
+    Вместо обработчика следующего шага в памяти процесса в хранилище записывается
+    название шага и данные диалога, поэтому диалог переживает перезапуск бота
+    и может продолжиться в другом процессе
+    """
+
+    def __init__(self, storage: KeyValueStateStorage):
+        """
+        @param storage: Хранилище состояний
+        """
+        self.storage = storage
+        self._handlers: dict[str, Callable] = {}
+
+    def step(self, state: str):
+        """Декоратор регистрирует обработчик шага диалога.
+        Обработчик получает Message и сохранённые данные диалога как именованные аргументы
+        @param state: Название шага
+        """
+
+        def step_decorator(func: Callable):
+            if state in self._handlers:
+                raise ValueError(f'Шаг {state} уже занят обработчиком {self._handlers[state].__name__}')
+            self._handlers[state] = func
+            return func
+
+        return step_decorator
+
+    def start(self, chat_id: int, user_id: int, state: str, **data):
+        """Ждёт от пользователя ответ, который обработает обработчик шага
+        @param chat_id: ID чата
+        @param user_id: Telegram ID пользователя
+        @param state: Название шага
+        @param data: Данные, которые получит обработчик шага. Должны сериализоваться в JSON
+        """
+        self.storage.set_state(chat_id, user_id, state)
+        self.storage.save(chat_id, user_id, data)
+
+    def is_waiting(self, message: Message) -> bool:
+        """Проверяет, ждёт ли бот ответ пользователя на шаг диалога"""
+        return self.storage.get_state(message.chat.id, message.from_user.id) in self._handlers
+
+    def dispatch(self, message: Message) -> bool:
+        """Передаёт ответ пользователя обработчику шага. Шаг завершается до вызова обработчика,
+        чтобы повторить шаг, обработчик снова вызывает start.
+        Шаг забирается из хранилища атомарно, поэтому повторно присланный ответ
+        или другой процесс бота не обработают его второй раз
+        @return: False, если бот не ждёт ответа от пользователя
+        """
+        chat_id, user_id = message.chat.id, message.from_user.id
+        if self.storage.get_state(chat_id, user_id) not in self._handlers:
+            return False
+        record = self.storage.pop_record(chat_id, user_id)
+        handler = self._handlers.get(record['state']) if record else None
+        if handler is None:
+            return False
+        handler(message, **record['data'])
+        return True
@@ -1,19 +1,52 @@
+import hashlib
+import io
 import os
+import zlib
 from base64 import b64decode
+from functools import cache
 
 from pathvalidate import sanitize_filename
 from PIL import Image as pil_image
+from reportlab import rl_config
 from reportlab.graphics.barcode import code128
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import BaseDocTemplate, PageTemplate, NextPageTemplate
-from reportlab.platypus import Image, Frame, PageBreak
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Frame, Flowable
 from reportlab.platypus.para import Paragraph
 from reportlab.platypus.tables import Table
 
+from metrics import STICKER_RENDER_LATENCY
 from models import OrderModel
+from profiling import profiled
+
+try:
+    from svglib.svglib import svg2rlg
+except ImportError:
+    svg2rlg = None
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arial.ttf')
+
+# Потоки PDF пишутся в двоичном виде: ASCII85 увеличивает каждый сжатый поток на четверть
+rl_config.useA85 = 0
+# Без даты создания и случайного ID документа одинаковые стикеры дают одинаковый файл,
+# и бот повторно отправляет его по file_id из Telegram
+rl_config.invariant = 1
+
+
+@cache
+def get_sticker_style() -> ParagraphStyle:
+    """
+    Регистрирует шрифт Arial и возвращает стиль текста стикеров.
+    Шрифт читается с диска один раз за время работы бота
+    """
+    pdfmetrics.registerFont(TTFont('Arial', FONT_PATH))
+    style = getSampleStyleSheet()['BodyText']
+    style.fontName = 'Arial'
+    return style
 
 
 def save_image_from_str_to_png(image: str, path: str):
@@ -38,6 +71,104 @@ def rotate_image(file_path: str):
         rotated_image.save(file_path)
 
 
+class CompactImage(Flowable):
+    """Картинка стикера, которая встраивается в PDF без потерь в исходном разрешении
+    и с минимальной глубиной цвета: чёрно-белая - 1 бит на точку, серая - 8 бит, цветная - RGB.
+    Одинаковые картинки встраиваются в файл один раз
+    """
+    hAlign = 'CENTER'
+
+    def __init__(self, path: str, width: float, height: float):
+        """
+        @param path: путь к файлу картинки
+        @param width: Ширина на странице
+        @param height: Высота на странице
+        """
+        super().__init__()
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def wrap(self, available_width, available_height):
+        return self.width, self.height
+
+    def draw(self):
+        canvas = self.canv
+        with open(self.path, 'rb') as file:
+            name = hashlib.md5(file.read()).hexdigest()
+        # Регистрация картинки повторяет Canvas.drawImage, но с потоком, подготовленным в make_image_xobject
+        reg_name = canvas._doc.getXObjectName(name)
+        if canvas._doc.idToObject.get(reg_name) is None:
+            image_object = make_image_xobject(name, self.path)
+            canvas._setXObjects(image_object)
+            canvas._doc.Reference(image_object, reg_name)
+            canvas._doc.addForm(name, image_object)
+        canvas._currentPageHasImages = 1
+        canvas.saveState()
+        canvas.scale(self.width, self.height)
+        canvas._code.append(f'/{reg_name} Do')
+        canvas.restoreState()
+
+
+def make_image_xobject(name: str, path: str) -> PDFImageXObject:
+    """
+    Готовит картинку к встраиванию в PDF: прозрачность заменяется белым фоном,
+    точки упаковываются в минимальную глубину цвета и сжимаются zlib
+    @param name: имя картинки в PDF
+    @param path: путь к файлу картинки
+    """
+    with pil_image.open(path) as image:
+        image.load()
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        background = pil_image.new('RGBA', image.size, 'white')
+        image = pil_image.alpha_composite(background, image.convert('RGBA'))
+    image = image.convert('RGB')
+    colors = image.getcolors(maxcolors=256)
+    if colors and all(red == green == blue for _, (red, green, blue) in colors):
+        image = image.convert('L')
+        if all(color[0] in (0, 255) for _, color in colors):
+            image = image.convert('1', dither=pil_image.Dither.NONE)
+
+    image_object = PDFImageXObject(name)
+    image_object.width, image_object.height = image.size
+    image_object.bitsPerComponent = 1 if image.mode == '1' else 8
+    image_object.colorSpace = 'DeviceRGB' if image.mode == 'RGB' else 'DeviceGray'
+    image_object.streamContent = zlib.compress(image.tobytes(), 9)
+    image_object._filters = 'FlateDecode',
+    return image_object
+
+
+def is_svg_sticker(image: str) -> bool:
+    """
+    Проверяет по началу строки, что стикер из API в формате SVG, а не PNG
+    :param image: байты картинки в виде строки base64
+    """
+    return b64decode(image[:12]).lstrip().startswith(b'<')
+
+
+def create_sticker_image(order: OrderModel, width: float, height: float) -> Flowable:
+    """
+    Создаёт элемент страницы со стикером заказа заданного размера.
+    SVG стикер рисуется векторной графикой, PNG - сжатой картинкой из файла order.sticker_path
+    @param order: Заказ
+    @param width: Ширина стикера на странице
+    @param height: Высота стикера на странице
+    @raise: TypeError, если SVG стикер не удалось разобрать
+    """
+    if not is_svg_sticker(order.sticker):
+        return CompactImage(order.sticker_path, width=width, height=height)
+    if svg2rlg is None:
+        raise TypeError('Для SVG стикеров установите пакет svglib')
+    drawing = svg2rlg(io.BytesIO(b64decode(order.sticker, validate=True)))
+    if drawing is None or not drawing.width or not drawing.height:
+        raise TypeError(f'Не удалось разобрать SVG стикер заказа {order.id}')
+    drawing.scale(width / drawing.width, height / drawing.height)
+    drawing.width, drawing.height = width, height
+    drawing.hAlign = 'CENTER'
+    return drawing
+
+
+@profiled
 def create_stickers(grouped_orders: dict[str:list[OrderModel]], supply_id: str) -> tuple[str, dict]:
     """
     Создает pdf файлы со стикерами для каждого артикула.
@@ -56,16 +187,17 @@ def create_stickers(grouped_orders: dict[str:list[OrderModel]], supply_id: str)
 
     supply_path = sanitize_filename(f'stickers for {supply_id}')
     os.makedirs(supply_path, exist_ok=True)
-    pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
 
     for article, orders in grouped_orders.items():
         file_name = sanitize_filename(article.strip())
         output_pdf_path = os.path.join(supply_path, f'{file_name}.pdf')
         os.makedirs('stickers', exist_ok=True)
         for order in orders:
-            save_image_from_str_to_png(order.sticker, order.sticker_path)
+            if not is_svg_sticker(order.sticker):
+                save_image_from_str_to_png(order.sticker, order.sticker_path)
         try:
-            create_stickers_for_orders(orders, output_pdf_path)
+            with STICKER_RENDER_LATENCY.time(format='pdf'):
+                create_stickers_for_orders(orders, output_pdf_path)
         except TypeError:
             stickers_report['failed'].append(article)
             continue
@@ -74,43 +206,143 @@ def create_stickers(grouped_orders: dict[str:list[OrderModel]], supply_id: str)
     return supply_path, stickers_report
 
 
+@profiled
+def create_supply_stickers(
+        grouped_orders: dict[str:list[OrderModel]],
+        supply_id: str,
+        sort_by: str = 'article',
+        page_order: str = 'interleaved'
+) -> tuple[str, dict]:
+    """
+    Создает один pdf файл со стикерами всей поставки с закладкой на каждый артикул.
+    Артикулы, для которых не удалось подготовить стикеры, пропускаются
+    @param grouped_orders: словарь со заказами, сгруппированными по артикулам
+    @param supply_id: ID поставки
+    @param sort_by: article - по артикулам, внутри артикула по номеру заказа; order - по номеру заказа
+    @param page_order: interleaved - стикер и этикетка каждого заказа подряд,
+     stickers_first - сначала все стикеры, затем все этикетки в том же порядке
+    @return: путь к pdf файлу и отчёт о создании стикеров
+    """
+    stickers_report = {
+        'successfully': [],
+        'failed': []
+    }
+    os.makedirs('stickers', exist_ok=True)
+    pages = []
+    labels = {}
+    for article, orders in sorted(grouped_orders.items()):
+        try:
+            with STICKER_RENDER_LATENCY.time(format='pdf'):
+                for order in orders:
+                    if not is_svg_sticker(order.sticker):
+                        save_image_from_str_to_png(order.sticker, order.sticker_path)
+                labels[article] = create_product_label(orders[0].product)
+                article_pages = [
+                    (article, order.id, create_sticker_image(order, width=95 * mm, height=65 * mm))
+                    for order in orders]
+        except TypeError:
+            stickers_report['failed'].append(article)
+            continue
+        else:
+            stickers_report['successfully'].append(article)
+            pages.extend(sorted(article_pages, key=lambda page: page[1]))
+    if sort_by == 'order':
+        pages.sort(key=lambda page: page[1])
+
+    output_pdf_path = sanitize_filename(f'stickers for {supply_id}.pdf')
+    render_stickers_pdf(output_pdf_path, pages, labels, page_order, title=f'Стикеры по поставке {supply_id}')
+    return output_pdf_path, stickers_report
+
+
+def create_product_label(product) -> tuple[Flowable, code128.Code128]:
+    """Готовит содержимое этикетки товара: описание товара и его штрихкод
+    @param product: Товар заказа
+    @raise: TypeError, если у товара нет наименования и штрихкода
+    """
+    if product.name is None or product.barcode is None:
+        raise TypeError(f'Нет наименования или штрихкода товара {product.article}')
+    style = get_sticker_style()
+    data = [
+        [Paragraph(product.name, style)],
+        [Paragraph(f'Артикул: {product.article}', style)],
+        [Paragraph('Страна: Россия', style)],
+        [Paragraph('Бренд: CVT', style)]
+    ]
+    return (
+        Table(data, colWidths=[100 * mm]),
+        code128.Code128(product.barcode, barHeight=50, barWidth=1.45, humanReadable=True))
+
+
+def render_stickers_pdf(
+        output_pdf_path: str,
+        pages: list[tuple[str, int, Flowable]],
+        labels: dict[str, tuple[Flowable, code128.Code128]],
+        page_order: str = 'interleaved',
+        title: str = None):
+    """Рисует страницы стикеров в pdf файл за один проход.
+    Этикетка товара рисуется в файл один раз на артикул и повторяется на страницах всех его заказов.
+    Если задан title, то в файл добавляются закладки на первую страницу каждого артикула
+    @param output_pdf_path: путь, куда сохранять файл
+    @param pages: (артикул, ID заказа, стикер) для каждого заказа. Список опустошается по мере отрисовки
+    @param labels: описание товара и штрихкод для каждого артикула, как в create_product_label
+    @param page_order: interleaved или stickers_first, как в create_supply_stickers
+    @param title: заголовок документа
+    """
+    sticker_size = (120 * mm, 75 * mm)
+    pdf = Canvas(output_pdf_path, pagesize=sticker_size)
+    if title:
+        pdf.setTitle(title)
+        pdf.showOutline()
+
+    def draw_sticker(article: str, sticker: Flowable):
+        if title and article not in bookmarks:
+            bookmarks[article] = key = f'article{len(bookmarks)}'
+            pdf.bookmarkPage(key)
+            pdf.addOutlineEntry(article, key, level=0)
+        Frame(0, 0, *sticker_size).addFromList([sticker], pdf)
+        pdf.showPage()
+
+    def draw_label(article: str):
+        if article not in label_forms:
+            label_forms[article] = form_name = f'label{len(label_forms)}'
+            description, barcode = labels[article]
+            pdf.beginForm(form_name)
+            barcode.drawOn(pdf, x=19.5 * mm, y=53 * mm)
+            Frame(10 * mm, 5 * mm, 100 * mm, 40 * mm).addFromList([description], pdf)
+            pdf.endForm()
+        pdf.doForm(label_forms[article])
+        pdf.showPage()
+
+    bookmarks = {}
+    label_forms = {}
+    label_articles = []
+    # Страницы забираются из списка по одной, чтобы отрисованные стикеры
+    # не копились в памяти до сохранения файла
+    pages.reverse()
+    while pages:
+        article, _, sticker = pages.pop()
+        draw_sticker(article, sticker)
+        if page_order == 'stickers_first':
+            label_articles.append(article)
+        else:
+            draw_label(article)
+    for article in label_articles:
+        draw_label(article)
+    pdf.save()
+
+
 def create_stickers_for_orders(orders: list[OrderModel], output_pdf_path: str):
     """Создает pdf файл, в который помещает все стикеры для переданного списка заказов.
     В файл помещаются QR коды и штрихкоды.
     @param orders: Список заказов
     @param output_pdf_path: путь, куда сохранять файл
+    @raise: TypeError, если у заказа нет стикера или у товара нет наименования и штрихкода
     """
-    sticker_size = (120 * mm, 75 * mm)
-    pdf = BaseDocTemplate(output_pdf_path, showBoundary=0)
-    style = getSampleStyleSheet()['BodyText']
-    style.fontName = 'Arial'
-    frame_sticker = Frame(0, 0, *sticker_size)
-    frame_description = Frame(10 * mm, 5 * mm, 100 * mm, 40 * mm)
-
-    elements = []
+    labels = {}
+    pages = []
     for order in orders:
-        data = [
-            [Paragraph(order.product.name, style)],
-            [Paragraph(f'Артикул: {order.product.article}', style)],
-            [Paragraph('Страна: Россия', style)],
-            [Paragraph('Бренд: CVT', style)]
-        ]
-
-        elements.append(Image(order.sticker_path, useDPI=300, width=95 * mm, height=65 * mm))
-        elements.append(NextPageTemplate('Barcode'))
-        elements.append(PageBreak())
-        elements.append(Table(data, colWidths=[100 * mm]))
-        elements.append(NextPageTemplate('Image'))
-        elements.append(PageBreak())
-
-        def barcode(canvas, doc):
-            canvas.saveState()
-            barcode128 = code128.Code128(order.product.barcode, barHeight=50, barWidth=1.45, humanReadable=True)
-            barcode128.drawOn(canvas, x=19.5 * mm, y=53 * mm)
-            canvas.restoreState()
-
-        pdf.addPageTemplates(
-            [PageTemplate(id='Image', frames=frame_sticker, pagesize=sticker_size),
-             PageTemplate(id='Barcode', frames=frame_description, pagesize=sticker_size, onPage=barcode)]
-        )
-    pdf.build(elements)
+        article = order.product.article
+        if article not in labels:
+            labels[article] = create_product_label(order.product)
+        pages.append((article, order.id, create_sticker_image(order, width=95 * mm, height=65 * mm)))
+    render_stickers_pdf(output_pdf_path, pages, labels)
@@ -1,21 +1,33 @@
+import json
 import os
+from importlib.util import find_spec
 import shutil
 from collections import Counter
-from datetime import datetime
-from typing import Callable
+from datetime import date, datetime, timedelta
+from functools import wraps
+from itertools import islice
+from math import ceil
+from typing import Callable, Iterable, Iterator
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 
 from peewee import ModelSelect
 from telebot.types import Message, CallbackQuery, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from telebot.util import quick_markup
+from telebot.types import InlineKeyboardMarkup
 
+from api.accounts import get_current_account, use_account
 from api.classes import Order, Supply
-from api.methods import get_product, get_stickers
-from db_client import add_stickers_to_db
-from db_client import check_user_registration
+from api.methods import get_product, get_stickers, get_supplies_page, SUPPLIES_PAGE_LIMIT
+from config import PAGE_SIZE, STICKER_FORMAT, STICKER_IMAGE_TYPE
+from config import STICKER_PDF_LAYOUT, STICKER_SORT, STICKER_PAGE_ORDER
+from cursors import Cursor, cursors
+from router import router
+from db_client import add_stickers_to_db, bulk_insert_supplies
+from db_client import get_supply_pages, save_supply_page, select_supplies_by_ids
+from db_client import check_user_registration, get_user_current_account
 from db_client import select_orders_by_supply
+from db_client import get_shipped_by_article, get_shipped_by_day, get_shipped_supplies
 from db_client import set_products_name_and_barcode
 from models import OrderModel
-from stickers import create_stickers
 
 
 def make_menu_from_list(buttons_title: list, row_width: int = 2) -> ReplyKeyboardMarkup:
@@ -35,79 +47,322 @@ def create_supplies_markup(
         supplies: list[Supply],
         show_more_supplies: bool = True,
         show_create_new: bool = False,
-        order_to_append: int | str = None
+        order_to_append: int | str = None,
+        orders_to_move: str = None,
+        page: int = 0,
+        cursor_id: str = None
 ):
-    """Подготавливает кнопки поставок
+    """Подготавливает кнопки поставок. Показывается одна страница размером PAGE_SIZE,
+    весь список сохраняется в курсоре для перелистывания
     @param supplies: список поставок, представленных как результаты парсинга
-    @param order_to_append: если указано, то callback_data меняется
-     на добавление заказа к поставке - 'append_o_to_s_{order_to_append}_{supply.supply_id}'.
-     В противном случае в callback_data будет отправлен только id поставки - 'supply_{supply.supply_id}'
+    запросов к API
+    @param order_to_append: если указано, то кнопка добавляет заказ к поставке (действие 'ap').
+     В противном случае кнопка показывает заказы поставки (действие 's')
+    @param orders_to_move: если указан ключ курсора массового переноса, то кнопка переносит
+     выбранные заказы в поставку (действие 'mp')
     @param show_create_new: добавляет кнопку "Показать больше поставок" в конце списка
     @param show_more_supplies: добавляет кнопку "Создать новую" в конце списка
-    запросов к API
+    @param page: номер показываемой страницы, начиная с 0
+    @param cursor_id: ключ курсора, если список уже сохранён
     """
+    if cursor_id is None:
+        cursor_id = cursors.put(Cursor(
+            kind='supplies',
+            items=supplies,
+            options={
+                'show_more_supplies': show_more_supplies,
+                'show_create_new': show_create_new,
+                'order_to_append': order_to_append,
+                'orders_to_move': orders_to_move}))
+
     is_done = {0: 'Открыта', 1: 'Закрыта'}
-    buttons = {}
-    for supply in supplies:
-        callback_data = f'append_o_to_s_{order_to_append}_{supply.supply_id}' \
-            if order_to_append else f'supply_{supply.supply_id}'
-        button_name = f'{supply.name} | {supply.supply_id} | {is_done[supply.is_done]}'
-        buttons[button_name] = {'callback_data': callback_data}
-
-    supplies_markup = quick_markup(buttons, row_width=1)
+    supplies_markup = InlineKeyboardMarkup(row_width=1)
+    page_supplies, pages_count = _get_page(supplies, page)
+    for supply in page_supplies:
+        if orders_to_move:
+            callback_data = router.callback_data('mp', orders_to_move, supply.supply_id)
+        elif order_to_append:
+            callback_data = router.callback_data('ap', order_to_append, supply.supply_id)
+        else:
+            callback_data = router.callback_data('s', supply.supply_id)
+        supplies_markup.add(
+            InlineKeyboardButton(
+                text=f'{supply.name} | {supply.supply_id} | {is_done[supply.is_done]}',
+                callback_data=callback_data
+            )
+        )
+    _add_page_buttons(supplies_markup, cursor_id, page, pages_count)
+
     if show_more_supplies:
         supplies_markup.add(
             InlineKeyboardButton(
                 text='Показать больше поставок',
-                callback_data=f'more_supplies'
+                callback_data=router.callback_data('ms')
             )
         )
     if show_create_new:
         supplies_markup.add(
             InlineKeyboardButton(
                 text='Создать новую',
-                callback_data=f'create_supply'
+                callback_data=router.callback_data('cs')
             )
         )
     return supplies_markup
 
 
-def create_orders_markup(orders: list[Order]):
-    """Подготавливает кнопки заказов
+def create_orders_markup(orders: list[Order], page: int = 0, cursor_id: str = None):
+    """Подготавливает кнопки заказов. Показывается одна страница размером PAGE_SIZE,
+    весь список сохраняется в курсоре для перелистывания
     @param orders: список заказов, представленных как результаты парсинга
     запросов к API
+    @param page: номер показываемой страницы, начиная с 0
+    @param cursor_id: ключ курсора, если список уже сохранён
+    """
+    if cursor_id is None:
+        cursor_id = cursors.put(Cursor(kind='orders', items=orders, account=get_current_account()))
+
+    orders_markup = InlineKeyboardMarkup(row_width=1)
+    page_orders, pages_count = _get_page(orders, page)
+    for order in page_orders:
+        orders_markup.add(
+            InlineKeyboardButton(
+                text=f'{order.article} | {convert_to_created_ago(order.created_at)}',
+                callback_data=router.callback_data('o', order.order_id)
+            )
+        )
+    _add_page_buttons(orders_markup, cursor_id, page, pages_count)
+    if orders:
+        orders_markup.add(
+            InlineKeyboardButton(
+                text='Перенести все в поставку',
+                callback_data=router.callback_data('ma', cursor_id)
+            )
+        )
+    return orders_markup
+
+
+def create_move_orders_markup(move_id: str) -> InlineKeyboardMarkup | None:
+    """Подготавливает кнопки выбора артикулов для массового переноса заказов.
+    Заказы и выбранные артикулы хранятся в курсоре, нажатие на артикул включает или выключает его.
+    Если ни один артикул не выбран, переносятся все заказы
+    @param move_id: ключ курсора массового переноса
+    @return: клавиатура или None, если курсор устарел
+    """
+    cursor = cursors.get(move_id)
+    if cursor is None:
+        return None
+    selected = cursor.options['selected']
+    articles_count = Counter(order.article for order in cursor.items)
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        InlineKeyboardButton(
+            text=f'{"✅ " if article in selected else ""}{article} ({count})',
+            callback_data=router.callback_data('mt', move_id, index))
+        for index, (article, count) in enumerate(sorted(articles_count.items()))])
+    orders_count = sum(articles_count[article] for article in selected) if selected else len(cursor.items)
+    markup.row(
+        InlineKeyboardButton(
+            text=f'Выбрать поставку для {"выбранных" if selected else "всех"} заказов ({orders_count})',
+            callback_data=router.callback_data('mc', move_id)))
+    return markup
+
+
+def toggle_article_to_move(move_id: str, index: int) -> bool:
+    """Включает или выключает артикул в курсоре массового переноса
+    @param move_id: ключ курсора массового переноса
+    @param index: номер артикула в отсортированном списке артикулов
+    @return: False, если курсор устарел
+    """
+    cursor = cursors.get(move_id)
+    if cursor is None:
+        return False
+    article = sorted({order.article for order in cursor.items})[index]
+    selected = cursor.options['selected']
+    if article in selected:
+        selected.remove(article)
+    else:
+        selected.append(article)
+    return True
+
+
+def get_move_account(move_id: str) -> str | None:
+    """Возвращает аккаунт, под которым были получены заказы курсора массового переноса
+    @param move_id: ключ курсора массового переноса
+    @return: имя аккаунта или None, если курсор устарел
+    """
+    cursor = cursors.get(move_id)
+    if cursor is None:
+        return None
+    return cursor.account
+
+
+def get_orders_to_move(move_id: str) -> list[Order] | None:
+    """Возвращает заказы курсора массового переноса, подходящие под выбранные артикулы
+    @param move_id: ключ курсора массового переноса
+    @return: список заказов или None, если курсор устарел
+    """
+    cursor = cursors.get(move_id)
+    if cursor is None:
+        return None
+    selected = cursor.options['selected']
+    return [order for order in cursor.items if not selected or order.article in selected]
+
+
+def format_move_report(supply_id: str, moved: list, errors: dict) -> str:
+    """Собирает итог массового переноса заказов в поставку
+    @param supply_id: ID поставки
+    @param moved: ID перенесённых заказов
+    @param errors: ошибки по ID не перенесённых заказов
+    @return: текст итога
+    """
+    lines = [f'Перенесено в поставку {supply_id}: {len(moved)} из {len(moved) + len(errors)}']
+    # Одинаковые ошибки объединяются, чтобы итог поместился в одно сообщение
+    order_ids_by_error = {}
+    for order_id, error in errors.items():
+        response = getattr(error, 'response', None)
+        error_text = f'{response.status_code} {response.reason}' if response is not None else str(error)
+        order_ids_by_error.setdefault(error_text, []).append(str(order_id))
+    for error, order_ids in order_ids_by_error.items():
+        shown_ids = ', '.join(order_ids[:10]) + (' и др.' if len(order_ids) > 10 else '')
+        lines.append(f'\nНе перенесено {len(order_ids)}шт. ({error}): {shown_ids}')
+    return '\n'.join(lines)
+
+
+def create_page_markup(cursor_id: str, page: int) -> InlineKeyboardMarkup | None:
+    """Подготавливает кнопки для другой страницы сохранённого списка без запросов к API
+    @param cursor_id: ключ курсора
+    @param page: номер страницы, начиная с 0
+    @return: клавиатура или None, если курсор устарел
+    """
+    cursor = cursors.get(cursor_id)
+    if cursor is None:
+        return None
+    create_markup = {
+        'orders': create_orders_markup,
+        'supplies': create_supplies_markup
+    }[cursor.kind]
+    return create_markup(cursor.items, **cursor.options, page=page, cursor_id=cursor_id)
+
+
+def _get_page(items: list, page: int) -> tuple[list, int]:
+    """Вырезает из списка одну страницу
+    @return: элементы страницы и общее количество страниц
+    """
+    pages_count = max(ceil(len(items) / PAGE_SIZE), 1)
+    page = min(max(page, 0), pages_count - 1)
+    return items[page * PAGE_SIZE:(page + 1) * PAGE_SIZE], pages_count
+
+
+def _add_page_buttons(markup: InlineKeyboardMarkup, cursor_id: str, page: int, pages_count: int):
+    """Добавляет к клавиатуре кнопки перелистывания, если страниц больше одной"""
+    if pages_count < 2:
+        return
+    page = min(max(page, 0), pages_count - 1)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text='« Назад', callback_data=router.callback_data('pg', cursor_id, page - 1)))
+    buttons.append(InlineKeyboardButton(text=f'{page + 1}/{pages_count}', callback_data=router.callback_data('noop')))
+    if page < pages_count - 1:
+        buttons.append(InlineKeyboardButton(text='Далее »', callback_data=router.callback_data('pg', cursor_id, page + 1)))
+    markup.row(*buttons)
+
+
+def iter_supplies(only_active: bool = True) -> Iterator[Supply]:
+    """
+    Лениво выдаёт поставки с Wildberries, начиная с самых новых.
+    API отдаёт поставки страницами от старых к новым, поэтому заполненные страницы
+    запоминаются в БД: запрашиваются только страницы после последней известной,
+    а более старые страницы читаются из БД, если все их поставки закрыты
+    (и пропускаются целиком, если нужны только незакрытые поставки).
+    Загруженные поставки сохраняются в БД
+    @param only_active: Если True то выдаются только незакрытые поставки,
+    в противном случае - все
+    @return: итератор поставок, представленных как результаты парсинга
+    запросов к API
+    @raise: HTTPError, WBAPIError
+    """
+
+    def select(supplies: Iterable[Supply]) -> Iterator[Supply]:
+        return (supply for supply in supplies if not supply.is_done or only_active is False)
+
+    known_pages = get_supply_pages()
+    cursor = known_pages[-1].next_cursor if known_pages else 0
+    new_pages = []
+    while True:
+        supplies, next_cursor = get_supplies_page(cursor)
+        bulk_insert_supplies(supplies)
+        new_pages.append(supplies)
+        if len(supplies) < SUPPLIES_PAGE_LIMIT:
+            break
+        save_supply_page(cursor, next_cursor, supplies)
+        cursor = next_cursor
+
+    for supplies in reversed(new_pages):
+        yield from select(reversed(supplies))
+
+    for page in reversed(known_pages):
+        if page.all_done:
+            if only_active:
+                continue
+            supplies = select_supplies_by_ids(json.loads(page.supply_ids))
+        else:
+            supplies, next_cursor = get_supplies_page(page.cursor)
+            bulk_insert_supplies(supplies)
+            save_supply_page(page.cursor, next_cursor, supplies)
+        yield from select(reversed(supplies))
+
+
+def get_supplies(
+        only_active: bool = True,
+        limit: int = 50) -> list[Supply]:
+    """
+    Получает информацию о последних поставках с Wildberries.
+    Страницы загружаются, только пока не найдено limit подходящих поставок
+    @param only_active: Если True то возвращает только незакрытые поставки,
+    в противном случае - все
+    @param limit: Максимальное число возвращаемых поставок
+    @return: список поставок, представленных как результаты парсинга
+    запросов к API, начиная с самых новых
+    @raise: HTTPError, WBAPIError
     """
-    return quick_markup({
-        f'{order.article} | {convert_to_created_ago(order.created_at)}': {
-            'callback_data': f'order_{order.order_id}'
-        }
-        for order in orders
-    }, row_width=1)
+    return list(islice(iter_supplies(only_active), limit))
 
 
-def join_orders(orders: list[Order]) -> str:
+def join_orders(orders: list[Order], max_length: int = 4000) -> str:
     """Собирает все артикулы из заказов и объединяет их в одно сообщение
     @param orders: список заказов, представленных как результаты парсинга
     запросов к API
+    @param max_length: максимальная длина строки. Артикулы, которые не поместились,
+    заменяются строкой "...и ещё артикулов: N"
     @return: Строка из объединенных артикулов заказов
     """
 
     articles = [order.article for order in orders]
-    joined_orders = '\n'.join(
-        [f'{article} - {count}шт.'
-         for article, count in Counter(sorted(articles)).items()]
-    )
+    lines = [f'{article} - {count}шт.'
+             for article, count in Counter(sorted(articles)).items()]
+    joined_orders = '\n'.join(lines)
+    if len(joined_orders) <= max_length:
+        return joined_orders
+    # Запас под строку с количеством не поместившихся артикулов
+    length = len('\n...и ещё артикулов: 0000000')
+    for shown, line in enumerate(lines):
+        length += len(line) + 1
+        if length > max_length:
+            return '\n'.join(lines[:shown] + [f'...и ещё артикулов: {len(lines) - shown}'])
     return joined_orders
 
 
 def check_registration(alternative_func: Callable, is_admin: bool = False):
-    """Декоратор проверяет регистрацию пользователя, отправившего сообщение.
-     @param alternative_func: Функция, которую следует вызвать, если проверка не пройдена.
+    """Декоратор проверяет регистрацию пользователя, отправившего сообщение,
+    и выполняет функцию от имени аккаунта продавца, выбранного пользователем.
+     @param alternative_func: Функция, которую следует вызвать, если проверка не пройдена
+     или пользователю не доступен ни один аккаунт.
     Она должна принимать в качестве аргумента Message
     @param is_admin: Если True, то проверяются права администратора"""
 
     def check_registration_decorator(func: Callable):
 
+        @wraps(func)
         def wrapper(*args, **kwargs):
             first_arg, *_ = args
             if isinstance(first_arg, Message):
@@ -124,16 +379,57 @@ def check_registration(alternative_func: Callable, is_admin: bool = False):
                     f' А не {type(first_arg)} = {first_arg}'
                 )
 
-            if check_user_registration(message.chat.id, is_admin):
-                return func(*args, **kwargs)
-            else:
+            if not check_user_registration(message.chat.id, is_admin):
+                alternative_func(message)
+                return
+            # Обработчик и все запросы к API и БД внутри него выполняются от имени аккаунта пользователя
+            account = get_user_current_account(message.chat.id)
+            if account is None:
                 alternative_func(message)
+                return
+            with use_account(account):
+                return func(*args, **kwargs)
 
         return wrapper
 
     return check_registration_decorator
 
 
+def format_shipping_report(by_weeks: bool = False, top_articles: int = 10, last_supplies: int = 5) -> str:
+    """Собирает отчёт об отгрузках текущего аккаунта из сводных таблиц
+    @param by_weeks: Если True, то отчёт за 8 недель по неделям, иначе за 7 дней по дням
+    @param top_articles: Сколько самых отгружаемых артикулов показать
+    @param last_supplies: Сколько последних отгруженных поставок показать
+    @return: текст отчёта
+    """
+    today = date.today()
+    if by_weeks:
+        since = today - timedelta(days=today.weekday() + 7 * 7)
+        title = 'Отгрузки за 8 недель'
+    else:
+        since = today - timedelta(days=6)
+        title = 'Отгрузки за 7 дней'
+
+    shipped = Counter()
+    for day, units in get_shipped_by_day(since):
+        shipped[day - timedelta(days=day.weekday()) if by_weeks else day] += units
+    if not shipped:
+        return f'{title}: отгрузок не было'
+
+    lines = [f'{title}:']
+    lines.extend(
+        f'{"с " if by_weeks else ""}{day:%d.%m} - {units}шт.'
+        for day, units in sorted(shipped.items()))
+    lines.append(f'Всего: {sum(shipped.values())}шт.')
+    lines.append('\nАртикулы:')
+    lines.extend(f'{article} - {units}шт.' for article, units in get_shipped_by_article(since, top_articles))
+    lines.append('\nПоследние поставки:')
+    lines.extend(
+        f'{supply_id} ({day:%d.%m}) - {units}шт.'
+        for supply_id, day, units in get_shipped_supplies(last_supplies))
+    return '\n'.join(lines)
+
+
 def group_orders_by_article(orders: ModelSelect) -> dict[str:list[OrderModel]]:
     """
     Группирует заказы по артикулам
@@ -152,6 +448,18 @@ def group_orders_by_article(orders: ModelSelect) -> dict[str:list[OrderModel]]:
     return grouped_orders
 
 
+def get_sticker_type() -> str:
+    """Выбирает формат, в котором стикеры заказов запрашиваются у API, по настройкам
+    STICKER_FORMAT и STICKER_IMAGE_TYPE. SVG запрашивается, только если установлен svglib
+    @return: zplh, svg или png
+    """
+    if STICKER_FORMAT == 'zpl':
+        return 'zplh'
+    if STICKER_IMAGE_TYPE == 'svg' and find_spec('svglib') is not None:
+        return 'svg'
+    return 'png'
+
+
 def add_stickers_and_products_to_orders(supply_id: str):
     """Добавляет в заказы данные по товарам и стикерам
     @param supply_id: ID поставки
@@ -160,34 +468,62 @@ def add_stickers_and_products_to_orders(supply_id: str):
     articles = set([order.product.article for order in orders])
     products = [get_product(article) for article in articles]
     set_products_name_and_barcode(products)
-    stickers = get_stickers([order.id for order in orders])
+    stickers = get_stickers([order.id for order in orders], get_sticker_type())
     add_stickers_to_db(stickers)
 
 
 def prepare_stickers(supply_id: str) -> tuple[str, dict]:
     """Собирает информацию для стикеров.
-    Подготавливает pdf, архивирует их и возвращает путь к zip архиву
+    Подготавливает pdf или zpl файлы по настройке STICKER_FORMAT, архивирует их и возвращает путь к zip архиву.
+    При STICKER_PDF_LAYOUT=supply вся поставка собирается в один pdf файл без архива
     @param supply_id: ID поставки
-    @return: адрес к файлу с архивом
+    @return: адрес к файлу с архивом или pdf файлу
     """
     orders = select_orders_by_supply(supply_id)
     grouped_orders = group_orders_by_article(orders)
+    if STICKER_FORMAT == 'zpl':
+        from zpl_stickers import create_zpl_stickers as create_stickers
+    elif STICKER_PDF_LAYOUT == 'supply':
+        from stickers import create_supply_stickers
+        return create_supply_stickers(grouped_orders, supply_id, STICKER_SORT, STICKER_PAGE_ORDER)
+    else:
+        # reportlab и PIL загружаются при первом создании стикеров, а не при запуске бота
+        from stickers import create_stickers
+
     supply_path, stickers_report = create_stickers(grouped_orders, supply_id)
-    shutil.make_archive(supply_path, 'zip', supply_path)
-    return f'{supply_path}.zip', stickers_report
+    return make_zip_archive(supply_path), stickers_report
+
+
+def make_zip_archive(directory: str) -> str:
+    """
+    Архивирует файлы папки в zip архив рядом с ней. Файлы пишутся по порядку имён
+    с постоянной датой, поэтому одинаковые файлы дают одинаковый архив
+    @param directory: путь к папке
+    @return: путь к архиву
+    """
+    archive_path = f'{directory}.zip'
+    with ZipFile(archive_path, 'w', ZIP_DEFLATED) as archive:
+        for file_name in sorted(os.listdir(directory)):
+            info = ZipInfo(file_name)
+            info.external_attr = 0o644 << 16
+            with open(os.path.join(directory, file_name), 'rb') as file:
+                archive.writestr(info, file.read(), ZIP_DEFLATED)
+    return archive_path
 
 
-def delete_temp_sticker_files():
+def delete_temp_sticker_files(*sticker_files: str):
     """
-    Удаляет папки и zip архивы с pdf стикерами
+    Удаляет папки со стикерами и переданные файлы, созданные prepare_stickers.
+    Остальные файлы рабочей папки не трогаются
+    @param sticker_files: пути к zip архивам и pdf файлам, которые вернула prepare_stickers
     """
     dir_content = os.listdir()
     for path in dir_content:
-        if not path.endswith('.py'):
-            if path.startswith('stickers'):
-                shutil.rmtree(path, ignore_errors=True)
-            if path.endswith('.zip'):
-                os.remove(path)
+        if path.startswith('stickers') and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    for path in sticker_files:
+        if path and os.path.isfile(path):
+            os.remove(path)
 
 
 def convert_to_created_ago(created_at: datetime) -> str:
@@ -196,7 +532,8 @@ def convert_to_created_ago(created_at: datetime) -> str:
     @param created_at: момент отсчёта
     @return: Строка формата HH:MM:SS
     """
-    created_ago = datetime.now() - created_at
+    # Время из API приходит с часовым поясом, а из БД - без него
+    created_ago = datetime.now(created_at.tzinfo) - created_at
     hours, seconds = divmod(created_ago.seconds, 3600)
     minutes, seconds = divmod(seconds, 60)
     return f'{hours:02.0f}:{minutes:02.0f}:{seconds:02.0f}'
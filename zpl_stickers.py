@@ -0,0 +1,108 @@
+import os
+from base64 import b64decode
+
+from pathvalidate import sanitize_filename
+
+from config import ZPL_FONT
+from metrics import STICKER_RENDER_LATENCY
+from models import OrderModel
+from profiling import profiled
+
+# Этикетка 58x40 мм при 8 точках на мм (203 dpi)
+LABEL_WIDTH_DOTS = 464
+LABEL_HEIGHT_DOTS = 320
+
+
+def escape_zpl_text(text: str) -> str:
+    """
+    Экранирует текст для поля ZPL с командой ^FH\\: служебные символы ^ и ~
+    и сам символ экранирования записываются шестнадцатеричными кодами
+    @param text: исходный текст
+    @return: текст, безопасный для ^FD
+    """
+    return text.replace('\\', '\\5C').replace('^', '\\5E').replace('~', '\\7E')
+
+
+def font_command(height: int, font: str = ZPL_FONT) -> str:
+    """
+    Выбирает шрифт для следующего поля ZPL: ^A@ со шрифтом принтера или встроенный ^A0
+    @param height: высота и ширина символов в точках
+    @param font: путь к шрифту на принтере, пустая строка - встроенный шрифт
+    @return: команда выбора шрифта
+    """
+    if font:
+        return f'^A@N,{height},{height},{font}'
+    return f'^A0N,{height},{height}'
+
+
+def make_product_label(name: str, article: str, barcode: str) -> str:
+    """
+    Собирает ZPL этикетку товара: штрихкод Code128 и описание товара.
+    ^CI28 переключает принтер на UTF-8, а шрифт ZPL_FONT содержит русские буквы
+    @param name: наименование товара
+    @param article: артикул товара
+    @param barcode: штрихкод товара
+    @return: этикетка в ZPL
+    """
+    font = font_command(24)
+    return (
+        f'^XA^CI28^PW{LABEL_WIDTH_DOTS}^LL{LABEL_HEIGHT_DOTS}\n'
+        f'^FO24,16^BY2^BCN,80,Y,N,N^FH\\^FD{escape_zpl_text(barcode)}^FS\n'
+        f'^FO24,130{font}^FB416,3,0,L^FH\\^FD{escape_zpl_text(name)}^FS\n'
+        f'^FO24,214{font}^FH\\^FDАртикул: {escape_zpl_text(article)}^FS\n'
+        f'^FO24,244{font}^FDСтрана: Россия^FS\n'
+        f'^FO24,274{font}^FDБренд: CVT^FS\n'
+        f'^XZ\n')
+
+
+@profiled
+def create_zpl_stickers(grouped_orders: dict[str:list[OrderModel]], supply_id: str) -> tuple[str, dict]:
+    """
+    Создает ZPL файлы со стикерами для каждого артикула.
+    Стикеры заказов берутся из API в формате ZPL как есть, PDF не рендерится
+    @param grouped_orders: словарь со заказами, сгруппированными по артикулам
+                            {
+                              Артикул1 : [Заказ1, Заказ2]
+                              и т.д.
+                            }
+    @param supply_id: ID поставки
+    @return: путь к папке с полученными файлами и отчёт о создании стикеров
+    """
+    stickers_report = {
+        'successfully': [],
+        'failed': []
+    }
+
+    supply_path = sanitize_filename(f'stickers for {supply_id}')
+    os.makedirs(supply_path, exist_ok=True)
+
+    for article, orders in grouped_orders.items():
+        file_name = sanitize_filename(article.strip())
+        output_zpl_path = os.path.join(supply_path, f'{file_name}.zpl')
+        try:
+            with STICKER_RENDER_LATENCY.time(format='zpl'):
+                create_zpl_stickers_for_orders(orders, output_zpl_path)
+        except (TypeError, ValueError):
+            stickers_report['failed'].append(article)
+            continue
+        else:
+            stickers_report['successfully'].append(article)
+    return supply_path, stickers_report
+
+
+def create_zpl_stickers_for_orders(orders: list[OrderModel], output_zpl_path: str):
+    """Создает ZPL файл, в который для каждого заказа подряд помещаются
+    стикер заказа и этикетка товара со штрихкодом
+    @param orders: Список заказов
+    @param output_zpl_path: путь, куда сохранять файл
+    @raise: TypeError, ValueError, если у заказа нет стикера или у товара нет наименования и штрихкода
+    """
+    labels = []
+    for order in orders:
+        product = order.product
+        if product.name is None or product.barcode is None:
+            raise TypeError(f'Нет наименования или штрихкода товара {product.article}')
+        labels.append(b64decode(order.sticker, validate=True).rstrip() + b'\n')
+        labels.append(make_product_label(product.name, product.article, product.barcode).encode())
+    with open(output_zpl_path, 'wb') as file:
+        file.writelines(labels)